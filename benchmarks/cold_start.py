@@ -0,0 +1,96 @@
+"""
+cold_start.py measures the import time and the time-to-first-response of the webapp.
+
+Every run starts a fresh interpreter, imports `webapp.main` and sends one request straight
+to the ASGI app, as a serverless cold start would. The median of the runs is printed as JSON.
+
+Usage:
+    python -m benchmarks.cold_start [--runs 10] [--path /api/v1/ping] [--output result.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['jwt', 'psycopg2', 'asyncpg']
+
+_PROBE = """
+import asyncio, json, sys, time
+
+start = time.perf_counter()
+from webapp.main import app
+imported = time.perf_counter()
+
+
+async def first_response(path):
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "headers": [(b"host", b"localhost")],
+             "client": ("127.0.0.1", 0), "server": ("localhost", 80)}
+    status = {}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+
+    await app(scope, receive, send)
+    return status.get("code")
+
+
+status_code = asyncio.run(first_response(sys.argv[1]))
+responded = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_response_ms": (responded - imported) * 1000,
+    "total_ms": (responded - start) * 1000,
+    "status_code": status_code,
+    "modules": len(sys.modules),
+    "heavy_modules": [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+def run_once(path: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('COLD_START', '1')
+    env.setdefault('DATABASE_URL', 'postgresql://localhost/devchat')
+    output = subprocess.run([sys.executable, '-c', _PROBE, path, *HEAVY_MODULES],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs: list) -> dict:
+    summary = {'runs': len(runs)}
+    for field in ('import_ms', 'first_response_ms', 'total_ms'):
+        values = [run[field] for run in runs]
+        summary[field] = {'median': statistics.median(values),
+                          'min': min(values), 'max': max(values)}
+    summary['status_code'] = runs[-1]['status_code']
+    summary['modules'] = runs[-1]['modules']
+    summary['heavy_modules'] = runs[-1]['heavy_modules']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/api/v1/ping')
+    parser.add_argument('--output', help="Write the result to this JSON file as well")
+    args = parser.parse_args()
+
+    result = summarize([run_once(args.path) for _ in range(args.runs)])
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
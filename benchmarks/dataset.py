@@ -0,0 +1,347 @@
+"""
+dataset.py seeds a database at production scale to load-test against.
+
+It generates users, organizations with their members and access keys, payments, transactions
+and the daily Balance history of every organization, and bulk-loads them with COPY. Sizes
+are skewed like real usage: most organizations have a few members and little traffic, while
+a fraction of "whale" organizations have many members and most of the transactions. The
+balances are computed from the generated payments and transactions, so `calculate_balances`
+carries on from them consistently.
+
+The rows are built from the models in webapp/model: users and organizations get their IDs
+from the ID allocators, and access keys are hashed by the AccessKey model. Given the same
+seed, an empty database and the same ID_PERMUTATION_KEY, the same dataset is generated,
+except for the random part of the access keys.
+
+Usage:
+    python -m benchmarks.dataset [--organizations 10000] [--users 50000]
+                                 [--transactions 1000000] [--days 180] [--seed 0]
+                                 [--keys-output keys.csv] [--truncate]
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Sequence
+from sqlalchemy import Table, func, select
+from webapp.model import Database, User, Organization, Role, AccessKey
+from webapp.model import Transaction, Balance, Payment, organization_user
+from webapp.utils import generate_access_key
+
+# Prices per 1000 tokens used to compute the cost of the transactions.
+PROMPT_PRICE = 0.0015
+RESPONSE_PRICE = 0.002
+
+_TABLES = [organization_user, AccessKey.__table__, Transaction.__table__, Balance.__table__,
+           Payment.__table__, User.__table__, Organization.__table__]
+
+
+def copy_rows(cursor, table: Table, columns: Sequence[str], rows: Iterable[Sequence]) -> int:
+    """
+    Load rows into a table with COPY.
+
+    Args:
+        cursor: psycopg2 cursor
+        table (Table): Table of the model the rows belong to
+        columns (list): Columns of the table, in the order of the values of the rows
+        rows (iterable): Rows of values, None for NULL
+
+    Returns:
+        int: Number of rows loaded
+    """
+    unknown = set(columns) - set(table.columns.keys())
+    if unknown:
+        raise ValueError(f"Unknown columns of {table.name}: {', '.join(sorted(unknown))}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                       buffer)
+    return count
+
+
+class Generator:
+    """
+    Generator of a dataset, drawing every value from a random generator seeded once.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        interval = timedelta(hours=args.balance_interval)
+        epoch = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        now = datetime.now(timezone.utc)
+        # Align the history on whole intervals, ending before now.
+        self.end = epoch + interval * ((now - epoch) // interval)
+        self.interval = interval
+        self.buckets = max(1, int(timedelta(days=args.days) / interval))
+        self.start = self.end - interval * self.buckets
+        self.counts = {}
+        self.timings = {}
+
+    def _timed(self, name: str, started: float, count: int):
+        self.counts[name] = self.counts.get(name, 0) + count
+        self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+
+    def users(self, db, cursor) -> List[int]:
+        started = time.perf_counter()
+        rows = []
+        for i in range(self.args.users):
+            user = User(db, username=f"user{i:07d}", email=f"user{i:07d}@example.com")
+            create_time = self.start + (self.end - self.start) * self.rng.random() / 2
+            rows.append((user.id, user.username, user.email, create_time, 1))
+        copy_rows(cursor, User.__table__,
+                  ['id', 'username', 'email', 'create_time', 'version'], rows)
+        self._timed('users', started, len(rows))
+        return [row[0] for row in rows]
+
+    def organizations(self, db, cursor) -> List[int]:
+        started = time.perf_counter()
+        rows = []
+        for i in range(self.args.organizations):
+            organization = Organization(db, name=f"org{i:06d}")
+            rows.append((organization.id, organization.name, 0.0, 'USD', self.start, 1))
+        copy_rows(cursor, Organization.__table__,
+                  ['id', 'name', 'balance', 'currency', 'create_time', 'version'], rows)
+        self._timed('organizations', started, len(rows))
+        return [row[0] for row in rows]
+
+    def members(self, cursor, org_ids: List[int], user_ids: List[int]) -> List[List[int]]:
+        """
+        Draw the members of every organization, the first one being its owner.
+        Member counts follow a Pareto distribution, and whales get `--whale-members`.
+        """
+        started = time.perf_counter()
+        args = self.args
+        members = []
+        rows = []
+        for index, org_id in enumerate(org_ids):
+            if index < self.whales:
+                size = args.whale_members
+            else:
+                size = int(self.rng.paretovariate(args.members_alpha))
+            org_members = self.rng.sample(user_ids, max(1, min(size, len(user_ids))))
+            members.append(org_members)
+            rows.append((org_id, org_members[0], Role.OWNER.name))
+            rows.extend((org_id, user_id, Role.MEMBER.name) for user_id in org_members[1:])
+        copy_rows(cursor, organization_user, ['organization_id', 'user_id', 'role'], rows)
+        self._timed('organization_user', started, len(rows))
+        return members
+
+    def access_keys(self, cursor, org_ids: List[int], members: List[List[int]], output):
+        started = time.perf_counter()
+        args = self.args
+        rows = []
+        hashes = set()
+        for org_id, org_members in zip(org_ids, members):
+            for user_id in org_members:
+                if self.rng.random() >= args.key_fraction:
+                    continue
+                value = generate_access_key(org_id)
+                key = AccessKey(value, user_id=user_id, organization_id=org_id)
+                if key.key_hash in hashes:  # same second and random bits, skip it
+                    continue
+                hashes.add(key.key_hash)
+                create_time = self.start + (self.end - self.start) * self.rng.random()
+                revoked = self.rng.random() < args.revoked_fraction
+                rows.append((key.key_hash, key.thumbnail, create_time,
+                             self.end if revoked else None, user_id, org_id))
+                if output is not None and not revoked:
+                    output.writerow((user_id, org_id, value))
+        copy_rows(cursor, AccessKey.__table__, ['key_hash', 'thumbnail', 'create_time',
+                                                'revoke_time', 'user_id', 'organization_id'],
+                  rows)
+        self._timed('access_keys', started, len(rows))
+
+    @property
+    def whales(self) -> int:
+        return math.ceil(self.args.organizations * self.args.whale_fraction)
+
+    def _activity(self, org_count: int) -> List[float]:
+        # Cumulative weights of the organizations to draw the transactions from.
+        cumulative = []
+        total = 0.0
+        for index in range(org_count):
+            weight = self.rng.paretovariate(self.args.activity_alpha)
+            if index < self.whales:
+                weight *= self.args.whale_weight
+            total += weight
+            cumulative.append(total)
+        return cumulative
+
+    def transactions(self, conn, org_ids: List[int], members: List[List[int]]) -> dict:
+        """
+        Load the transactions in chunks, and sum them per organization and balance interval.
+        """
+        started = time.perf_counter()
+        args = self.args
+        cumulative = self._activity(len(org_ids))
+        indexes = range(len(org_ids))
+        span = (self.end - self.start).total_seconds()
+        interval = self.interval.total_seconds()
+        sums = {}
+        columns = ['organization_id', 'user_id', 'prompt_tokens', 'response_tokens', 'cost',
+                   'currency', 'create_time']
+        remaining = args.transactions
+        while remaining > 0:
+            chunk = min(remaining, args.chunk)
+            rows = []
+            for index in self.rng.choices(indexes, cum_weights=cumulative, k=chunk):
+                offset = self.rng.random() * span
+                prompt_tokens = int(self.rng.lognormvariate(6.5, 1.0))
+                response_tokens = int(self.rng.lognormvariate(5.5, 1.0))
+                price = prompt_tokens * PROMPT_PRICE + response_tokens * RESPONSE_PRICE
+                cost = round(price / 1000, 8)
+                rows.append((org_ids[index], self.rng.choice(members[index]), prompt_tokens,
+                             response_tokens, cost, 'USD',
+                             self.start + timedelta(seconds=offset)))
+                bucket_sums = sums.setdefault((index, int(offset // interval)), [0, 0, 0.0])
+                bucket_sums[0] += prompt_tokens
+                bucket_sums[1] += response_tokens
+                bucket_sums[2] += cost
+            with conn.cursor() as cursor:
+                copy_rows(cursor, Transaction.__table__, columns, rows)
+            conn.commit()
+            remaining -= chunk
+            print(f"transactions: {args.transactions - remaining}/{args.transactions}",
+                  file=sys.stderr)
+        self._timed('transactions', started, args.transactions)
+        return sums
+
+    def balances(self, cursor, org_ids: List[int], sums: dict):
+        """
+        Load the initial payment of every organization and its balance at the end of every
+        interval, then set the organizations to their last balance.
+        """
+        started = time.perf_counter()
+        payments = []
+        balances = []
+        for index, org_id in enumerate(org_ids):
+            amount = 10000.0 if index < self.whales else float(self.rng.choice((10, 20, 50, 100)))
+            payments.append((org_id, amount, 'USD', self.start))
+            balance = amount
+            for bucket in range(self.buckets):
+                prompt_tokens, response_tokens, cost = sums.get((index, bucket), (0, 0, 0.0))
+                balance -= cost
+                balances.append((self.start + self.interval * (bucket + 1), org_id,
+                                 prompt_tokens, response_tokens, balance, 'USD'))
+        copy_rows(cursor, Payment.__table__,
+                  ['organization_id', 'amount', 'currency', 'create_time'], payments)
+        self._timed('payments', started, len(payments))
+        copy_rows(cursor, Balance.__table__, ['timestamp', 'organization_id', 'prompt_token_sum',
+                                              'response_token_sum', 'balance', 'currency'],
+                  balances)
+        cursor.execute("UPDATE organizations SET balance = balances.balance FROM balances "
+                       "WHERE balances.organization_id = organizations.id "
+                       "AND balances.timestamp = %s", (self.end,))
+        self._timed('balances', started, len(balances))
+
+
+def _is_empty(database: Database) -> bool:
+    with database.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(  # pylint: disable=E1102
+            select(User.id).limit(1).subquery())).scalar_one() == 0
+
+
+def generate(database: Database, args) -> dict:
+    """
+    Generate the dataset into an empty database.
+
+    Returns:
+        dict: Number of rows and seconds spent per table
+    """
+    generator = Generator(args)
+    output_file = open(args.keys_output, 'w', encoding='utf-8', newline='') \
+        if args.keys_output else None  # pylint: disable=consider-using-with
+    conn = database.engine.raw_connection()
+    try:
+        output = csv.writer(output_file) if output_file else None
+        if output:
+            output.writerow(('user_id', 'organization_id', 'access_key'))
+        with database.get_session() as db, conn.cursor() as cursor:
+            user_ids = generator.users(db, cursor)
+            org_ids = generator.organizations(db, cursor)
+            db.commit()
+            members = generator.members(cursor, org_ids, user_ids)
+            generator.access_keys(cursor, org_ids, members, output)
+        conn.commit()
+        sums = generator.transactions(conn, org_ids, members)
+        with conn.cursor() as cursor:
+            generator.balances(cursor, org_ids, sums)
+        conn.commit()
+    finally:
+        conn.close()
+        if output_file:
+            output_file.close()
+
+    started = time.perf_counter()
+    with database.engine.connect() as db_conn:
+        db_conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('ANALYZE')
+    generator.timings['analyze'] = time.perf_counter() - started
+
+    return {'seed': args.seed, 'start': generator.start.isoformat(),
+            'end': generator.end.isoformat(), 'whales': generator.whales,
+            'rows': generator.counts,
+            'seconds': {name: round(value, 3) for name, value in generator.timings.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--organizations', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=180, help="Days of history")
+    parser.add_argument('--balance-interval', type=int, default=24,
+                        help="Hours between two balances of an organization")
+    parser.add_argument('--members-alpha', type=float, default=1.5,
+                        help="Pareto shape of the member counts, lower is more skewed")
+    parser.add_argument('--activity-alpha', type=float, default=1.2,
+                        help="Pareto shape of the transaction volumes, lower is more skewed")
+    parser.add_argument('--whale-fraction', type=float, default=0.01,
+                        help="Fraction of whale organizations")
+    parser.add_argument('--whale-members', type=int, default=1000,
+                        help="Members of a whale organization")
+    parser.add_argument('--whale-weight', type=float, default=100,
+                        help="Transaction volume of a whale relative to other organizations")
+    parser.add_argument('--key-fraction', type=float, default=0.5,
+                        help="Fraction of the memberships with an access key")
+    parser.add_argument('--revoked-fraction', type=float, default=0.1,
+                        help="Fraction of the access keys that are revoked")
+    parser.add_argument('--chunk', type=int, default=100000,
+                        help="Transactions loaded per COPY")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keys-output', help="Write the valid access keys to this CSV file")
+    parser.add_argument('--truncate', action='store_true',
+                        help="Empty the tables of the dataset first")
+    parser.add_argument('--output', help="Write the result to this JSON file as well")
+    args = parser.parse_args()
+
+    database = Database(os.environ['DATABASE_URL'])
+    if args.truncate:
+        with database.engine.begin() as conn:
+            conn.exec_driver_sql(f"TRUNCATE {', '.join(table.name for table in _TABLES)} "
+                                 "RESTART IDENTITY CASCADE")
+    elif not _is_empty(database):
+        parser.error("The database already has users, pass --truncate to replace them.")
+
+    result = generate(database, args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+serialization.py compares the default and the fast response path of the organizations
+endpoint of a user, without a database.
+
+The default path builds `OrganizationResponse` objects, which FastAPI validates again against
+the response model before encoding them. The fast path encodes the rows as they are built
+from the query results. The median time per response of each path is printed as JSON.
+
+Usage:
+    python -m benchmarks.serialization [--organizations 50] [--keys 20] [--runs 200]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime, timezone
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from webapp.api.fast_json import FastJSONResponse, orjson
+from webapp.api.v1.entities.users import OrganizationResponse, organization_rows
+from webapp.model import Role
+
+
+def make_results(organizations: int, keys: int):
+    """
+    Build query results shaped like those of get_organizations_of_user and
+    get_user_keys_in_organizations.
+    """
+    create_time = datetime(2023, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    orgs = [{"id": 10000000000 + i, "name": f"organization-{i}", "role": Role.MEMBER}
+            for i in range(organizations)]
+    org_keys = {org["id"]: [{"id": org["id"] * 100 + k, "thumbnail": "DC.abcd...wxyz0123",
+                             "create_time": create_time} for k in range(keys)]
+                for org in orgs}
+    return orgs, org_keys
+
+
+def default_path(loop, field, orgs, org_keys) -> bytes:
+    content = [OrganizationResponse(**org) for org in organization_rows(orgs, org_keys)]
+    return JSONResponse(loop.run_until_complete(
+        serialize_response(field=field, response_content=content))).body
+
+
+def fast_path(orgs, org_keys) -> bytes:
+    return FastJSONResponse(organization_rows(orgs, org_keys)).body
+
+
+def measure(func, runs: int) -> dict:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--organizations', type=int, default=50)
+    parser.add_argument('--keys', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--output', help="Write the result to this JSON file as well")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    field = create_response_field('response', list[OrganizationResponse])
+    orgs, org_keys = make_results(args.organizations, args.keys)
+    if json.loads(default_path(loop, field, orgs, org_keys)) != \
+            json.loads(fast_path(orgs, org_keys)):
+        raise SystemExit("The fast path encodes a different response.")
+
+    default = measure(lambda: default_path(loop, field, orgs, org_keys), args.runs)
+    fast = measure(lambda: fast_path(orgs, org_keys), args.runs)
+    loop.close()
+    result = {'organizations': args.organizations, 'keys_per_organization': args.keys,
+              'encoder': 'orjson' if orjson is not None else 'json',
+              'default': default, 'fast': fast,
+              'speedup': default['median_ms'] / fast['median_ms']}
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+signup.py measures the statements, commits and time per signup against a real database.
+
+It compares the step-by-step path (create_user, create_organization,
+add_user_to_organization, create_access_key and enqueue_message, each committing on its
+own) with `create_account`, which writes the same entities in one transaction.
+The tables are created in DATABASE_URL and the created rows are dropped afterwards.
+
+Usage:
+    python -m benchmarks.signup [--signups 200] [--output result.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import uuid
+from sqlalchemy import event
+from webapp.controller import create_user, create_organization, add_user_to_organization
+from webapp.controller import create_access_key, enqueue_message, create_account
+from webapp.model import Base, Database
+
+_WELCOME_EMAIL = {'from_address': 'hello@devchat.ai', 'from_name': 'DevChat Team',
+                  'template_id': 'benchmark'}
+
+
+def _step_by_step(db, username: str, email: str):
+    user = create_user(db, username, email)
+    organization = create_organization(db, username)
+    add_user_to_organization(db, user.id, organization.id, 'owner')
+    _, value = create_access_key(db, user.id, organization.id, commit=False)
+    enqueue_message(db, 'email', {**_WELCOME_EMAIL, 'to_address': email,
+                                  'template_data': {'user_name': username,
+                                                    'access_key': value}})
+    db.commit()
+
+
+def _unit_of_work(db, username: str, email: str):
+    create_account(db, username, email, welcome_email=_WELCOME_EMAIL)
+
+
+class _Counter:
+    def __init__(self, engine):
+        self.statements = 0
+        self.commits = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+        event.listen(engine, 'commit', self._on_commit)
+
+    def _on_execute(self, *_):
+        self.statements += 1
+
+    def _on_commit(self, *_):
+        self.commits += 1
+
+
+def run(database: Database, path, signups: int) -> dict:
+    counter = _Counter(database.engine)
+    prefix = uuid.uuid4().hex[:8]
+    timings = []
+    statements = commits = 0
+    with database.get_session() as db:
+        for i in range(signups):
+            username = f'bench-{prefix}-{i}'
+            before = (counter.statements, counter.commits)
+            start = time.perf_counter()
+            path(db, username, f'{username}@example.com')
+            timings.append((time.perf_counter() - start) * 1000)
+            statements += counter.statements - before[0]
+            commits += counter.commits - before[1]
+    return {'signups': signups,
+            'statements_per_signup': statements / signups,
+            'commits_per_signup': commits / signups,
+            'latency_ms': {'median': statistics.median(timings),
+                           'p95': sorted(timings)[int(len(timings) * 0.95) - 1],
+                           'max': max(timings)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--signups', type=int, default=200)
+    parser.add_argument('--output', help="Write the result to this JSON file as well")
+    args = parser.parse_args()
+
+    database = Database(os.environ['DATABASE_URL'])
+    try:
+        result = {'step_by_step': run(database, _step_by_step, args.signups),
+                  'unit_of_work': run(database, _unit_of_work, args.signups)}
+    finally:
+        Base.metadata.drop_all(database.engine)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
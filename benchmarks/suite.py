@@ -0,0 +1,266 @@
+"""
+suite.py runs the benchmark suite of the controllers and the API against a local Postgres.
+
+The microbenchmarks time the hot controller and utility functions one call at a time. The
+load tests send requests from concurrent clients to the FastAPI app in-process, without a
+network in between. The tables are created in DATABASE_URL, seeded with a small dataset
+and dropped afterwards, so point it at a scratch database. A database holding any row is
+refused.
+
+The results are written as JSON, and two result files can be compared:
+
+Usage:
+    python -m benchmarks.suite [--quick] [--concurrency 16] [--output result.json]
+    python -m benchmarks.suite --compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, List
+from sqlalchemy import select
+from webapp.controller import create_organization, create_user, add_user_to_organization
+from webapp.controller import create_access_key, provision_users, login_by_key
+from webapp.controller import get_organizations_of_user, add_transactions_batch
+from webapp.controller import calculate_balances, get_cache
+from webapp.model import Base, Database, Transaction
+from webapp.utils import generate_access_key, verify_access_key
+from webapp.utils import is_valid_email, is_valid_account_name
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(name: str, timings: List[float], elapsed: float, errors: int = 0) -> dict:
+    """
+    Summarize timings in seconds as throughput and latency percentiles in milliseconds.
+    """
+    timings = sorted(timings)
+    return {'name': name, 'count': len(timings), 'errors': errors,
+            'throughput': len(timings) / elapsed if elapsed else 0.0,
+            'mean_ms': sum(timings) / len(timings) * 1000,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000}
+
+
+def bench(name: str, func: Callable[[], Any], iterations: int, warmup: int = 3) -> dict:
+    for _ in range(min(warmup, iterations)):
+        func()
+    timings = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - call_start)
+    return summarize(name, timings, time.perf_counter() - start)
+
+
+class Dataset:
+    """
+    Organizations with members, access keys and transactions to run the benchmarks on.
+    """
+
+    def __init__(self, db, organizations: int, users_per_organization: int,
+                 transactions_per_organization: int):
+        self.org_ids = []
+        self.users = []
+        self.keys = {}
+        for i in range(organizations):
+            owner = create_user(db, f"bench-owner-{i}", f"bench-owner-{i}@example.com")
+            org = create_organization(db, f"bench-org-{i}")
+            owner_id, org_id = owner.id, org.id
+            add_user_to_organization(db, owner_id, org_id, 'owner')
+            _, self.keys[owner_id] = create_access_key(db, owner_id, org_id)
+            rows = [{'username': f"bench-{i}-{j}", 'email': f"bench-{i}-{j}@example.com"}
+                    for j in range(users_per_organization)]
+            for result in provision_users(db, org_id, rows, create_keys=True):
+                self.keys[result['user_id']] = result['access_key']
+            self.org_ids.append(org_id)
+            self.users.append((owner_id, org_id))
+
+        start = datetime.now(timezone.utc) - timedelta(days=30)
+        for org_id, (user_id, _) in zip(self.org_ids, self.users):
+            add_transactions_batch(db, [
+                Transaction(organization_id=org_id, user_id=user_id,
+                            prompt_tokens=random.randint(10, 2000),
+                            response_tokens=random.randint(10, 2000),
+                            cost=random.random() / 100,
+                            create_time=start + timedelta(minutes=k))
+                for k in range(transactions_per_organization)])
+
+
+def run_micro(db, data: Dataset, scale: float) -> List[dict]:
+    def iterations(count: int) -> int:
+        return max(1, int(count * scale))
+
+    owner_id, org_id = data.users[0]
+    key = data.keys[owner_id]
+    emails = [f"user{i}@example.com" for i in range(100)] + ["not-an-email"] * 10
+    names = [f"user-{i}" for i in range(100)] + ["-bad-", "a" * 50]
+    batch_org_id = data.org_ids[-1]
+
+    def add_batch():
+        add_transactions_batch(db, [
+            Transaction(organization_id=batch_org_id, user_id=owner_id, prompt_tokens=100,
+                        response_tokens=100, cost=0.001) for _ in range(1000)])
+
+    return [
+        bench('is_valid_email[x110]', lambda: [is_valid_email(e) for e in emails],
+              iterations(2000)),
+        bench('is_valid_account_name[x102]', lambda: [is_valid_account_name(n) for n in names],
+              iterations(2000)),
+        bench('generate_access_key', lambda: generate_access_key(org_id), iterations(5000)),
+        bench('verify_access_key', lambda: verify_access_key(key), iterations(5000)),
+        bench('login_by_key', lambda: login_by_key(db, key), iterations(1000)),
+        bench('get_organizations_of_user[cached]',
+              lambda: get_organizations_of_user(db, owner_id), iterations(5000)),
+        bench('get_organizations_of_user[uncached]',
+              lambda: get_organizations_of_user(db, owner_id, ['id', 'name', 'role']),
+              iterations(1000)),
+        bench('add_transactions_batch[1000]', add_batch, iterations(20), warmup=1),
+        bench(f'calculate_balances[{len(data.org_ids)} orgs]',
+              lambda: calculate_balances(db, data.org_ids), iterations(10), warmup=1),
+    ]
+
+
+async def _load(client, name: str, make_request: Callable, concurrency: int,
+                requests: int) -> dict:
+    timings = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in remaining:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            timings.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return {**summarize(name, timings, time.perf_counter() - start, errors),
+            'concurrency': concurrency}
+
+
+async def run_load(data: Dataset, concurrency: int, requests: int) -> List[dict]:
+    import httpx  # pylint: disable=import-outside-toplevel
+    from webapp.main import app  # pylint: disable=import-outside-toplevel
+
+    users = data.users
+    keys = [data.keys[user_id] for user_id, _ in users]
+    scenarios = {
+        'GET /api/v1/ping': lambda client, i: client.get('/api/v1/ping'),
+        'GET /api/v1/users/{id}/profile': lambda client, i: client.get(
+            f'/api/v1/users/{users[i % len(users)][0]}/profile'),
+        'GET /api/v1/users/{id}/organizations': lambda client, i: client.get(
+            f'/api/v1/users/{users[i % len(users)][0]}/organizations'),
+        'POST /api/v1/login': lambda client, i: client.post(
+            '/api/v1/login', json={'key': keys[i % len(keys)]}),
+        'GET /api/v1/organizations/{id}/users': lambda client, i: client.get(
+            f'/api/v1/organizations/{users[i % len(users)][1]}/users',
+            headers={'Authorization': f'Bearer {keys[i % len(keys)]}'}),
+    }
+    results = []
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        for name, make_request in scenarios.items():
+            await _load(client, name, make_request, concurrency, max(concurrency, requests // 10))
+            results.append(await _load(client, name, make_request, concurrency, requests))
+    return results
+
+
+def compare(before_path: str, after_path: str):
+    """
+    Print the change of throughput and p99 latency of every benchmark in both result files.
+    """
+    with open(before_path, encoding='utf-8') as file:
+        before = json.load(file)
+    with open(after_path, encoding='utf-8') as file:
+        after = json.load(file)
+    print(f"{'benchmark':48} {'throughput':>22} {'p99 ms':>22}")
+    for section in ('micro', 'load'):
+        previous = {result['name']: result for result in before.get(section, [])}
+        for result in after.get(section, []):
+            old = previous.get(result['name'])
+            if old is None:
+                continue
+            throughput = (result['throughput'] / old['throughput'] - 1) * 100 \
+                if old['throughput'] else 0.0
+            p99 = (result['p99_ms'] / old['p99_ms'] - 1) * 100 if old['p99_ms'] else 0.0
+            print(f"{result['name']:48} {result['throughput']:12.1f} ({throughput:+6.1f}%) "
+                  f"{result['p99_ms']:12.3f} ({p99:+6.1f}%)")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _is_empty(database: Database) -> bool:
+    # The tables are dropped afterwards, so none of them may hold data of its own.
+    with database.engine.connect() as conn:
+        return all(conn.execute(select(table).limit(1)).first() is None
+                   for table in Base.metadata.sorted_tables)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--organizations', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50, help="Users per organization")
+    parser.add_argument('--transactions', type=int, default=2000,
+                        help="Transactions per organization")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per endpoint")
+    parser.add_argument('--quick', action='store_true', help="Run a tenth of the iterations")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the result to this JSON file as well")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    database = Database(os.environ['DATABASE_URL'])
+    if not _is_empty(database):
+        parser.error("The database is not empty, point DATABASE_URL to a scratch database.")
+
+    random.seed(args.seed)
+    scale = 0.1 if args.quick else 1.0
+    requests = max(args.concurrency, int(args.requests * scale))
+    try:
+        with database.get_session() as db:
+            data = Dataset(db, args.organizations, args.users, args.transactions)
+            micro = run_micro(db, data, scale)
+        get_cache().clear()
+        load = asyncio.run(run_load(data, args.concurrency, requests))
+    finally:
+        Base.metadata.drop_all(database.engine)
+
+    result = {'commit': _git_commit(), 'time': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'dataset': {'organizations': args.organizations, 'users': args.users,
+                          'transactions': args.transactions, 'seed': args.seed},
+              'micro': micro, 'load': load}
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+test_dataloader.py contains tests for the batching of lookups in dataloader.py.
+"""
+import asyncio
+import pytest
+from webapp.api.dataloader import DataLoader
+
+
+def _squares(batches: list, fail: bool = False):
+    async def batch_load(keys):
+        batches.append(list(keys))
+        if fail:
+            raise ValueError("broken")
+        return {key: key * key for key in keys if key >= 0}
+    return batch_load
+
+
+def test_loads_of_one_tick_are_batched():
+    batches = []
+
+    async def load():
+        loader = DataLoader(_squares(batches), max_batch_size=3)
+        results = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1),
+                                       loader.load_many([3, -1, 4]))
+        again = await loader.load(2)
+        return results, again
+
+    assert asyncio.run(load()) == ([1, 4, 1, [9, None, 16]], 4)
+    assert batches == [[1, 2, 3], [-1, 4]]
+
+
+def test_batch_errors_are_raised_to_every_load():
+    async def load():
+        loader = DataLoader(_squares([], fail=True))
+        return await asyncio.gather(loader.load(1), loader.load(2), return_exceptions=True)
+
+    results = asyncio.run(load())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+    async def load_many():
+        return await DataLoader(_squares([], fail=True)).load_many([1])
+
+    with pytest.raises(ValueError):
+        asyncio.run(load_many())
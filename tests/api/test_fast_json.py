@@ -0,0 +1,22 @@
+"""
+test_fast_json.py contains tests for the response class in fast_json.py.
+"""
+import json
+from datetime import datetime, timezone
+from webapp.api import fast_json
+from webapp.api.fast_json import FastJSONResponse
+from webapp.model import Role
+
+CONTENT = {"role": Role.OWNER, "name": "ünïcode",
+           "create_time": datetime(2023, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)}
+EXPECTED = {"role": "owner", "name": "ünïcode",
+            "create_time": "2023-05-01T12:30:15.123456+00:00"}
+
+
+def test_fast_json_response():
+    assert json.loads(FastJSONResponse(CONTENT).body) == EXPECTED
+
+
+def test_fast_json_response_without_orjson(monkeypatch):
+    monkeypatch.setattr(fast_json, "orjson", None)
+    assert json.loads(FastJSONResponse(CONTENT).body) == EXPECTED
@@ -0,0 +1,237 @@
+import asyncio
+import os
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from webapp.main import app
+from webapp.controller import create_access_key, create_user, create_organization
+from webapp.controller import add_user_to_organization
+from webapp.events import get_event_hub
+from webapp.metrics import DB_QUERIES
+from webapp.settings import get_settings
+
+client = TestClient(app)
+
+
+def _create_owner(database):
+    user = create_user(database, username="owner", email="owner@example.com")
+    org = create_organization(database, name="Test-Org")
+    add_user_to_organization(database, user.id, org.id, 'owner')
+    _, value = create_access_key(database, user_id=user.id, organization_id=org.id)
+    return org, {"Authorization": f"Bearer {value}"}
+
+
+def test_provision_users_json(database):
+    org, headers = _create_owner(database)
+
+    response = client.post(f"/api/v1/organizations/{org.id}/users?create_keys=true",
+                           headers=headers, json=[
+                               {"username": "alice", "email": "alice@example.com"},
+                               ["bob", "bob@example.com", "owner"],
+                               {"username": "owner", "email": "owner@example.com"},
+                           ])
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["succeeded"] == 2
+    assert body["failed"] == 1
+    assert body["results"][0]["access_key"].startswith("DC.")
+    assert body["results"][1]["role"] == "owner"
+    assert body["results"][2]["error"] == "User already in the organization."
+
+
+def test_provision_users_csv(database):
+    org, headers = _create_owner(database)
+
+    response = client.post(f"/api/v1/organizations/{org.id}/users",
+                           headers={**headers, "Content-Type": "text/csv"},
+                           content="username,email,role\n"
+                                   "alice,alice@example.com,member\n"
+                                   "bob,bob@example.com,\n")
+
+    assert response.status_code == 200
+    assert response.json()["succeeded"] == 2
+    assert response.json()["results"][1]["access_key"] is None
+
+
+def test_provision_users_requires_owner(database):
+    org, _ = _create_owner(database)
+    member = create_user(database, username="member", email="member@example.com")
+    add_user_to_organization(database, member.id, org.id)
+    _, value = create_access_key(database, user_id=member.id, organization_id=org.id)
+
+    response = client.post(f"/api/v1/organizations/{org.id}/users", json=[])
+    assert response.status_code == 401
+
+    response = client.post(f"/api/v1/organizations/{org.id}/users",
+                           headers={"Authorization": f"Bearer {value}"}, json=[])
+    assert response.status_code == 403
+
+
+def test_provision_users_invalid_body(database):
+    org, headers = _create_owner(database)
+
+    response = client.post(f"/api/v1/organizations/{org.id}/users",
+                           headers=headers, json={"username": "alice"})
+    assert response.status_code == 422
+
+
+def _walk(path, headers, limit):
+    items, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+        response = client.get(path, headers=headers, params=params)
+        assert response.status_code == 200
+        body = response.json()
+        items.extend(body[path.rsplit("/", 1)[-1]])
+        pages += 1
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return items, pages
+
+
+def test_list_organization_users_pages(database):
+    org, headers = _create_owner(database)
+    client.post(f"/api/v1/organizations/{org.id}/users", headers=headers, json=[
+        {"username": f"user{i}", "email": f"user{i}@example.com"} for i in range(6)])
+
+    users, pages = _walk(f"/api/v1/organizations/{org.id}/users", headers, limit=3)
+
+    assert pages == 3
+    assert len(users) == 7
+    assert [user["id"] for user in users] == sorted(user["id"] for user in users)
+
+
+def test_list_organization_keys_pages(database):
+    org, headers = _create_owner(database)
+    client.post(f"/api/v1/organizations/{org.id}/users?create_keys=true", headers=headers,
+                json=[{"username": f"user{i}", "email": f"user{i}@example.com"}
+                      for i in range(4)])
+
+    keys, pages = _walk(f"/api/v1/organizations/{org.id}/keys", headers, limit=2)
+
+    assert pages == 3
+    assert len({key["id"] for key in keys}) == 5
+
+
+def test_list_organization_keys_requires_owner(database):
+    org, _ = _create_owner(database)
+    member = create_user(database, username="member", email="member@example.com")
+    add_user_to_organization(database, member.id, org.id)
+    _, value = create_access_key(database, user_id=member.id, organization_id=org.id)
+
+    response = client.get(f"/api/v1/organizations/{org.id}/keys",
+                          headers={"Authorization": f"Bearer {value}"})
+    assert response.status_code == 403
+
+    response = client.get(f"/api/v1/organizations/{org.id}/users",
+                          headers={"Authorization": f"Bearer {value}"},
+                          params={"cursor": "not-a-cursor"})
+    assert response.status_code == 422
+
+
+def test_permissions_are_cached(database):
+    org, headers = _create_owner(database)
+    assert client.get(f"/api/v1/organizations/{org.id}/keys", headers=headers).status_code == 200
+    queries = DB_QUERIES.value(route="/api/v1/organizations/{org_id}/keys")
+
+    # The key lookup and the keys page, with no query for the role of the caller.
+    assert client.get(f"/api/v1/organizations/{org.id}/keys", headers=headers).status_code == 200
+    assert DB_QUERIES.value(route="/api/v1/organizations/{org_id}/keys") == queries + 2
+
+
+def _idle_key_lookups() -> int:
+    # Connections left in a transaction after looking up an access key.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text(
+                "SELECT count(*) FROM pg_stat_activity WHERE pid <> pg_backend_pid() "
+                "AND state LIKE 'idle in transaction%' AND query LIKE '%access_keys%'")).scalar()
+    finally:
+        engine.dispose()
+
+
+def test_organization_events_release_connections(database):
+    org, headers = _create_owner(database)
+    org_id = org.id
+    database.commit()
+
+    async def open_stream():
+        started = asyncio.Event()
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(60)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            started.set()
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+                 "method": "GET", "scheme": "http",
+                 "path": f"/api/v1/organizations/{org_id}/events",
+                 "raw_path": b"", "root_path": "", "query_string": b"",
+                 "headers": [(b"authorization", headers["Authorization"].encode())],
+                 "client": ("127.0.0.1", 1234), "server": ("testserver", 80)}
+        stream = asyncio.ensure_future(app(scope, receive, send))
+        try:
+            await asyncio.wait_for(started.wait(), 5)
+            return messages[0]["status"], await asyncio.to_thread(_idle_key_lookups)
+        finally:
+            stream.cancel()
+            await asyncio.gather(stream, return_exceptions=True)
+            await get_event_hub().stop()
+
+    status, idle = asyncio.run(open_stream())
+    assert status == 200
+    assert idle == 0
+
+
+def test_organization_events_require_member(database):
+    _, headers = _create_owner(database)
+    other = create_organization(database, name="Other-Org")
+    response = client.get(f"/api/v1/organizations/{other.id}/events", headers=headers)
+    assert response.status_code == 403
+
+
+def _create_admin(database, monkeypatch):
+    admin = create_user(database, username="admin", email="admin@example.com")
+    org = create_organization(database, name="Admin-Org")
+    add_user_to_organization(database, admin.id, org.id)
+    _, value = create_access_key(database, user_id=admin.id, organization_id=org.id)
+    monkeypatch.setattr(get_settings(), "admin_user_ids", {admin.id})
+    return {"Authorization": f"Bearer {value}"}
+
+
+def test_search_organizations(database, monkeypatch):
+    headers = _create_admin(database, monkeypatch)
+    for name in ["test-lab", "Tester", "Other-Org", "Test-Org"]:
+        create_organization(database, name=name)
+
+    names, cursor = [], None
+    while True:
+        response = client.get("/api/v1/organizations/search", headers=headers,
+                              params={"q": "TEST", "limit": 2,
+                                      **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        names += [org["name"] for org in response.json()["organizations"]]
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert names == ["test-lab", "Test-Org", "Tester"]
+
+
+def test_search_organizations_times_out(database, monkeypatch):
+    headers = _create_admin(database, monkeypatch)
+    monkeypatch.setattr(get_settings(), "search_timeout", 0.05)
+    engine = create_engine(os.environ['DATABASE_URL'])
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("LOCK TABLE organizations IN ACCESS EXCLUSIVE MODE"))
+            response = client.get("/api/v1/organizations/search", headers=headers,
+                                  params={"q": "test"})
+    finally:
+        engine.dispose()
+    assert response.status_code == 503
+    assert response.json()["detail"] == "Search timed out. Please refine the query."
@@ -0,0 +1,77 @@
+"""
+test_single_flight.py contains tests for the coalescing of reads in single_flight.py.
+"""
+import asyncio
+import pytest
+from webapp.api import single_flight as single_flight_module
+from webapp.api.single_flight import single_flight
+from webapp.metrics import SINGLE_FLIGHT
+from webapp.settings import get_settings
+
+
+def _loader(calls: list, result, delay: float = 0.05):
+    async def load():
+        calls.append(result)
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return load
+
+
+def test_concurrent_reads_share_one_load():
+    calls = []
+    coalesced = SINGLE_FLIGHT.value(name="test", outcome="coalesced")
+
+    async def read():
+        return await asyncio.gather(
+            single_flight("test", (1, 1), _loader(calls, "first")),
+            single_flight("test", (1, 1), _loader(calls, "second")),
+            single_flight("test", (1, 2), _loader(calls, "other version")))
+
+    assert asyncio.run(read()) == ["first", "first", "other version"]
+    assert calls == ["first", "other version"]
+    assert SINGLE_FLIGHT.value(name="test", outcome="coalesced") == coalesced + 1
+    assert not single_flight_module._flights  # pylint: disable=protected-access
+
+
+def test_errors_are_shared():
+    calls = []
+
+    async def read():
+        return await asyncio.gather(
+            single_flight("test", 1, _loader(calls, ValueError("broken"))),
+            single_flight("test", 1, _loader(calls, "second")), return_exceptions=True)
+
+    results = asyncio.run(read())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert len(calls) == 1
+
+
+def test_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(get_settings(), "single_flight_wait", 0.01)
+    calls = []
+
+    async def read():
+        return await asyncio.gather(
+            single_flight("test", 1, _loader(calls, "slow", delay=0.2)),
+            single_flight("test", 1, _loader(calls, "fast", delay=0)))
+
+    assert asyncio.run(read()) == ["slow", "fast"]
+    assert calls == ["slow", "fast"]
+
+
+def test_cancelled_load_is_not_shared():
+    calls = []
+
+    async def read():
+        leader = asyncio.ensure_future(single_flight("test", 1, _loader(calls, "cancelled")))
+        follower = asyncio.ensure_future(single_flight("test", 1, _loader(calls, "own")))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(read()) == "own"
+    assert calls == ["cancelled", "own"]
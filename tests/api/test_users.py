@@ -1,22 +1,27 @@
+import asyncio
+import os
 from fastapi.testclient import TestClient
-import responses
+from sqlalchemy.pool import NullPool
 from webapp.main import app
+from webapp.model import AsyncDatabase, OutboxMessage
+from webapp.worker import OutboxWorker
 from webapp.controller import create_access_key, create_user, create_organization
-from webapp.controller import add_user_to_organization
+from webapp.controller import add_user_to_organization, get_cache
+from webapp.metrics import DB_QUERIES
+from webapp.settings import get_settings
 
 client = TestClient(app)
 
 
-@responses.activate
-def test_create_user_success(database):  # pylint: disable=W0613
-    # Mock the HTTP response for the hCaptcha verification
-    responses.add(
-        responses.POST,
-        "https://hcaptcha.com/siteverify",
-        json={"success": True},
-        status=200
-    )
+async def _drain_outbox():
+    database = AsyncDatabase(os.environ['DATABASE_URL'], create_tables=False, poolclass=NullPool)
+    try:
+        return await OutboxWorker(database).run_once()
+    finally:
+        await database.dispose()
 
+
+def test_create_user_success(database, services):  # pylint: disable=W0613
     response = client.post("/api/v1/users", json={
         "username": "newuser",
         "email": "test@merico.dev",
@@ -28,6 +33,31 @@ def test_create_user_success(database):  # pylint: disable=W0613
     assert response.status_code == 201
     assert isinstance(response.json()["user_id"], int)
 
+    # The welcome email waits in the outbox until a worker sends it
+    assert not services.emails
+    message = database.query(OutboxMessage).one()
+    assert message.topic == "email"
+    assert message.payload["to_address"] == "test@merico.dev"
+
+    assert asyncio.run(_drain_outbox()) == 1
+    assert len(services.emails) == 1
+    email = services.emails[0]
+    assert email["personalizations"][0]["to"] == [{"email": "test@merico.dev"}]
+    assert email["personalizations"][0]["dynamic_template_data"]["user_name"] == "newuser"
+    assert email["personalizations"][0]["dynamic_template_data"]["access_key"].startswith("DC.")
+
+
+def test_create_user_captcha_unavailable(database, services):  # pylint: disable=W0613
+    services.status["/siteverify"] = 503
+
+    response = client.post("/api/v1/users", json={
+        "username": "newuser",
+        "email": "test@merico.dev",
+        "token": "token"
+    })
+
+    assert response.status_code == 503
+
 
 def test_create_user_invalid_hcaptcha(database):  # pylint: disable=W0613
     response = client.post("/api/v1/users", json={
@@ -40,19 +70,10 @@ def test_create_user_invalid_hcaptcha(database):  # pylint: disable=W0613
     assert "Invalid hCaptcha token." in response.json()["detail"]
 
 
-@responses.activate
 def test_create_user_existing_username(database):
     # Create a user with the same username
     create_user(database, username="existinguser", email="existinguser@example.com")
 
-    # Mock the HTTP response for the hCaptcha verification
-    responses.add(
-        responses.POST,
-        "https://hcaptcha.com/siteverify",
-        json={"success": True},
-        status=200
-    )
-
     response = client.post("/api/v1/users", json={
         "username": "existinguser",
         "email": "existinguser@example.com",
@@ -63,19 +84,10 @@ def test_create_user_existing_username(database):
     assert response.json()["detail"] == "Username already exists."
 
 
-@responses.activate
 def test_create_user_existing_email(database):
     # Create a user with the same email
     create_user(database, username="existinguser", email="existingemail@example.com")
 
-    # Mock the HTTP response for the hCaptcha verification
-    responses.add(
-        responses.POST,
-        "https://hcaptcha.com/siteverify",
-        json={"success": True},
-        status=200
-    )
-
     response = client.post("/api/v1/users", json={
         "username": "newuser",
         "email": "existingemail@example.com",
@@ -103,6 +115,49 @@ def test_get_user_profile_not_found(database):  # pylint: disable=W0613
     assert response.json()["detail"] == "User not found."
 
 
+def test_get_user_profile_not_modified(database):  # pylint: disable=W0613
+    user = create_user(database, username="testuser", email="testuser@example.com")
+
+    response = client.get(f"/api/v1/users/{user.id}/profile")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    response = client.get(f"/api/v1/users/{user.id}/profile",
+                          headers={"If-None-Match": f"W/{etag}"})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+
+def test_get_user_profiles(database):  # pylint: disable=W0613
+    users = [create_user(database, username=f"testuser{i}", email=f"testuser{i}@example.com")
+             for i in range(5)]
+    org = create_organization(database, name="Test-Org", country="US")
+    for user in users[:4]:
+        add_user_to_organization(database, user.id, org.id)
+    _, value = create_access_key(database, user_id=users[0].id, organization_id=org.id)
+    headers = {"Authorization": f"Bearer {value}"}
+    # The last user shares no organization with the caller.
+    ids = [user.id for user in reversed(users)] + [999999]
+    get_cache().clear()
+    queries = DB_QUERIES.value(route="/api/v1/users/profiles")
+
+    response = client.get("/api/v1/users/profiles", headers=headers,
+                          params={"ids": ",".join(str(user_id) for user_id in ids)})
+    assert response.status_code == 200
+    assert response.json()["profiles"] == [
+        {"user_id": user.id, "username": user.username, "email": user.email}
+        for user in reversed(users[:4])]
+    # The key, the roles of the caller, the visible users and their profiles.
+    assert DB_QUERIES.value(route="/api/v1/users/profiles") == queries + 4
+
+    response = client.get("/api/v1/users/profiles", params={"ids": str(users[0].id)})
+    assert response.status_code == 401
+
+    response = client.get("/api/v1/users/profiles", headers=headers, params={"ids": "1,abc"})
+    assert response.status_code == 422
+
+
 def test_login(database):
     user = create_user(database, username="testuser", email="testuser@example.com")
     org = create_organization(database, name="Test-Org", country="US")
@@ -170,3 +225,105 @@ def test_get_user_organizations_empty(database):
     response = client.get(f"/api/v1/users/{user.id}/organizations")
     assert response.status_code == 200
     assert len(response.json()) == 0
+
+
+def test_get_user_organizations_not_modified(database):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    org = create_organization(database, name="Test-Org", country="US")
+    add_user_to_organization(database, user.id, org.id)
+
+    response = client.get(f"/api/v1/users/{user.id}/organizations")
+    etag = response.headers["ETag"]
+    response = client.get(f"/api/v1/users/{user.id}/organizations",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # A new key changes the version of the user, so the old ETag no longer matches.
+    create_access_key(database, user_id=user.id, organization_id=org.id)
+    response = client.get(f"/api/v1/users/{user.id}/organizations",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()[0]["keys"]) == 1
+
+
+def test_get_user_keys_pages(database):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    org = create_organization(database, name="Test-Org", country="US")
+    add_user_to_organization(database, user.id, org.id)
+    key_ids = [create_access_key(database, user_id=user.id, organization_id=org.id)[0].id
+               for _ in range(3)]
+
+    response = client.get(f"/api/v1/users/{user.id}/organizations/{org.id}/keys?limit=2")
+    assert [key["id"] for key in response.json()["keys"]] == key_ids[:2]
+    cursor = response.json()["next_cursor"]
+
+    response = client.get(f"/api/v1/users/{user.id}/organizations/{org.id}/keys",
+                          params={"limit": 2, "cursor": cursor})
+    assert [key["id"] for key in response.json()["keys"]] == key_ids[2:]
+    assert response.json()["next_cursor"] is None
+
+
+def test_get_user_organizations_fast_responses(database, monkeypatch):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    org = create_organization(database, name="Test-Org", country="US")
+    add_user_to_organization(database, user.id, org.id)
+    create_access_key(database, user_id=user.id, organization_id=org.id)
+
+    default = client.get(f"/api/v1/users/{user.id}/organizations")
+    monkeypatch.setattr(get_settings(), "fast_responses", True)
+    fast = client.get(f"/api/v1/users/{user.id}/organizations")
+
+    assert fast.status_code == 200
+    assert fast.json() == default.json()
+    assert fast.headers["ETag"] == default.headers["ETag"]
+
+
+def _admin_headers(database, monkeypatch):
+    admin = create_user(database, username="admin", email="admin@example.com")
+    org = create_organization(database, name="Admin-Org", country="US")
+    add_user_to_organization(database, admin.id, org.id)
+    _, value = create_access_key(database, user_id=admin.id, organization_id=org.id)
+    monkeypatch.setattr(get_settings(), "admin_user_ids", {admin.id})
+    return {"Authorization": f"Bearer {value}"}
+
+
+def test_search_users(database, monkeypatch):
+    headers = _admin_headers(database, monkeypatch)
+    for username in ["alice", "Alina", "alfred"]:
+        create_user(database, username=username, email=f"{username.lower()}@example.com")
+
+    response = client.get("/api/v1/users/search", headers=headers,
+                          params={"q": "al", "limit": 2})
+    assert response.status_code == 200
+    assert [user["username"] for user in response.json()["users"]] == ["alfred", "alice"]
+    assert set(response.json()["users"][0]) == {"id", "username", "email"}
+
+    response = client.get("/api/v1/users/search", headers=headers, params={
+        "q": "al", "limit": 2, "cursor": response.json()["next_cursor"]})
+    assert [user["username"] for user in response.json()["users"]] == ["Alina"]
+    assert response.json()["next_cursor"] is None
+
+    response = client.get("/api/v1/users/search", headers=headers,
+                          params={"q": "ADMIN@", "by": "email"})
+    assert [user["username"] for user in response.json()["users"]] == ["admin"]
+
+
+def test_search_users_invalid(database, monkeypatch):
+    headers = _admin_headers(database, monkeypatch)
+
+    assert client.get("/api/v1/users/search", headers=headers,
+                      params={"q": "al", "by": "company"}).status_code == 422
+    assert client.get("/api/v1/users/search", headers=headers,
+                      params={"q": "al", "cursor": "not-a-cursor"}).status_code == 422
+    assert client.get("/api/v1/users/search", headers=headers,
+                      params={"q": " "}).status_code == 422
+
+
+def test_search_users_requires_admin(database, monkeypatch):
+    headers = _admin_headers(database, monkeypatch)
+    monkeypatch.setattr(get_settings(), "admin_user_ids", set())
+
+    assert client.get("/api/v1/users/search", params={"q": "al"}).status_code == 401
+    response = client.get("/api/v1/users/search", headers=headers, params={"q": "al"})
+    assert response.status_code == 403
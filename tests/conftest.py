@@ -5,8 +5,16 @@ import os
 from dotenv import load_dotenv, find_dotenv
 import pytest
 from webapp.model import Database, Base
+from webapp.model.id_allocator import user_ids, organization_ids
+from webapp.controller import get_cache
+from webapp.http_clients import reset_service_clients
+from webapp.settings import get_settings
+from tests.stub_server import StubServer
 
 load_dotenv(find_dotenv(), override=True)
+# TestClient runs every request in a new event loop, and asyncpg connections are bound to
+# the loop that opened them, so the app must not pool them across requests.
+os.environ.setdefault('DATABASE_POOL_PROFILE', 'serverless')
 
 
 @pytest.fixture(scope="function", name="database")
@@ -15,3 +23,30 @@ def fixture_database():
     with db.get_session() as session:
         yield session
     Base.metadata.drop_all(db.engine)
+    user_ids.reset()
+    organization_ids.reset()
+    # IDs repeat across tests once the tables are dropped.
+    get_cache().clear()
+
+
+@pytest.fixture(scope="session", name="stub_server")
+def fixture_stub_server():
+    server = StubServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True, name="services")
+def fixture_services(stub_server):
+    """
+    Point the hCaptcha and SendGrid clients to the local stand-in server.
+    """
+    settings = get_settings()
+    urls = settings.hcaptcha_url, settings.sendgrid_url
+    settings.hcaptcha_url = settings.sendgrid_url = stub_server.url
+    reset_service_clients()
+    stub_server.reset()
+    yield stub_server
+    settings.hcaptcha_url, settings.sendgrid_url = urls
+    reset_service_clients()
@@ -0,0 +1,96 @@
+"""
+test_aio.py contains tests for the asynchronous controller functions in aio.py.
+"""
+import asyncio
+import os
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+from webapp.model import AsyncDatabase
+from webapp.model.database import to_async_url
+from webapp.model.id_allocator import organization_ids, user_ids
+from webapp.controller import aio
+
+
+def _run(coroutine_function):
+    async def main():
+        database = AsyncDatabase(os.environ['DATABASE_URL'], create_tables=False,
+                                 poolclass=NullPool)
+        try:
+            return await coroutine_function(database)
+        finally:
+            await database.dispose()
+    return asyncio.run(main())
+
+
+def test_to_async_url():
+    assert to_async_url("postgresql://merico@localhost/devchat") == \
+        "postgresql+asyncpg://merico@localhost/devchat"
+    assert to_async_url("postgresql+psycopg2://u:p@db:5432/x") == \
+        "postgresql+asyncpg://u:p@db:5432/x"
+
+
+def test_async_signup_and_queries(database):  # pylint: disable=W0613
+    async def scenario(database):
+        async with database.get_session() as db:
+            user = await aio.create_user(db, "testuser", "testuser@example.com")
+            org = await aio.create_organization(db, "Test-Org")
+            await aio.add_user_to_organization(db, user.id, org.id, 'owner')
+            _, value = await aio.create_access_key(db, user.id, org.id)
+
+        async with database.get_session() as db:
+            return (user, org,
+                    await aio.login_by_key(db, value),
+                    await aio.get_user_profile(db, user.id),
+                    await aio.get_organizations_of_user(db, user.id))
+
+    user, org, login_id, profile, organizations = _run(scenario)
+
+    assert login_id == user.id
+    assert profile == {"username": "testuser", "email": "testuser@example.com"}
+    assert organizations == [{"id": org.id, "name": "Test-Org", "role": "owner"}]
+
+
+def test_concurrent_async_signups(database, monkeypatch):
+    # With no block reserved yet, both signups reserve one while the other waits on it.
+    # The allocators get locks of their own, which a deadlock leaves held after the test.
+    for allocator in (user_ids, organization_ids):
+        allocator.reset()
+        monkeypatch.setattr(allocator, '_lock', threading.Lock())
+
+    async def scenario(database):
+        async def signup(name):
+            async with database.get_session() as db:
+                user, org, _, _ = await aio.create_account(db, name, f"{name}@example.com")
+                return user.id, org.id
+        return await asyncio.gather(signup("first"), signup("second"))
+
+    results = []
+    # A deadlock blocks the event loop itself, so the test waits from another thread.
+    thread = threading.Thread(target=lambda: results.extend(_run(scenario)), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    if thread.is_alive():
+        # End the stuck sessions, which would otherwise block dropping the tables.
+        database.execute(text("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                              "WHERE datname = current_database() AND pid <> pg_backend_pid()"))
+    assert not thread.is_alive()
+    ids = [entity_id for result in results for entity_id in result]
+    assert len(ids) == 4 and len(set(ids)) == 4
+
+
+def test_async_sessions_run_concurrently(database):  # pylint: disable=W0613
+    def sleep(db):
+        db.execute(text("SELECT pg_sleep(0.3)"))
+
+    async def scenario(database):
+        async def one():
+            async with database.get_session() as db:
+                await db.run_sync(sleep)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(5)])
+        return time.perf_counter() - start
+
+    assert _run(scenario) < 1.0
@@ -0,0 +1,136 @@
+"""
+test_cache.py contains tests for the entity cache in cache.py.
+"""
+import pytest
+from sqlalchemy import event
+from webapp.model import Role
+from webapp.controller import create_user, create_organization, add_user_to_organization
+from webapp.controller import assign_role_to_user, get_user_role_in_organization
+from webapp.controller import get_organizations_of_user, get_organization_id_by_name
+from webapp.controller import get_user_memberships
+from webapp.controller.cache import LocalCache, _Cache
+
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+    cache.set("c", 3)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3 and stats["misses"] == 1
+    assert stats["hit_ratio"] == 0.75
+    assert stats["memory_bytes"] > 0
+
+
+def test_cache_backends_implement_storage():
+    class PartialCache(_Cache):
+        def _get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialCache()
+
+
+def test_local_cache_expires_entries():
+    now = [0.0]
+    cache = LocalCache(ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    now[0] = 9.9
+    assert cache.get("a") == (True, 1)
+    now[0] = 10.0
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["memory_bytes"] == 0
+
+
+def test_local_cache_returns_copies():
+    cache = LocalCache()
+    cache.set("a", [{"id": 1}])
+    _, value = cache.get("a")
+    value[0]["id"] = 2
+    assert cache.get("a") == (True, [{"id": 1}])
+
+
+def test_local_cache_stores_json():
+    cache = LocalCache()
+    cache.set("a", {"role": Role.OWNER})
+    assert cache._get("a") == b'{"role":"owner"}'  # pylint: disable=protected-access
+
+
+def _count_statements(database, func):
+    statements = []
+
+    def on_execute(*_):
+        statements.append(1)
+
+    engine = database.get_bind()
+    event.listen(engine, "before_cursor_execute", on_execute)
+    try:
+        result = func()
+    finally:
+        event.remove(engine, "before_cursor_execute", on_execute)
+    return result, len(statements)
+
+
+def test_cached_role_invalidated_on_write(database):
+    org = create_organization(database, "Test-Organization")
+    other_org = create_organization(database, "Other-Organization")
+    user = create_user(database, "testuser", "testuser@example.com")
+    user_id, org_id, other_org_id = user.id, org.id, other_org.id
+    add_user_to_organization(database, user_id, org_id)
+
+    # The memberships of the user are loaded at once, then every role check is cached.
+    role, count = _count_statements(
+        database, lambda: get_user_role_in_organization(database, user_id, org_id))
+    assert role == Role.MEMBER
+    assert count == 1
+    role, count = _count_statements(
+        database, lambda: get_user_role_in_organization(database, user_id, other_org_id))
+    assert role is None
+    assert count == 0
+
+    assign_role_to_user(database, user_id, org_id, Role.OWNER)
+    assert get_user_role_in_organization(database, user_id, org_id) == Role.OWNER
+
+
+def test_cached_organizations_invalidated_on_write(database):
+    org1 = create_organization(database, "Test-Org-1")
+    org2 = create_organization(database, "Test-Org-2")
+    user = create_user(database, "testuser", "testuser@example.com")
+    user_id = user.id
+    add_user_to_organization(database, user_id, org1.id)
+
+    assert [org["id"] for org in get_organizations_of_user(database, user_id)] == [org1.id]
+    _, count = _count_statements(database, lambda: get_organizations_of_user(database, user_id))
+    assert count == 0
+
+    add_user_to_organization(database, user.id, org2.id)
+    assert {org["id"] for org in get_organizations_of_user(database, user.id)} == \
+        {org1.id, org2.id}
+
+
+def test_missing_organization_not_cached(database):
+    assert get_organization_id_by_name(database, "Test-Organization") is None
+    org_id = create_organization(database, "Test-Organization").id
+    cached_id, count = _count_statements(
+        database, lambda: get_organization_id_by_name(database, "Test-Organization"))
+    assert cached_id == org_id
+    assert count == 0
+
+
+def test_cached_values_keep_their_types(database):
+    org_id = create_organization(database, "Test-Organization").id
+    user_id = create_user(database, "testuser", "testuser@example.com").id
+    add_user_to_organization(database, user_id, org_id, Role.OWNER)
+
+    for _ in range(2):
+        assert get_user_memberships(database, user_id) == {org_id: Role.OWNER}
+        assert isinstance(get_user_memberships(database, user_id)[org_id], Role)
+        organizations = get_organizations_of_user(database, user_id)
+        assert isinstance(organizations[0]["role"], Role)
@@ -8,6 +8,7 @@ from webapp.model import User
 from webapp.controller import create_user, add_user_to_organization, assign_role_to_user
 from webapp.model import AccessKey
 from webapp.controller import create_access_key, revoke_access_key
+from webapp.controller import get_user_version, get_organization_version
 from webapp.utils import verify_access_key
 
 
@@ -224,3 +225,21 @@ def test_revoke_key_invalid_id(database):
     with pytest.raises(ValueError) as error:
         revoke_access_key(database, 999)
         assert str(error) == "Key does not exist."
+
+
+def test_versions_bumped_by_changes(database):
+    organization = create_organization(database, "Test-Organization", "USA")
+    user = create_user(database, "testuser", "testuser@example.com")
+    other = create_user(database, "otheruser", "otheruser@example.com")
+    assert get_user_version(database, user.id) == 1
+    assert get_organization_version(database, organization.id) == 1
+
+    add_user_to_organization(database, user.id, organization.id)
+    assign_role_to_user(database, user.id, organization.id, Role.OWNER)
+    key, _ = create_access_key(database, user.id, organization.id)
+    revoke_access_key(database, key.id)
+
+    assert get_user_version(database, user.id) == 5
+    assert get_organization_version(database, organization.id) == 5
+    assert get_user_version(database, other.id) == 1
+    assert get_user_version(database, 999) is None
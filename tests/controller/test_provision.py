@@ -0,0 +1,73 @@
+"""
+test_provision.py contains tests for the functions in provision.py.
+"""
+import pytest
+from webapp.model import User, AccessKey, organization_user, Role
+from webapp.controller import create_organization, create_user, add_user_to_organization
+from webapp.controller import provision_users
+from webapp.utils import verify_access_key
+
+
+def test_provision_users_success(database):
+    org = create_organization(database, "Test-Organization")
+    rows = [{"username": f"user{i}", "email": f"user{i}@example.com"} for i in range(1200)]
+    rows[0]["role"] = "owner"
+
+    results = provision_users(database, org.id, rows, create_keys=True)
+
+    assert len(results) == 1200
+    assert all(result["error"] is None and result["created"] for result in results)
+    assert len({result["user_id"] for result in results}) == 1200
+    assert database.query(User).count() == 1200
+    assert database.query(AccessKey).count() == 1200
+    assert verify_access_key(results[5]["access_key"]) == org.id
+
+    role = database.query(organization_user.c.role).filter(
+        organization_user.c.user_id == results[0]["user_id"]).scalar()
+    assert role == Role.OWNER
+
+
+def test_provision_users_reports_row_errors(database):
+    org = create_organization(database, "Test-Organization")
+    existing = create_user(database, "existinguser", "existing@example.com")
+    create_user(database, "takenuser", "taken@example.com")
+    member = create_user(database, "memberuser", "member@example.com")
+    add_user_to_organization(database, member.id, org.id)
+
+    results = provision_users(database, org.id, [
+        {"username": "gooduser", "email": "good@example.com"},
+        {"username": "bad user", "email": "bad@example.com"},
+        {"username": "baduser", "email": "not-an-email"},
+        {"username": "roleuser", "email": "role@example.com", "role": "admin"},
+        {"username": "gooduser", "email": "other@example.com"},
+        {"username": "existinguser", "email": "existing@example.com"},
+        {"username": "takenuser", "email": "someone@example.com"},
+        {"username": "newuser", "email": "taken@example.com"},
+        {"username": "memberuser", "email": "member@example.com"},
+    ])
+
+    errors = [result["error"] for result in results]
+    assert errors == [
+        None,
+        "Invalid username provided.",
+        "Invalid email provided.",
+        "Invalid role admin.",
+        "Duplicate username in the batch.",
+        None,
+        "Username already exists.",
+        "Email already exists.",
+        "User already in the organization.",
+    ]
+    assert results[0]["created"] is True
+    assert results[5]["created"] is False
+    assert results[5]["user_id"] == existing.id
+    assert results[1]["user_id"] is None
+
+    members = database.query(organization_user.c.user_id).filter(
+        organization_user.c.organization_id == org.id).all()
+    assert {row[0] for row in members} == {member.id, existing.id, results[0]["user_id"]}
+
+
+def test_provision_users_unknown_organization(database):
+    with pytest.raises(ValueError, match="Organization not found."):
+        provision_users(database, 1, [{"username": "user", "email": "user@example.com"}])
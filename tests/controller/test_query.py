@@ -2,12 +2,19 @@
 test_query.py contains tests for the query.py module.
 """
 import datetime
+import os
+import pytest
+from sqlalchemy import create_engine, event, text
 from webapp.controller import create_organization, create_user, add_user_to_organization
 from webapp.controller import get_organization_id_by_name, get_users_of_organization
 from webapp.controller import create_access_key, revoke_access_key
 from webapp.controller import get_valid_keys_of_organization, get_revoked_key_hashes
-from webapp.controller import get_user_profile, get_organizations_of_user
+from webapp.controller import get_user_profile, get_user_profiles, get_organizations_of_user
+from webapp.controller import get_members_among
+from webapp.controller import get_cache
 from webapp.controller import get_user_keys_in_organizations
+from webapp.controller import search_users, search_organizations, SearchTimeout
+from webapp.model.trigram import trigrams_installed
 from webapp.utils import now
 
 
@@ -75,6 +82,60 @@ def test_get_users_of_organization_invalid_id(database):
     assert users == []
 
 
+def test_get_users_of_organization_reuses_statements(database):
+    organization = create_organization(database, "Test-Organization", "USA")
+    statements = []
+
+    def listener(*args):
+        statements.append(args[1])
+
+    event.listen(database.bind, "before_execute", listener)
+    try:
+        get_users_of_organization(database, organization.id, columns=['id', 'company'])
+        get_users_of_organization(database, organization.id + 1,
+                                  columns=['id', 'company', 'id'])
+    finally:
+        event.remove(database.bind, "before_execute", listener)
+
+    assert len(statements) == 2
+    assert statements[0] is statements[1]
+
+
+def test_get_users_of_organization_unknown_column(database):
+    with pytest.raises(ValueError):
+        get_users_of_organization(database, 1, columns=['id', 'password'])
+
+
+def test_get_users_of_organization_pages(database):
+    organization = create_organization(database, "Test-Organization", "USA")
+    user_ids = sorted(create_user(database, f"testuser{i}", f"testuser{i}@example.com").id
+                      for i in range(5))
+    for user_id in user_ids:
+        add_user_to_organization(database, user_id, organization.id)
+
+    first = get_users_of_organization(database, organization.id, limit=2)
+    second = get_users_of_organization(database, organization.id, limit=2,
+                                       after_id=first[-1]["id"])
+    last = get_users_of_organization(database, organization.id, limit=2,
+                                     after_id=second[-1]["id"])
+
+    assert [user["id"] for user in first + second + last] == user_ids
+
+
+def test_get_valid_keys_of_organization_pages(database):
+    organization = create_organization(database, "Test-Organization", "USA")
+    user = create_user(database, "testuser", "testuser@example.com")
+    add_user_to_organization(database, user.id, organization.id)
+    keys = [create_access_key(database, user.id, organization.id)[0] for _ in range(3)]
+    revoke_access_key(database, keys[1].id)
+
+    first = get_valid_keys_of_organization(database, organization.id, limit=1)
+    rest = get_valid_keys_of_organization(database, organization.id, limit=5,
+                                          after_id=first[0].id)
+
+    assert [key.id for key in first + rest] == [keys[0].id, keys[2].id]
+
+
 def test_get_valid_keys_of_organization_success(database):
     org_name = "Test-Organization"
     country_code = "USA"
@@ -150,6 +211,35 @@ def test_get_user_profile_invalid_id(database):
     assert user_profile is None
 
 
+def test_get_user_profiles(database):
+    first = create_user(database, "testuser1", "testuser1@example.com")
+    second = create_user(database, "testuser2", "testuser2@example.com")
+    get_cache().clear()
+    get_user_profile(database, first.id)
+    hits = get_cache().stats()["hits"]
+
+    profiles = get_user_profiles(database, [first.id, second.id, first.id, 999])
+    assert profiles == {first.id: {"username": "testuser1", "email": "testuser1@example.com"},
+                        second.id: {"username": "testuser2", "email": "testuser2@example.com"}}
+    assert get_cache().stats()["hits"] == hits + 1
+    assert get_user_profiles(database, []) == {}
+
+
+def test_get_members_among(database):
+    users = [create_user(database, f"testuser{i}", f"testuser{i}@example.com") for i in range(3)]
+    first = create_organization(database, "First-Organization", "USA")
+    second = create_organization(database, "Second-Organization", "USA")
+    add_user_to_organization(database, users[0].id, first.id)
+    add_user_to_organization(database, users[0].id, second.id)
+    add_user_to_organization(database, users[1].id, second.id)
+    user_ids = [user.id for user in users]
+
+    assert get_members_among(database, [first.id, second.id], user_ids) == \
+        {users[0].id, users[1].id}
+    assert get_members_among(database, [first.id], user_ids) == {users[0].id}
+    assert get_members_among(database, [], user_ids) == set()
+
+
 def test_get_organizations_of_user_success(database):
     org_name1 = "Test-Organization1"
     org_name2 = "Test-Organization2"
@@ -231,3 +321,122 @@ def test_get_user_keys_in_organizations(database):
         in user_keys_custom[organization1.id]
     assert {"name": None, "id": key2.id, "thumbnail": key2.thumbnail} \
         in user_keys_custom[organization2.id]
+
+    # Columns the caller passes are left untouched
+    columns = ["id"]
+    get_user_keys_in_organizations(database, user.id, [organization1.id], columns=columns,
+                                   limit_per_organization=1)
+    assert columns == ["id"]
+
+    with pytest.raises(ValueError):
+        get_user_keys_in_organizations(database, user.id, [organization1.id],
+                                       columns=["key_hash"])
+
+
+def test_get_user_keys_pages(database):
+    user = create_user(database, "testuser", "testuser@example.com")
+    organizations = [create_organization(database, f"Test-Organization{i}", "USA")
+                     for i in range(2)]
+    keys = {}
+    for organization in organizations:
+        add_user_to_organization(database, user.id, organization.id)
+        keys[organization.id] = [create_access_key(database, user.id, organization.id)[0].id
+                                 for _ in range(3)]
+    user_id, org_id, other_id = user.id, organizations[0].id, organizations[1].id
+
+    statements = []
+
+    def listener(*args):
+        statements.append(args[2])
+
+    event.listen(database.bind, "before_cursor_execute", listener)
+    try:
+        page = get_user_keys_in_organizations(database, user_id, [org_id], columns=["id"],
+                                              limit_per_organization=2,
+                                              after_id=keys[org_id][0])
+        overview = get_user_keys_in_organizations(database, user_id, [org_id, other_id],
+                                                  columns=["id"], limit_per_organization=2)
+    finally:
+        event.remove(database.bind, "before_cursor_execute", listener)
+
+    assert page == {org_id: [{"id": key_id} for key_id in keys[org_id][1:]]}
+    assert overview == {org_id: [{"id": key_id} for key_id in keys[org_id][:2]],
+                        other_id: [{"id": key_id} for key_id in keys[other_id][:2]]}
+    # A single organization is read by the index up to the limit, without ranking its keys.
+    assert "row_number" not in statements[0] and "LIMIT" in statements[0]
+    assert "row_number" in statements[1]
+
+
+def _create_users(database):
+    for username, email in [("alice", "zed@example.com"), ("Alina", "alina@example.com"),
+                            ("al_x", "x@example.com"), ("bob", "bob@alice.com")]:
+        create_user(database, username, email)
+
+
+def test_search_users_by_prefix(database):
+    _create_users(database)
+
+    users = search_users(database, "AL")
+    assert [user["username"] for user in users] == ["al_x", "alice", "Alina"]
+    assert users[2]["sort_key"] == "alina"
+    assert search_users(database, "al_")[0]["username"] == "al_x"
+    assert search_users(database, "al%") == []
+    assert search_users(database, "älice") == []
+    assert [user["username"] for user in search_users(database, "x@", by="email")] == ["al_x"]
+
+
+def test_search_users_pages(database):
+    _create_users(database)
+
+    first = search_users(database, "al", limit=2)
+    assert [user["username"] for user in first] == ["al_x", "alice"]
+    second = search_users(database, "al", limit=2,
+                          after=(first[-1]["sort_key"], first[-1]["id"]))
+    assert [user["username"] for user in second] == ["Alina"]
+
+
+def test_search_users_invalid(database):
+    with pytest.raises(ValueError):
+        search_users(database, "al", by="company")
+    with pytest.raises(ValueError):
+        search_users(database, "  ")
+    with pytest.raises(ValueError):
+        search_users(database, "al\x00")
+    with pytest.raises(ValueError):
+        search_users(database, "al", after=(0.5, 1))
+
+
+def test_search_organizations(database):
+    for name in ["Dev-Team", "devops", "Marketing"]:
+        create_organization(database, name)
+
+    organizations = search_organizations(database, "dev")
+    assert [org["name"] for org in organizations] == ["Dev-Team", "devops"]
+    assert set(organizations[0]) == {"id", "name", "sort_key"}
+
+
+def test_search_fuzzy(database):
+    _create_users(database)
+
+    if not trigrams_installed(database.connection()):
+        with pytest.raises(ValueError):
+            search_users(database, "alicia", fuzzy=True)
+        return
+    users = search_users(database, "alicia", fuzzy=True)
+    assert users[0]["username"] in ("alice", "Alina")
+    with pytest.raises(ValueError):
+        search_users(database, "al", fuzzy=True)
+
+
+def test_search_timeout(database):
+    create_user(database, "alice", "alice@example.com")
+    database.commit()
+    engine = create_engine(os.environ['DATABASE_URL'])
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("LOCK TABLE users IN ACCESS EXCLUSIVE MODE"))
+            with pytest.raises(SearchTimeout):
+                search_users(database, "al", timeout=0.05)
+    finally:
+        database.rollback()
+        engine.dispose()
@@ -0,0 +1,91 @@
+"""
+test_unit_of_work.py contains tests for the functions in unit_of_work.py.
+"""
+import pytest
+from sqlalchemy import event
+from webapp.model import User, Organization, AccessKey, OutboxMessage
+from webapp.model import organization_user, Role
+from webapp.controller import UnitOfWork, create_account, create_user
+from webapp.utils import verify_access_key
+
+
+def test_create_account_success(database):
+    user, org, key, value = create_account(
+        database, "newuser", "newuser@example.com",
+        welcome_email={"from_address": "hello@devchat.ai", "from_name": "DevChat Team",
+                       "template_id": "template"})
+
+    assert database.query(User).filter(User.id == user.id).one().username == "newuser"
+    assert database.query(Organization).filter(Organization.id == org.id).one().name == "newuser"
+    role = database.query(organization_user.c.role).filter(
+        organization_user.c.user_id == user.id,
+        organization_user.c.organization_id == org.id).scalar()
+    assert role == Role.OWNER
+    assert database.query(AccessKey).filter(AccessKey.id == key.id).one().user_id == user.id
+    assert verify_access_key(value) == org.id
+
+    message = database.query(OutboxMessage).one()
+    assert message.payload["to_address"] == "newuser@example.com"
+    assert message.payload["template_data"] == {"user_name": "newuser", "access_key": value}
+
+
+def test_create_account_commits_once(database):
+    # The first account reserves the ID blocks; the next ones need no query for their IDs.
+    create_account(database, "firstuser", "firstuser@example.com")
+    commits = []
+    statements = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    def on_execute(_conn, _cursor, statement, *_):
+        statements.append(statement)
+
+    engine = database.get_bind()
+    event.listen(engine, "commit", on_commit)
+    event.listen(engine, "before_cursor_execute", on_execute)
+    try:
+        create_account(database, "newuser", "newuser@example.com", welcome_email={})
+    finally:
+        event.remove(engine, "commit", on_commit)
+        event.remove(engine, "before_cursor_execute", on_execute)
+
+    assert len(commits) == 1
+    assert [statement.split()[0] for statement in statements] == ["INSERT"] * 5, statements
+
+
+def test_create_account_existing_username(database):
+    create_user(database, "existinguser", "existing@example.com")
+
+    with pytest.raises(ValueError, match="Username already exists."):
+        create_account(database, "existinguser", "new@example.com")
+
+    # Nothing of the failed signup is left behind.
+    assert database.query(User).count() == 1
+    assert database.query(Organization).count() == 0
+    assert database.query(AccessKey).count() == 0
+
+
+def test_create_account_existing_email(database):
+    create_user(database, "existinguser", "existing@example.com")
+
+    with pytest.raises(ValueError, match="Email already exists."):
+        create_account(database, "newuser", "existing@example.com")
+
+
+def test_unit_of_work_rolls_back_on_error(database):
+    with pytest.raises(RuntimeError):
+        with UnitOfWork(database) as uow:
+            uow.create_user("newuser", "newuser@example.com")
+            raise RuntimeError()
+
+    assert database.query(User).count() == 0
+
+
+def test_unit_of_work_key_requires_membership(database):
+    with UnitOfWork(database) as uow:
+        user = uow.create_user("newuser", "newuser@example.com")
+        org = uow.create_organization("neworg")
+
+    with pytest.raises(ValueError, match="User not found in the organization"):
+        UnitOfWork(database).create_access_key(user.id, org.id)
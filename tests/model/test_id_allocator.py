@@ -0,0 +1,75 @@
+"""
+test_id_allocator.py contains tests for the ID allocator of users and organizations.
+"""
+import pytest
+from sqlalchemy import event
+from webapp.model.id_allocator import FeistelPermutation, IdAllocator, BLOCK_SIZE
+from webapp.model.id_allocator import ID_MIN, ID_SPACE
+from webapp.controller import create_user, create_organization
+
+
+def test_feistel_permutation_is_bijective():
+    permutation = FeistelPermutation(b"test-key", domain=1000)
+    values = [permutation.permute(value) for value in range(1000)]
+    assert sorted(values) == list(range(1000))
+    assert values != list(range(1000))
+
+
+def test_feistel_permutation_rejects_out_of_domain():
+    permutation = FeistelPermutation(b"test-key", domain=1000)
+    with pytest.raises(ValueError):
+        permutation.permute(1000)
+
+
+def test_feistel_permutation_depends_on_key():
+    first = FeistelPermutation(b"first-key")
+    second = FeistelPermutation(b"second-key")
+    assert [first.permute(v) for v in range(10)] != [second.permute(v) for v in range(10)]
+
+
+def test_allocate_reserves_blocks(database):
+    allocator = IdAllocator("test_entity")
+    allocator.sequence.create(database.get_bind())
+    try:
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(database.get_bind(), "before_cursor_execute", count)
+        try:
+            ids = allocator.allocate(database, BLOCK_SIZE + 5)
+            ids += [allocator.next_id(database) for _ in range(10)]
+        finally:
+            event.remove(database.get_bind(), "before_cursor_execute", count)
+
+        assert len(statements) == 1
+        assert len(set(ids)) == len(ids)
+        assert all(ID_MIN <= value < ID_MIN + ID_SPACE for value in ids)
+        assert all(len(str(value)) == 11 for value in ids)
+    finally:
+        database.rollback()
+        allocator.sequence.drop(database.get_bind())
+
+
+def test_create_entities_without_probing(database):
+    create_user(database, username="warmup", email="warmup@example.com")
+    create_organization(database, name="Warmup-Org")
+
+    statements = []
+
+    def record(*args):
+        statements.append(args[2].lstrip())
+
+    event.listen(database.get_bind(), "before_cursor_execute", record)
+    try:
+        user = create_user(database, username="testuser", email="testuser@example.com")
+        user_statements, statements[:] = list(statements), []
+        org = create_organization(database, name="Test-Org")
+    finally:
+        event.remove(database.get_bind(), "before_cursor_execute", record)
+
+    assert user.id != org.id
+    # The INSERT comes first: no SELECT probes for a free ID.
+    assert user_statements[0].startswith("INSERT INTO users")
+    assert statements[0].startswith("INSERT INTO organizations")
@@ -0,0 +1,98 @@
+"""
+test_pool.py contains tests for the connection pool profiles in pool.py.
+"""
+import asyncio
+import os
+import pytest
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from webapp.metrics import pool_stats, timed_pool_class
+from webapp.model import Database, AsyncDatabase
+from webapp.model.pool import get_pool_profile
+from webapp.settings import Settings
+
+URL = "postgresql://merico@localhost/devchat"
+
+
+def test_server_profile_options():
+    options = get_pool_profile("server").engine_options(URL)
+    assert options["poolclass"] is QueuePool
+    assert options["pool_size"] == 20
+    assert options["pool_pre_ping"] is True
+    assert options["pool_use_lifo"] is True
+    assert options["connect_args"] == {"options": "-c statement_timeout=30000",
+                                       "connect_timeout": 10}
+
+    options = get_pool_profile("server").engine_options(URL, asynchronous=True)
+    assert options["poolclass"] is AsyncAdaptedQueuePool
+    assert options["connect_args"] == {"server_settings": {"statement_timeout": "30000"},
+                                       "timeout": 10}
+
+
+def test_pgbouncer_profile_options():
+    options = get_pool_profile("pgbouncer").engine_options(URL, asynchronous=True)
+    assert options["poolclass"] is NullPool
+    assert "pool_size" not in options
+    connect_args = options["connect_args"]
+    assert "server_settings" not in connect_args
+    assert connect_args["statement_cache_size"] == 0
+    assert connect_args["prepared_statement_cache_size"] == 0
+    assert connect_args["prepared_statement_name_func"]() != \
+        connect_args["prepared_statement_name_func"]()
+
+
+def test_profile_overrides():
+    profile = get_pool_profile("server", pool_size=50, statement_timeout_ms=5000)
+    assert profile.pool_size == 50
+    assert profile.max_overflow == 10
+    assert profile.statement_timeout_ms == 5000
+    assert get_pool_profile("server").pool_size == 20
+
+    with pytest.raises(ValueError):
+        get_pool_profile("unknown")
+    # PgBouncer rejects the startup parameter carrying the timeout.
+    with pytest.raises(ValueError):
+        get_pool_profile("pgbouncer", statement_timeout_ms=5000)
+
+
+def test_settings_pool_profile():
+    assert Settings({}).database_pool_profile == "default"
+    assert Settings({"VERCEL": "1"}).database_pool_profile == "serverless"
+    settings = Settings({"DATABASE_POOL_PROFILE": "pgbouncer", "DATABASE_POOL_SIZE": "8"})
+    assert settings.database_pool_profile == "pgbouncer"
+    assert settings.database_pool_size == 8
+    assert settings.database_max_overflow is None
+
+
+def test_statement_timeout_is_set():
+    url = os.environ['DATABASE_URL']
+    options = get_pool_profile("server", statement_timeout_ms=1234).engine_options(url)
+    database = Database(url, create_tables=False, **options)
+    with database.get_session() as db:
+        assert db.execute(text("SHOW statement_timeout")).scalar_one() == "1234ms"
+    database.engine.dispose()
+
+    async def show(profile: str):
+        async_database = AsyncDatabase(url, create_tables=False, **get_pool_profile(
+            profile, statement_timeout_ms=1234).engine_options(url, asynchronous=True))
+        try:
+            async with async_database.get_session() as db:
+                return (await db.execute(text("SHOW statement_timeout"))).scalar_one()
+        finally:
+            await async_database.dispose()
+
+    assert asyncio.run(show("serverless")) == "1234ms"
+
+
+def test_pool_stats():
+    url = os.environ['DATABASE_URL']
+    database = Database(url, create_tables=False, poolclass=timed_pool_class(QueuePool),
+                        pool_size=2, max_overflow=1, pool_logging_name="test_pool")
+    with database.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        stats = pool_stats()["test_pool"]
+        assert stats["checked_out"] == 1
+        assert stats["capacity"] == 3
+        assert stats["saturation"] == pytest.approx(1 / 3)
+    assert pool_stats()["test_pool"]["checked_out"] == 0
+    database.engine.dispose()
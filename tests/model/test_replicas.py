@@ -0,0 +1,96 @@
+"""
+test_replicas.py contains tests for the routing of reads to the read replicas.
+"""
+import asyncio
+import os
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.pool import NullPool
+from webapp import dependencies
+from webapp.controller import cache, create_user, get_cache
+from webapp.main import app
+from webapp.model import Database, AsyncDatabase
+from webapp.model.replicas import ReplicaRouter
+from webapp.settings import Settings
+
+client = TestClient(app)
+
+
+def _replica_url() -> str:
+    # The test database plays its own replica, told apart by its application name.
+    return os.environ['DATABASE_URL'] + "?application_name=replica"
+
+
+def test_router_skips_lagging_replicas():
+    now = [0.0]
+    router = ReplicaRouter(3, max_lag=5, check_interval=1, clock=lambda: now[0])
+    assert router.choose() is None
+
+    assert router.due() == [0, 1, 2]
+    assert router.due() == []
+    router.record(0, 0.5)
+    router.record(1, 30.0)
+    router.record(2, 0.0)
+    assert [router.choose() for _ in range(4)] == [0, 2, 0, 2]
+
+    now[0] = 1.0
+    assert router.due() == [0, 1, 2]
+    router.record(0, None)
+    router.record(2, 6.0)
+    assert router.choose() is None
+
+
+def test_read_session_uses_replica():
+    database = Database(os.environ['DATABASE_URL'], create_tables=False,
+                        replica_urls=[_replica_url()], poolclass=NullPool)
+    with database.read_session() as db:
+        assert db.execute(text("SHOW application_name")).scalar_one() == "replica"
+    with database.read_session(primary=True) as db:
+        assert db.execute(text("SHOW application_name")).scalar_one() != "replica"
+    assert database.router.lags == [0.0]
+
+
+def test_read_session_falls_back_to_primary():
+    async def read():
+        database = AsyncDatabase(os.environ['DATABASE_URL'], create_tables=False,
+                                 replica_urls=["postgresql://nobody@localhost:1/nothing"],
+                                 poolclass=NullPool)
+        try:
+            async with database.read_session() as db:
+                return (await db.execute(text("SELECT 1"))).scalar_one(), database.router.lags
+        finally:
+            await database.dispose()
+
+    assert asyncio.run(read()) == (1, [None])
+
+
+def test_reads_pinned_to_primary_after_write(database, monkeypatch):
+    url = os.environ['DATABASE_URL']
+    settings = Settings({"DATABASE_REPLICA_URLS": url})
+    monkeypatch.setattr(cache, "get_settings", lambda: settings)
+    replica_database = AsyncDatabase(url, create_tables=False, replica_urls=[url],
+                                     poolclass=NullPool)
+    monkeypatch.setattr(dependencies, "get_async_database", lambda: replica_database)
+    replica_statements = []
+    event.listen(replica_database.replica_engines[0].sync_engine, "before_cursor_execute",
+                 lambda *args: replica_statements.append(args[2]))
+
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    assert cache.has_recent_writes([user.id])
+    assert client.get(f"/api/v1/users/{user.id}/profile").status_code == 200
+    assert not replica_statements
+
+    get_cache().clear()
+    assert client.get(f"/api/v1/users/{user.id}/profile").status_code == 200
+    assert replica_statements
+
+
+def test_replicas_need_shared_cache(monkeypatch):
+    url = os.environ['DATABASE_URL']
+    monkeypatch.setattr(dependencies, "get_settings",
+                        lambda: Settings({"DATABASE_REPLICA_URLS": url}))
+    assert not dependencies.get_replica_urls()
+
+    monkeypatch.setattr(dependencies, "get_settings", lambda: Settings({
+        "DATABASE_REPLICA_URLS": url, "CACHE_URL": "redis://localhost:6379/0"}))
+    assert dependencies.get_replica_urls() == [url]
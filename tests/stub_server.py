@@ -0,0 +1,85 @@
+"""
+stub_server.py contains a local stand-in for the hCaptcha and SendGrid APIs.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+
+class StubServer:
+    """
+    An HTTP server on a free local port answering like hCaptcha and SendGrid.
+
+    Attributes:
+        valid_tokens (set): hCaptcha tokens that verify successfully
+        emails (list): JSON bodies of the emails sent through SendGrid
+        status (dict): Status code to answer per path instead of the normal response
+        delay (float): Seconds to wait before answering
+    """
+
+    def __init__(self):
+        self.valid_tokens = {"token"}
+        self.emails = []
+        self.status = {}
+        self.delay = 0.0
+        self.requests = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        self.valid_tokens = {"token"}
+        self.emails.clear()
+        self.status.clear()
+        self.delay = 0.0
+        self.requests = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+            def _reply(self, status: int, body: dict = None):
+                data = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                stub.requests += 1
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if self.path in stub.status:
+                    self._reply(stub.status[self.path])
+                elif self.path == '/siteverify':
+                    token = parse_qs(body.decode()).get('response', [''])[0]
+                    if token in stub.valid_tokens:
+                        self._reply(200, {"success": True})
+                    else:
+                        self._reply(200, {"success": False,
+                                          "error-codes": ["invalid-input-response"]})
+                elif self.path == '/v3/mail/send':
+                    stub.emails.append(json.loads(body))
+                    self._reply(202)
+                else:
+                    self._reply(404, {"error": "not found"})
+
+        return Handler
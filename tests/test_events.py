@@ -0,0 +1,78 @@
+"""
+test_events.py contains tests for the organization events in events.py and notify.py.
+"""
+import asyncio
+import json
+import os
+from datetime import timedelta
+import pytest
+from webapp.controller import add_transactions_batch, calculate_balances, create_organization
+from webapp.events import EventHub, Subscription, event_stream
+from webapp.model import Transaction
+from webapp.utils import now
+
+
+def test_subscription_drops_oldest_events():
+    async def fill():
+        subscription = Subscription(1, max_queued=2)
+        for index in range(3):
+            subscription.put({"index": index})
+        return [await subscription.get(0.01) for _ in range(3)], subscription.dropped
+
+    events, dropped = asyncio.run(fill())
+    assert events == [{"index": 1}, {"index": 2}, None]
+    assert dropped == 1
+
+
+def test_event_stream():
+    async def stream():
+        hub = EventHub(os.environ['DATABASE_URL'])
+        subscription = hub.subscribe(1)
+        hub.dispatch(json.dumps({"organization_id": 1, "type": "usage", "cost": 0.5}))
+        hub.dispatch(json.dumps({"organization_id": 2, "type": "usage", "cost": 1.0}))
+        hub.dispatch("not json")
+        events = event_stream(hub, subscription, heartbeat=0.01)
+        try:
+            return [await events.__anext__(), await events.__anext__()], hub.subscriptions
+        finally:
+            await events.aclose()
+            await hub.stop()
+
+    (usage, keepalive), subscriptions = asyncio.run(stream())
+    assert usage == 'event: usage\ndata: {"organization_id": 1, "type": "usage", ' \
+        '"cost": 0.5}\n\n'
+    assert keepalive == ': keepalive\n\n'
+    assert not subscriptions
+
+
+def test_usage_and_balances_are_notified(database):
+    organization = create_organization(database, "Test-Organization", "USA")
+    other = create_organization(database, "Other-Organization", "USA")
+    org_id, other_id = organization.id, other.id
+    create_time = now(database) - timedelta(seconds=2)
+
+    async def listen():
+        hub = EventHub(os.environ['DATABASE_URL'], retry_delay=0.1)
+        subscription = hub.subscribe(org_id)
+        other_subscription = hub.subscribe(other_id)
+        try:
+            await asyncio.wait_for(hub.connected.wait(), 5)
+            await asyncio.to_thread(add_transactions_batch, database, [
+                Transaction(organization_id=org_id, user_id=1, prompt_tokens=10,
+                            response_tokens=20, cost=0.1, create_time=create_time),
+                Transaction(organization_id=org_id, user_id=2, prompt_tokens=5,
+                            response_tokens=5, cost=0.2, create_time=create_time)])
+            usage = await subscription.get(5)
+            await asyncio.to_thread(calculate_balances, database, [org_id])
+            balance = await subscription.get(5)
+            return usage, balance, await other_subscription.get(0.1)
+        finally:
+            await hub.stop()
+
+    usage, balance, other_event = asyncio.run(listen())
+    assert usage == {"organization_id": org_id, "type": "usage", "transactions": 2,
+                     "prompt_tokens": 15, "response_tokens": 25, "cost": pytest.approx(0.3)}
+    assert balance["type"] == "balance"
+    assert balance["balance"] == pytest.approx(-0.3)
+    assert balance["prompt_tokens"] == 15
+    assert other_event is None
@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from webapp.http_clients import CircuitBreaker, ServiceClient, ServiceUnavailableError
+from webapp.integrations import verify_hcaptcha, send_email
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_opens_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now = 10.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 20.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_service_client_fails_fast_when_open(services):
+    services.status["/siteverify"] = 500
+    client = ServiceClient("stub", services.url,
+                           breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60.0))
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(ServiceUnavailableError):
+                await client.post("/siteverify")
+        await client.aclose()
+
+    asyncio.run(scenario())
+    assert services.requests == 2
+
+
+def test_service_client_timeout(services):
+    services.delay = 0.5
+    client = ServiceClient("stub", services.url, timeout=0.1)
+
+    async def scenario():
+        with pytest.raises(ServiceUnavailableError):
+            await client.post("/siteverify")
+        await client.aclose()
+
+    asyncio.run(scenario())
+    assert client.breaker.failures == 1
+
+
+def test_verify_hcaptcha_and_send_email(services):
+    async def scenario():
+        return (await verify_hcaptcha("token"), await verify_hcaptcha("fake_token"),
+                await send_email("hello@devchat.ai", "DevChat Team", "user@example.com",
+                                 "d-template", {"user_name": "user"}))
+
+    assert asyncio.run(scenario()) == (True, False, 202)
+    assert services.emails[0]["template_id"] == "d-template"
+    assert services.emails[0]["from"] == {"email": "hello@devchat.ai", "name": "DevChat Team"}
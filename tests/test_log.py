@@ -0,0 +1,102 @@
+"""
+test_log.py contains tests for the logging pipeline in log.py.
+"""
+import json
+import logging
+import time
+from webapp.log import JSONFormatter, SamplingFilter, configure_logging, stop_logging
+from webapp.settings import Settings
+from webapp.utils import get_logger
+
+
+class _SlowHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        time.sleep(0.01)
+        self.lines.append(self.format(record))
+
+
+def _record(name: str, level: int, message: str = "message") -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 1, message, None, None)
+
+
+def test_sampling_filter():
+    sampling = SamplingFilter({"webapp.controller": 0.1, "webapp.controller.query": 0})
+
+    kept = [sampling.filter(_record("webapp.controller.transact", logging.INFO))
+            for _ in range(100)]
+    assert sum(kept) == 10
+    assert kept[0] and kept[10] and not any(kept[1:10])
+    assert not sampling.filter(_record("webapp.controller.query", logging.INFO))
+    assert sampling.filter(_record("webapp.controller.query", logging.WARNING))
+    assert sampling.filter(_record("webapp.api", logging.DEBUG))
+
+    sampling = SamplingFilter({"webapp": 0.6})
+    assert sum(sampling.filter(_record("webapp.api", logging.INFO)) for _ in range(100)) == 60
+
+
+def test_settings_log_sampling():
+    settings = Settings({"LOG_SAMPLING": "webapp.controller.transact=0.01, webapp.api=1"})
+    assert settings.log_sampling == {"webapp.controller.transact": 0.01, "webapp.api": 1.0}
+    assert settings.log_format == "text"
+    assert settings.log_level == "INFO"
+    assert Settings({"LOG_LEVEL": "debug"}).log_level == "DEBUG"
+    assert settings.log_queue is True
+    assert Settings({"VERCEL": "1"}).log_queue is False
+
+
+def test_json_formatter():
+    logger = logging.getLogger("webapp.test_log")
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger.addHandler(handler)
+    try:
+        logger.warning("Key %s revoked", "DC.abc", extra={"org_id": 42})
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            logger.exception("Failed")
+    finally:
+        logger.removeHandler(handler)
+
+    entry = json.loads(JSONFormatter().format(records[0]))
+    assert entry["level"] == "WARNING"
+    assert entry["logger"] == "webapp.test_log"
+    assert entry["message"] == "Key DC.abc revoked"
+    assert entry["org_id"] == 42
+    assert "ValueError: broken" in json.loads(JSONFormatter().format(records[1]))["exception"]
+
+
+def test_queued_logging_does_not_block():
+    handler = _SlowHandler()
+    configure_logging(Settings({"LOG_SAMPLING": "webapp.test_log.sampled=0.5",
+                                "LOG_FORMAT": "json"}), handler)
+    logger = logging.getLogger("webapp.test_log")
+    try:
+        start = time.perf_counter()
+        for i in range(20):
+            logger.info("Record %d", i)
+        elapsed = time.perf_counter() - start
+        for i in range(4):
+            logging.getLogger("webapp.test_log.sampled").info("Sampled %d", i)
+    finally:
+        stop_logging()
+        configure_logging()
+
+    assert elapsed < 0.1
+    messages = [json.loads(line)["message"] for line in handler.lines]
+    assert messages == [f"Record {i}" for i in range(20)] + ["Sampled 0", "Sampled 2"]
+
+
+def test_configure_logging_sets_level():
+    try:
+        configure_logging(Settings({"LOG_LEVEL": "WARNING"}), logging.NullHandler())
+        assert not get_logger("webapp.test_log").isEnabledFor(logging.INFO)
+    finally:
+        stop_logging()
+        configure_logging()
+    assert get_logger("webapp.test_log").isEnabledFor(logging.INFO)
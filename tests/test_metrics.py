@@ -0,0 +1,61 @@
+"""
+test_metrics.py contains tests for the metrics in metrics.py.
+"""
+from fastapi.testclient import TestClient
+from webapp.main import app
+from webapp.metrics import Counter, Histogram, DB_QUERIES_PER_REQUEST, POOL_CHECKOUT_WAIT
+from webapp.controller import create_user
+
+client = TestClient(app)
+
+
+def test_counter_render():
+    counter = Counter('test_total', "Test counter.", ('route',))
+    counter.inc(route='/a')
+    counter.inc(2, route='/a')
+    counter.inc(route='/b"')
+
+    assert counter.render() == [
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{route="/a"} 3',
+        'test_total{route="/b\\""} 1',
+    ]
+
+
+def test_histogram_render():
+    histogram = Histogram('test_seconds', "Test histogram.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.55',
+        'test_seconds_count 3',
+    ]
+
+
+def test_metrics_endpoint(database):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    route = "/api/v1/users/{user_id}/profile"
+    requests = DB_QUERIES_PER_REQUEST.count(route=route)
+    checkouts = POOL_CHECKOUT_WAIT.count()
+
+    assert client.get(f"/api/v1/users/{user.id}/profile").status_code == 200
+    assert DB_QUERIES_PER_REQUEST.count(route=route) == requests + 1
+    assert POOL_CHECKOUT_WAIT.count() > checkouts
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert f'http_requests_total{{method="GET",route="{route}",status="200"}}' in text
+    assert f'http_request_duration_seconds_count{{method="GET",route="{route}"}}' in text
+    assert f'db_queries_total{{route="{route}"}}' in text
+    # The scrape itself is in flight while it renders the metrics.
+    assert f'http_requests_in_flight{{method="GET",route="{route}"}} 0' in text
+    assert 'http_requests_in_flight{method="GET",route="/metrics"} 1' in text
+    assert 'entity_cache{stat="hit_ratio"}' in text
@@ -0,0 +1,63 @@
+"""
+test_profiler.py contains tests for the SQL profiler in profiler.py.
+"""
+import logging
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from webapp.main import app
+from webapp.profiler import RequestProfile, install_profiler_hooks, normalize
+from webapp.profiler import _profile  # pylint: disable=protected-access
+from webapp.settings import get_settings
+from webapp.controller import create_user
+
+client = TestClient(app)
+
+
+def test_normalize():
+    assert normalize("SELECT users.id FROM users\n  WHERE users.username = 'o''neil' "
+                     "AND users.id IN (%(id_1_1)s, %(id_1_2)s) LIMIT 10") == \
+        "SELECT users.id FROM users WHERE users.username = ? AND users.id IN (?, ...) LIMIT ?"
+    assert normalize("SELECT * FROM users WHERE id = $1") == "SELECT * FROM users WHERE id = ?"
+
+
+def test_profiler_disabled(database):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    response = client.get(f"/api/v1/users/{user.id}/profile")
+    assert "server-timing" not in response.headers
+
+
+def test_profiler_header_and_slow_log(database, monkeypatch, caplog):
+    user = create_user(database, username="testuser", email="testuser@example.com")
+    settings = get_settings()
+    monkeypatch.setattr(settings, "sql_profiler", True)
+    monkeypatch.setattr(settings, "slow_request_ms", 0)
+    monkeypatch.setattr(settings, "explain_query_ms", 0)
+
+    with caplog.at_level(logging.WARNING, logger="webapp.profiler"):
+        response = client.get(f"/api/v1/users/{user.id}/profile")
+
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("db;dur=")
+    assert 'desc="1 queries"' in response.headers["server-timing"]
+    message = caplog.records[-1].getMessage()
+    assert "Slow request GET" in message
+    assert "FROM users WHERE users.id = ?" in message
+    assert "Buffers" in message or "Planning" in message
+
+
+def test_failed_explain_keeps_transaction(database, caplog):
+    # The statement succeeds once and divides by zero when explained.
+    database.execute(text("CREATE TEMPORARY SEQUENCE explained"))
+    install_profiler_hooks()
+    profile = RequestProfile(explain_threshold=0)
+    token = _profile.set(profile)
+    try:
+        with caplog.at_level(logging.WARNING, logger="webapp.profiler"):
+            assert database.execute(text(
+                "SELECT 1 / (2 - nextval('explained'))")).scalar() == 1
+    finally:
+        _profile.reset(token)
+
+    assert profile.queries[0].plan is None
+    assert "Could not explain" in caplog.records[-1].getMessage()
+    assert database.execute(text("SELECT 1")).scalar() == 1
@@ -0,0 +1,182 @@
+"""
+test_ratelimit.py contains tests for the rate limiting and load shedding in ratelimit.py.
+"""
+import asyncio
+import os
+import threading
+import time
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.pool import QueuePool
+from webapp import ratelimit
+from webapp.controller import add_user_to_organization, create_access_key
+from webapp.controller import create_organization, create_user
+from webapp.main import app
+from webapp.metrics import REQUESTS_REJECTED, pool_wait, timed_pool_class
+from webapp.model import Database
+from webapp.ratelimit import LocalBuckets, LoopLagMonitor, RateLimit, RateLimiter
+from webapp.settings import Settings, get_settings
+
+client = TestClient(app)
+
+
+def _use_limiter(monkeypatch, limiter: RateLimiter) -> RateLimiter:
+    monkeypatch.setattr(ratelimit, "get_rate_limiter", lambda: limiter)
+    return limiter
+
+
+def test_local_buckets():
+    now = [0.0]
+    buckets = LocalBuckets(max_entries=2, clock=lambda: now[0])
+    limit = RateLimit(rate=2, burst=3)
+
+    assert [buckets.take("a", limit) for _ in range(4)] == [0, 0, 0, 0.5]
+    now[0] = 1.0
+    assert buckets.take("a", limit) == 0
+    assert buckets.take("a", limit, reserve=0.5) == pytest.approx(0.75)
+
+    buckets.take("b", limit)
+    buckets.take("c", limit)
+    assert list(buckets._buckets) == ["b", "c"]  # pylint: disable=protected-access
+
+
+def test_rejection_gives_back_tokens():
+    buckets = LocalBuckets(clock=lambda: 0.0)
+    limiter = RateLimiter({"ip": RateLimit(1, 3), "key": RateLimit(1, 1)}, buckets)
+    scope = {"method": "GET", "path": "/api/v1/users/1/profile", "client": ("10.0.0.1", 1),
+             "headers": [(b"authorization", b"Bearer key")]}
+
+    assert asyncio.run(limiter.admit(scope)) == (0.0, None)
+    assert asyncio.run(limiter.admit(scope)) == (1.0, "key")
+    assert buckets._buckets["ip:10.0.0.1"][0] == 2  # pylint: disable=protected-access
+
+
+def test_settings_rate_limits():
+    settings = Settings({"RATE_LIMITS": "auth=10/m, ip=20/s:40, key=5"})
+    assert settings.rate_limits == {"auth": (10 / 60, 10.0), "ip": (20.0, 40.0),
+                                    "key": (5.0, 5.0)}
+    assert settings.shed_loop_lag == 0.25
+    assert settings.shed_pool_wait == 1.0
+    assert Settings({"VERCEL": "1"}).shed_pool_wait is None
+    assert Settings({"SHED_LOOP_LAG_MS": "0"}).shed_loop_lag is None
+
+    with pytest.raises(ValueError):
+        Settings({"RATE_LIMITS": "ip=10/d"})
+    with pytest.raises(ValueError):
+        RateLimiter({"user": RateLimit(1, 1)}, LocalBuckets())
+
+
+def test_login_rate_limited_by_ip(database, monkeypatch):  # pylint: disable=W0613
+    _use_limiter(monkeypatch, RateLimiter({"auth": RateLimit(2 / 60, 2)}, LocalBuckets(),
+                                          trust_forwarded_for=True))
+    rejected = REQUESTS_REJECTED.value(reason="auth")
+
+    responses = [client.post("/api/v1/login", json={"key": "DC.invalid"},
+                             headers={"X-Forwarded-For": "10.0.0.1"}) for _ in range(3)]
+    assert [response.status_code for response in responses] == [401, 401, 429]
+    assert responses[2].headers["Retry-After"] == "30"
+    assert REQUESTS_REJECTED.value(reason="auth") == rejected + 1
+
+    other = client.post("/api/v1/login", json={"key": "DC.invalid"},
+                        headers={"X-Forwarded-For": "10.0.0.2"})
+    assert other.status_code == 401
+    assert client.get("/api/v1/users/1/profile").status_code != 429
+
+
+def test_organization_limited_for_members_only(database, monkeypatch):
+    _use_limiter(monkeypatch, RateLimiter({"org": RateLimit(1 / 60, 2)}, LocalBuckets()))
+    user = create_user(database, username="member", email="member@example.com")
+    org = create_organization(database, name="Test-Org")
+    outsider = create_user(database, username="outsider", email="outsider@example.com")
+    other_org = create_organization(database, name="Other-Org")
+    add_user_to_organization(database, user.id, org.id)
+    add_user_to_organization(database, outsider.id, other_org.id)
+    _, value = create_access_key(database, user_id=user.id, organization_id=org.id)
+    _, other_value = create_access_key(database, user_id=outsider.id,
+                                       organization_id=other_org.id)
+    path = f"/api/v1/organizations/{org.id}/users"
+
+    # Neither anonymous clients nor outsiders drain the bucket of the organization.
+    for headers in ({}, {"Authorization": f"Bearer {other_value}"}):
+        for _ in range(3):
+            assert client.get(path, headers=headers).status_code in (401, 403)
+    responses = [client.get(path, headers={"Authorization": f"Bearer {value}"})
+                 for _ in range(3)]
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert responses[2].headers["Retry-After"] == "60"
+
+
+def test_forwarded_for_uses_last_address():
+    limiter = RateLimiter({}, LocalBuckets(), trust_forwarded_for=True)
+    scope = {"headers": [(b"x-forwarded-for", b"1.2.3.4, 10.0.0.1")], "client": ("10.0.0.9", 1)}
+    assert limiter.client_ip(scope) == "10.0.0.1"
+    assert RateLimiter({}, LocalBuckets()).client_ip(scope) == "10.0.0.9"
+
+
+def test_default_limiter_does_not_shed(monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "rate_limits", {})
+    monkeypatch.setattr(settings, "shed_loop_lag", 0.25)
+    monkeypatch.setattr(settings, "shed_pool_wait", 1.0)
+    limiter = ratelimit.get_rate_limiter.__wrapped__()
+    limiter.monitor.lag = 1.0
+
+    scope = {"method": "GET", "path": "/api/v1/users/1/profile", "headers": [],
+             "client": ("10.0.0.1", 1)}
+    assert not limiter.overloaded()
+    assert asyncio.run(limiter.admit(scope)) == (0.0, None)
+
+    monkeypatch.setattr(settings, "rate_limits", {"ip": (20.0, 40.0)})
+    limiter = ratelimit.get_rate_limiter.__wrapped__()
+    limiter.monitor.lag = 1.0
+    assert limiter.overloaded()
+
+
+def test_overload_sheds_heavy_clients_first(database, monkeypatch):  # pylint: disable=W0613
+    limiter = _use_limiter(monkeypatch, RateLimiter(
+        {"key": RateLimit(1, 4)}, LocalBuckets(), max_loop_lag=0.25))
+    heavy = {"Authorization": "Bearer heavy"}
+    light = {"Authorization": "Bearer light"}
+    for _ in range(3):
+        assert client.get("/api/v1/users/1/profile", headers=heavy).status_code != 429
+
+    limiter.monitor.lag = 1.0
+    assert client.get("/api/v1/users/1/profile", headers=heavy).status_code == 429
+    assert client.get("/api/v1/users/1/profile", headers=light).status_code != 429
+    response = client.get("/api/v1/users/1/profile")
+    assert response.status_code == 429
+    assert response.json() == {"detail": "Server overloaded. Please try again later."}
+    assert client.get("/api/v1/ping").status_code == 200
+
+    limiter.monitor.lag = 0.0
+    assert client.get("/api/v1/users/1/profile").status_code != 429
+
+
+def test_loop_lag_monitor():
+    async def block():
+        monitor = LoopLagMonitor(interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+        await asyncio.sleep(0.01)
+        lag = monitor.lag
+        await monitor.stop()
+        return lag, monitor.lag
+
+    lag, stopped_lag = asyncio.run(block())
+    assert lag >= 0.15
+    assert stopped_lag == 0
+
+
+def test_pool_wait():
+    database = Database(os.environ['DATABASE_URL'], create_tables=False,
+                        poolclass=timed_pool_class(QueuePool), pool_size=1, max_overflow=0)
+    connection = database.engine.connect()
+    waiting = threading.Thread(target=lambda: database.engine.connect().close())
+    waiting.start()
+    time.sleep(0.2)
+    assert pool_wait() >= 0.2
+    connection.close()
+    waiting.join()
+    assert pool_wait(window=0) == 0
+    database.engine.dispose()
@@ -0,0 +1,24 @@
+from webapp.model import Database
+from webapp.settings import Settings
+
+
+def test_settings_cold_start_on_vercel():
+    settings = Settings({"DATABASE_URL": "postgresql://localhost/devchat", "VERCEL": "1"})
+    assert settings.cold_start is True
+    assert settings.create_tables is False
+
+    settings = Settings({"VERCEL": "1", "DATABASE_CREATE_TABLES": "true"})
+    assert settings.cold_start is True
+    assert settings.create_tables is True
+
+
+def test_settings_defaults():
+    settings = Settings({})
+    assert settings.database_url is None
+    assert settings.cold_start is False
+    assert settings.create_tables is True
+
+
+def test_database_is_lazy():
+    db = Database("postgresql://nobody@localhost:1/nothing")
+    assert db._engine is None  # pylint: disable=protected-access
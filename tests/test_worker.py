@@ -0,0 +1,84 @@
+import asyncio
+from datetime import timedelta
+import os
+from sqlalchemy.pool import NullPool
+from webapp.controller import enqueue_message, claim_messages
+from webapp.model import AsyncDatabase, OutboxMessage, OutboxStatus
+from webapp.worker import OutboxWorker, PermanentFailure
+
+
+def _run_worker(**kwargs):
+    async def main():
+        database = AsyncDatabase(os.environ['DATABASE_URL'], create_tables=False,
+                                 poolclass=NullPool)
+        try:
+            return await OutboxWorker(database, **kwargs).run_once()
+        finally:
+            await database.dispose()
+    return asyncio.run(main())
+
+
+def _email(to_address):
+    return {"from_address": "hello@devchat.ai", "from_name": "DevChat Team",
+            "to_address": to_address, "template_id": "d-template",
+            "template_data": {"user_name": "user", "access_key": "DC.secret"}}
+
+
+def test_worker_sends_batch(database, services):
+    for i in range(5):
+        enqueue_message(database, "email", _email(f"user{i}@example.com"))
+    database.commit()
+
+    assert _run_worker(batch_size=3) == 3
+    assert _run_worker(batch_size=3) == 2
+    assert _run_worker(batch_size=3) == 0
+
+    assert len(services.emails) == 5
+    messages = database.query(OutboxMessage).all()
+    assert all(message.status == OutboxStatus.SENT for message in messages)
+    assert all(message.payload is None for message in messages)
+    assert all(message.sent_time is not None for message in messages)
+
+
+def test_worker_retries_with_backoff(database, services):
+    services.status["/v3/mail/send"] = 503
+    enqueue_message(database, "email", _email("user@example.com"))
+    database.commit()
+
+    assert _run_worker(base_delay=timedelta(seconds=30)) == 1
+    database.expire_all()
+    message = database.query(OutboxMessage).one()
+    assert message.status == OutboxStatus.PENDING
+    assert message.attempts == 1
+    assert "ServiceUnavailableError" in message.last_error
+
+    # Not due before the backoff delay
+    assert _run_worker() == 0
+
+
+def test_worker_gives_up(database, services):  # pylint: disable=W0613
+    async def reject(payload):
+        raise PermanentFailure(f"rejected {payload['n']}")
+
+    async def flaky(payload):
+        raise RuntimeError(f"flaky {payload['n']}")
+
+    enqueue_message(database, "rejected", {"n": 1})
+    enqueue_message(database, "flaky", {"n": 2})
+    enqueue_message(database, "unknown", {"n": 3})
+    database.commit()
+
+    assert _run_worker(max_attempts=1, handlers={"rejected": reject, "flaky": flaky}) == 3
+    database.expire_all()
+    messages = database.query(OutboxMessage).order_by(OutboxMessage.id).all()
+    assert [message.status for message in messages] == [OutboxStatus.FAILED] * 3
+    assert [message.payload for message in messages] == [None] * 3
+    assert "No handler" in messages[2].last_error
+
+
+def test_claim_messages_skips_claimed(database):
+    enqueue_message(database, "email", _email("user@example.com"))
+    database.commit()
+
+    assert len(claim_messages(database)) == 1
+    assert not claim_messages(database, lease=timedelta(seconds=60))
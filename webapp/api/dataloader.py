@@ -0,0 +1,90 @@
+"""
+dataloader.py contains the batching of the entity lookups of a request.
+
+A DataLoader gathers the keys loaded during one tick of the event loop, e.g. by the
+coroutines of an `asyncio.gather`, and looks them all up with a single batch call, i.e. one
+`IN (...)` query per entity type. Every key is looked up once per loader, so the loaders
+live as long as the request and read through its session.
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, \
+    TypeVar
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from webapp.controller.aio import get_user_profiles
+from webapp.dependencies import get_async_read_db
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+MAX_BATCH_SIZE = 1000
+
+
+class DataLoader(Generic[K, V]):
+    """
+    Loader of entities by key, batching the keys loaded within one event loop tick.
+
+    Args:
+        batch_load (Callable): Coroutine function getting the entities of a list of keys, \
+            by key. Keys missing from its result load as None.
+        max_batch_size (int): Maximum number of keys per batch call
+    """
+
+    def __init__(self, batch_load: Callable[[List[K]], Awaitable[Dict[K, V]]],
+                 max_batch_size: int = MAX_BATCH_SIZE):
+        self.batch_load = batch_load
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self._futures: Dict[K, asyncio.Future] = {}
+        self._queue: List[K] = []
+
+    def load(self, key: K) -> Awaitable[Optional[V]]:
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[key] = future
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # Runs after the callbacks already scheduled, e.g. the other gathered loads.
+                loop.call_soon(self._dispatch)
+        return future
+
+    def load_many(self, keys: Iterable[K]) -> Awaitable[List[Optional[V]]]:
+        # The keys are queued now rather than when the result is awaited, to join the batch.
+        return asyncio.gather(*[self.load(key) for key in keys])
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        asyncio.ensure_future(self._run(keys))
+
+    async def _run(self, keys: List[K]):
+        # The batches run one after the other, since they may share a session.
+        for start in range(0, len(keys), self.max_batch_size):
+            batch = keys[start:start + self.max_batch_size]
+            self.batches += 1
+            try:
+                values = await self.batch_load(batch)
+            except Exception as exc:
+                for key in batch:
+                    self._futures[key].set_exception(exc)
+                continue
+            for key in batch:
+                self._futures[key].set_result(values.get(key))
+
+
+class Loaders:
+    """
+    Loaders of the entities read by a request.
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.user_profiles: DataLoader[int, Dict[str, str]] = DataLoader(
+            lambda user_ids: get_user_profiles(db, user_ids))
+
+
+def get_loaders(db: AsyncSession = Depends(get_async_read_db)) -> Loaders:
+    """
+    Get the loaders of a request, reading through its read session.
+    """
+    return Loaders(db)
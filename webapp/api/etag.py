@@ -0,0 +1,34 @@
+"""
+etag.py contains helpers for conditional GET requests with ETags built from version counters.
+"""
+from typing import Optional
+from fastapi import Response
+
+
+def make_etag(kind: str, entity_id: int, version: int) -> str:
+    return f'"{kind}-{entity_id}-{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag with the weak comparison of RFC 9110.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def set_etag(response: Response, etag: str):
+    # no-cache lets clients keep the response but makes them revalidate it on every use.
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status_code=304)
+    set_etag(response, etag)
+    return response
@@ -0,0 +1,37 @@
+"""
+fast_json.py contains the response class of the fast response mode of the read endpoints.
+
+With FAST_RESPONSES enabled, read endpoints return plain dicts and lists built once from the
+query results in this response, skipping the validation of their `response_model`.
+"""
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is the fallback
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response encoding its content as is, with orjson if it is installed.
+    Datetimes are encoded in ISO 8601 and enums by value, as FastAPI does.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)  # pylint: disable=E1101
+        return json.dumps(content, default=_default, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,91 @@
+"""
+pagination.py contains helpers for keyset pagination with opaque cursors.
+"""
+import base64
+import binascii
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(f'id:{last_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    """
+    Get the ID after which the page of a cursor starts.
+
+    Raises:
+        HTTPException: 422 if the cursor was not issued by `encode_cursor`
+    """
+    if cursor is None:
+        return None
+    try:
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        prefix, last_id = text.split(':')
+        if prefix == 'id':
+            return int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        pass
+    raise HTTPException(status_code=422, detail="Invalid cursor.")
+
+
+def paginate(rows: List[Any], limit: int,
+             key: str = 'id') -> Tuple[List[Any], Optional[str]]:
+    """
+    Split rows fetched with `limit + 1` into the page and the cursor of the next page.
+
+    Returns:
+        Tuple[list, Optional[str]]: The page and the cursor, or None on the last page
+    """
+    if len(rows) <= limit:
+        return (rows, None)
+    last = rows[limit - 1]
+    last_id = last[key] if isinstance(last, dict) else getattr(last, key)
+    return (rows[:limit], encode_cursor(last_id))
+
+
+def encode_keyset_cursor(sort_key: Any, last_id: int) -> str:
+    text = 'key:' + json.dumps([sort_key, last_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def decode_keyset_cursor(cursor: Optional[str]) -> Optional[Tuple[Any, int]]:
+    """
+    Get the sort key and the ID after which the page of a cursor starts.
+
+    Raises:
+        HTTPException: 422 if the cursor was not issued by `encode_keyset_cursor`
+    """
+    if cursor is None:
+        return None
+    try:
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        prefix, _, value = text.partition(':')
+        if prefix == 'key':
+            sort_key, last_id = json.loads(value)
+            if isinstance(last_id, int):
+                return (sort_key, last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        pass
+    raise HTTPException(status_code=422, detail="Invalid cursor.")
+
+
+def paginate_keyset(rows: List[Dict[str, Any]], limit: int,
+                    key: str = 'id') -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Split rows ordered by their `sort_key` and `key`, fetched with `limit + 1`, into the page
+    and the cursor of the next page. The sort keys are removed from the rows.
+
+    Returns:
+        Tuple[list, Optional[str]]: The page and the cursor, or None on the last page
+    """
+    page = rows[:limit]
+    sort_keys = [row.pop('sort_key') for row in page]
+    if len(rows) <= limit:
+        return (page, None)
+    return (page, encode_keyset_cursor(sort_keys[-1], page[-1][key]))
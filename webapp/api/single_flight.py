@@ -0,0 +1,76 @@
+"""
+single_flight.py contains the coalescing of identical concurrent reads of the endpoints.
+
+The first request for a key runs the load and the requests arriving for the same key while
+it is in flight wait for its result instead of running their own queries. They wait at most
+SINGLE_FLIGHT_WAIT_MS, after which they load on their own. The endpoints put the version of
+the entity read in the key, so a request never gets a result loaded before a change it has
+seen.
+The shared results must not be modified by the endpoints.
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+from webapp.metrics import SINGLE_FLIGHT
+from webapp.settings import get_settings
+
+T = TypeVar('T')
+
+_flights: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+
+
+class _Abandoned(Exception):
+    """
+    The request running the load was cancelled before it finished.
+    """
+
+
+async def single_flight(name: str, key: Hashable, loader: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run a load, or share the result of the identical load in flight.
+
+    Args:
+        name (str): Name of the load, the `name` label of `single_flight_requests_total`
+        key (Hashable): Key of the load among those of the same name
+        loader (Callable): Coroutine function running the load
+
+    Returns:
+        The result of the load. Its exceptions are raised to every request sharing it.
+    """
+    wait = get_settings().single_flight_wait
+    if wait is None:
+        return await loader()
+
+    flight_key = (name, key)
+    loop = asyncio.get_running_loop()
+    future = _flights.get(flight_key)
+    if future is not None and future.get_loop() is loop:
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), wait)
+            SINGLE_FLIGHT.inc(name=name, outcome='coalesced')
+            return result
+        except asyncio.TimeoutError:
+            SINGLE_FLIGHT.inc(name=name, outcome='timeout')
+        except _Abandoned:
+            pass
+        return await loader()
+
+    future = loop.create_future()
+    _flights[flight_key] = future
+    SINGLE_FLIGHT.inc(name=name, outcome='leader')
+    try:
+        result = await loader()
+    except asyncio.CancelledError:
+        future.set_exception(_Abandoned())
+        raise
+    except Exception as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        if _flights.get(flight_key) is future:
+            del _flights[flight_key]
+        # Nobody may have been waiting for the exception.
+        if future.done() and not future.cancelled():
+            future.exception()
+    return result
@@ -0,0 +1,217 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from webapp.api.fast_json import FastJSONResponse
+from webapp.api.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, paginate
+from webapp.api.pagination import decode_keyset_cursor, paginate_keyset
+from webapp.controller.aio import provision_users
+from webapp.controller.aio import get_users_of_organization, get_valid_keys_of_organization
+from webapp.controller.aio import search_organizations
+from webapp.controller.query import MAX_SEARCH_QUERY_LENGTH, SearchTimeout
+from webapp.dependencies import Permissions, get_async_db, get_async_read_db, get_permissions
+from webapp.dependencies import get_admin_user_id
+from webapp.events import event_stream, get_event_hub
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+router = APIRouter()
+
+MAX_PROVISION_ROWS = 10000
+
+
+class ProvisionedUser(BaseModel):
+    row: int
+    username: str
+    email: str
+    role: str
+    user_id: Optional[int]
+    created: bool
+    access_key: Optional[str]
+    error: Optional[str]
+
+
+class ProvisionUsersResponse(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[ProvisionedUser]
+
+
+def _parse_rows(content_type: str, body: bytes) -> List[Dict[str, Any]]:
+    """
+    Parse a CSV with a `username,email[,role]` header, or a JSON list of objects
+    or of `[username, email, role]` lists.
+    """
+    if content_type.startswith('text/csv'):
+        reader = csv.DictReader(io.StringIO(body.decode('utf-8-sig')))
+        if not reader.fieldnames or not {'username', 'email'} <= set(reader.fieldnames):
+            raise ValueError("CSV header must contain username and email.")
+        return list(reader)
+
+    data = json.loads(body)
+    if not isinstance(data, list):
+        raise ValueError("Expected a list of users.")
+    rows = []
+    for item in data:
+        if isinstance(item, dict):
+            rows.append(item)
+        elif isinstance(item, list) and 2 <= len(item) <= 3:
+            rows.append(dict(zip(('username', 'email', 'role'), item)))
+        else:
+            raise ValueError("Each user must be an object or a [username, email, role] list.")
+    return rows
+
+
+@router.post("/organizations/{org_id}/users", response_model=ProvisionUsersResponse)
+async def provision_users_endpoint(org_id: int, request: Request, create_keys: bool = False,
+                                   permissions: Permissions = Depends(get_permissions),
+                                   db: AsyncSession = Depends(get_async_db)):
+    permissions.require_owner(org_id, "Only owners can add users.")
+
+    try:
+        rows = _parse_rows(request.headers.get('content-type', ''), await request.body())
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        raise HTTPException(status_code=422, detail=f"Invalid user list: {error}") from error
+    if len(rows) > MAX_PROVISION_ROWS:
+        raise HTTPException(status_code=413,
+                            detail=f"At most {MAX_PROVISION_ROWS} users per request.")
+
+    try:
+        results = await provision_users(db, org_id, rows, create_keys=create_keys)
+    except ValueError as error:
+        raise HTTPException(status_code=404, detail=str(error)) from error
+    except Exception as exc:
+        logger.exception("Unknown error provisioning users in organization %d: %s",
+                         org_id, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    failed = sum(1 for result in results if result['error'] is not None)
+    return ProvisionUsersResponse(succeeded=len(results) - failed, failed=failed,
+                                  results=[ProvisionedUser(**result) for result in results])
+
+
+class OrganizationUser(BaseModel):
+    id: int
+    username: str
+    email: str
+
+
+class OrganizationUsersResponse(BaseModel):
+    users: List[OrganizationUser]
+    next_cursor: Optional[str]
+
+
+@router.get("/organizations/{org_id}/users", response_model=OrganizationUsersResponse)
+async def get_organization_users_endpoint(
+        org_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None, permissions: Permissions = Depends(get_permissions),
+        db: AsyncSession = Depends(get_async_read_db)):
+    permissions.require_member(org_id, "Only members can list users.")
+    after_id = decode_cursor(cursor)
+
+    try:
+        users = await get_users_of_organization(db, org_id, limit=limit + 1, after_id=after_id)
+    except Exception as exc:
+        logger.exception("Unknown error listing users of organization %d: %s", org_id, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    users, next_cursor = paginate(users, limit)
+    if get_settings().fast_responses:
+        return FastJSONResponse({"users": users, "next_cursor": next_cursor})
+    return OrganizationUsersResponse(users=users, next_cursor=next_cursor)
+
+
+class OrganizationKey(BaseModel):
+    id: int
+    user_id: int
+    name: Optional[str]
+    thumbnail: str
+    create_time: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class OrganizationKeysResponse(BaseModel):
+    keys: List[OrganizationKey]
+    next_cursor: Optional[str]
+
+
+@router.get("/organizations/{org_id}/keys", response_model=OrganizationKeysResponse)
+async def get_organization_keys_endpoint(
+        org_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None, permissions: Permissions = Depends(get_permissions),
+        db: AsyncSession = Depends(get_async_read_db)):
+    permissions.require_owner(org_id, "Only owners can list keys.")
+    after_id = decode_cursor(cursor)
+
+    try:
+        keys = await get_valid_keys_of_organization(db, org_id, limit=limit + 1,
+                                                    after_id=after_id)
+    except Exception as exc:
+        logger.exception("Unknown error listing keys of organization %d: %s", org_id, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    keys, next_cursor = paginate(keys, limit)
+    if get_settings().fast_responses:
+        return FastJSONResponse({
+            "keys": [{"id": key.id, "user_id": key.user_id, "name": key.name,
+                      "thumbnail": key.thumbnail, "create_time": key.create_time}
+                     for key in keys],
+            "next_cursor": next_cursor})
+    return OrganizationKeysResponse(keys=[OrganizationKey.from_orm(key) for key in keys],
+                                    next_cursor=next_cursor)
+
+
+@router.get("/organizations/{org_id}/events")
+async def get_organization_events_endpoint(org_id: int,
+                                           permissions: Permissions = Depends(get_permissions)):
+    # Usage and balance changes of the organization, as Server-Sent Events.
+    permissions.require_member(org_id, "Only members can follow events.")
+    hub = get_event_hub()
+    subscription = hub.subscribe(org_id)
+    return StreamingResponse(event_stream(hub, subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class OrganizationSearchItem(BaseModel):
+    id: int
+    name: str
+
+
+class OrganizationSearchResponse(BaseModel):
+    organizations: List[OrganizationSearchItem]
+    next_cursor: Optional[str]
+
+
+@router.get("/organizations/search", response_model=OrganizationSearchResponse)
+async def search_organizations_endpoint(
+        q: str = Query(..., max_length=MAX_SEARCH_QUERY_LENGTH), fuzzy: bool = False,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None, _: int = Depends(get_admin_user_id),
+        db: AsyncSession = Depends(get_async_read_db)):
+    after = decode_keyset_cursor(cursor)
+    try:
+        organizations = await search_organizations(
+            db, q, fuzzy=fuzzy, limit=limit + 1, after=after,
+            timeout=get_settings().search_timeout)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    except SearchTimeout as error:
+        raise HTTPException(status_code=503,
+                            detail="Search timed out. Please refine the query.") from error
+    except Exception as exc:
+        logger.exception("Unknown error searching organizations: %s", str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    organizations, next_cursor = paginate_keyset(organizations, limit)
+    if get_settings().fast_responses:
+        return FastJSONResponse({"organizations": organizations, "next_cursor": next_cursor})
+    return OrganizationSearchResponse(organizations=organizations, next_cursor=next_cursor)
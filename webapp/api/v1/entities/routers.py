@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 from .users import router as users_router
+from .organizations import router as organizations_router
 
 router = APIRouter()
 
 router.include_router(users_router)
+router.include_router(organizations_router)
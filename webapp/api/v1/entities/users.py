@@ -1,15 +1,25 @@
-import os
-from typing import Any, Dict, List
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from webapp.controller import create_user, create_organization, add_user_to_organization
-from webapp.controller import create_access_key
-from webapp.controller.query import login_by_key, get_user_profile
-from webapp.controller.query import get_organizations_of_user, get_user_keys_in_organizations
-from webapp.dependencies import get_db
-from webapp.utils import send_email, verify_hcaptcha, get_logger
+from webapp.api.dataloader import Loaders, get_loaders
+from webapp.api.etag import make_etag, etag_matches, set_etag, not_modified
+from webapp.api.fast_json import FastJSONResponse
+from webapp.api.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, paginate
+from webapp.api.pagination import decode_keyset_cursor, paginate_keyset
+from webapp.api.single_flight import single_flight
+from webapp.controller.aio import create_account
+from webapp.controller.aio import login_by_key, get_user_profile
+from webapp.controller.aio import get_organizations_of_user, get_user_keys_in_organizations
+from webapp.controller.aio import get_user_version, search_users, get_members_among
+from webapp.controller.query import MAX_SEARCH_QUERY_LENGTH, SearchTimeout
+from webapp.dependencies import Permissions, get_admin_user_id, get_async_db, get_async_read_db
+from webapp.dependencies import get_permissions
+from webapp.http_clients import ServiceUnavailableError
+from webapp.settings import get_settings
+from webapp.integrations import verify_hcaptcha
+from webapp.utils import get_logger
 
 logger = get_logger(__name__)
 router = APIRouter()
@@ -26,33 +36,33 @@ class CreateUserResponse(BaseModel):
 
 
 @router.post("/users", response_model=CreateUserResponse, status_code=201)
-async def create_user_endpoint(user_req: CreateUserRequest, db: Session = Depends(get_db)):
-    if not verify_hcaptcha(user_req.token):
+async def create_user_endpoint(user_req: CreateUserRequest,
+                               db: AsyncSession = Depends(get_async_db)):
+    try:
+        verified = await verify_hcaptcha(user_req.token)
+    except ServiceUnavailableError as error:
+        raise HTTPException(status_code=503,
+                            detail="Captcha service unavailable. Please try again later.") \
+            from error
+    if not verified:
         raise HTTPException(status_code=401,
                             detail="Invalid hCaptcha token. Please refresh the page and try again.")
-    template_id = os.getenv("SENDGRID_TEMPLATE_ID")
+    template_id = get_settings().sendgrid_template_id
     if not template_id:
         logger.error("SENDGRID_TEMPLATE_ID environment variable is not set")
         raise HTTPException(status_code=500,
                             detail="Email server error. Please contact hello@devchat.ai.")
     try:
-        user = create_user(db, user_req.username, user_req.email)
-        org = create_organization(db, user.username)
-        add_user_to_organization(db, user.id, org.id, 'owner')
-        _, value = create_access_key(db, user.id, org.id)
-        status = send_email(from_address="hello@devchat.ai", from_name="DevChat Team",
-                            to_address=user.email,
-                            template_id=template_id,
-                            template_data={"user_name": user.username, "access_key": value})
+        # The welcome email is sent by the outbox worker once the account is committed.
+        user, _, _, _ = await create_account(db, user_req.username, user_req.email, welcome_email={
+            "from_address": "hello@devchat.ai", "from_name": "DevChat Team",
+            "template_id": template_id})
     except ValueError as error:
         raise HTTPException(status_code=422, detail=str(error)) from error
     except Exception as exc:
         logger.exception("Unknown error creating user %s: %s", user_req.username, str(exc))
         raise HTTPException(status_code=500, detail="Unknown server error.") from exc
 
-    if status != 202:
-        raise HTTPException(status_code=status, detail="Failed to send email.")
-
     return CreateUserResponse(user_id=user.id)
 
 
@@ -66,9 +76,9 @@ class LoginResponse(BaseModel):
 
 
 @router.post("/login", response_model=LoginResponse)
-async def login_endpoint(request: LoginRequest, db: Session = Depends(get_db)):
+async def login_endpoint(request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     try:
-        user_id = login_by_key(db, request.key)
+        user_id = await login_by_key(db, request.key)
     except Exception as exc:
         logger.exception("Unknown login error: %s", str(exc))
         raise HTTPException(status_code=500, detail="Unknown server error.") from exc
@@ -83,37 +93,192 @@ class UserProfileResponse(BaseModel):
 
 
 @router.get("/users/{user_id}/profile", response_model=UserProfileResponse)
-async def get_user_profile_endpoint(user_id: int, db: Session = Depends(get_db)):
+async def get_user_profile_endpoint(user_id: int, response: Response,
+                                    if_none_match: Optional[str] = Header(None),
+                                    db: AsyncSession = Depends(get_async_read_db)):
     try:
-        user_profile = get_user_profile(db, user_id)
+        version = await get_user_version(db, user_id)
+        etag = make_etag("user", user_id, version)
+        if version is not None and etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        user_profile = await single_flight(
+            "user_profile", (user_id, version),
+            lambda: get_user_profile(db, user_id)) if version is not None else None
     except Exception as exc:
         logger.exception("Unknown error getting profile of user %d: %s", user_id, str(exc))
         raise HTTPException(status_code=500, detail="Unknown server error.") from exc
     if user_profile is None:
         raise HTTPException(status_code=404, detail="User not found.")
+    set_etag(response, etag)
     return UserProfileResponse(**user_profile)
 
 
+class UserProfileItem(BaseModel):
+    user_id: int
+    username: str
+    email: str
+
+
+class UserProfilesResponse(BaseModel):
+    profiles: List[UserProfileItem]
+
+
+def parse_ids(ids: str) -> List[int]:
+    """
+    Parse a comma-separated list of IDs, without duplicates.
+
+    Raises:
+        HTTPException: 422 if an ID is not an integer or there are more than MAX_PAGE_SIZE
+    """
+    try:
+        parsed = list(dict.fromkeys(int(value) for value in ids.split(',') if value.strip()))
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail="Invalid user ID.") from error
+    if len(parsed) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=422,
+                            detail=f"At most {MAX_PAGE_SIZE} users can be read at once.")
+    return parsed
+
+
+@router.get("/users/profiles", response_model=UserProfilesResponse)
+async def get_user_profiles_endpoint(ids: str = Query(..., description="Comma-separated user IDs"),
+                                     permissions: Permissions = Depends(get_permissions),
+                                     db: AsyncSession = Depends(get_async_read_db),
+                                     loaders: Loaders = Depends(get_loaders)):
+    user_ids = parse_ids(ids)
+    try:
+        # Only the caller and the members of the caller's organizations are visible.
+        visible = await get_members_among(db, permissions.roles, user_ids)
+        visible.add(permissions.user_id)
+        user_ids = [user_id for user_id in user_ids if user_id in visible]
+        profiles = await loaders.user_profiles.load_many(user_ids)
+    except Exception as exc:
+        logger.exception("Unknown error getting profiles of users %s: %s", ids, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+    # Unknown and invisible users are left out, in the order of the request.
+    items = [{"user_id": user_id, **profile}
+             for user_id, profile in zip(user_ids, profiles) if profile is not None]
+    if get_settings().fast_responses:
+        return FastJSONResponse({"profiles": items})
+    return UserProfilesResponse(profiles=[UserProfileItem(**item) for item in items])
+
+
+class UserSearchItem(BaseModel):
+    id: int
+    username: str
+    email: str
+
+
+class UserSearchResponse(BaseModel):
+    users: List[UserSearchItem]
+    next_cursor: Optional[str]
+
+
+@router.get("/users/search", response_model=UserSearchResponse)
+async def search_users_endpoint(q: str = Query(..., max_length=MAX_SEARCH_QUERY_LENGTH),
+                                by: str = Query('username', regex='^(username|email)$'),
+                                fuzzy: bool = False,
+                                limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                cursor: Optional[str] = None,
+                                _: int = Depends(get_admin_user_id),
+                                db: AsyncSession = Depends(get_async_read_db)):
+    after = decode_keyset_cursor(cursor)
+    try:
+        users = await search_users(db, q, by=by, fuzzy=fuzzy, limit=limit + 1, after=after,
+                                   timeout=get_settings().search_timeout)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    except SearchTimeout as error:
+        raise HTTPException(status_code=503,
+                            detail="Search timed out. Please refine the query.") from error
+    except Exception as exc:
+        logger.exception("Unknown error searching users by %s: %s", by, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    users, next_cursor = paginate_keyset(users, limit)
+    if get_settings().fast_responses:
+        return FastJSONResponse({"users": users, "next_cursor": next_cursor})
+    return UserSearchResponse(users=users, next_cursor=next_cursor)
+
+
+KEYS_PER_ORGANIZATION = 100
+
+
 class OrganizationResponse(BaseModel):
     org_id: int
     org_name: str
     role: str
     keys: List[Dict[str, Any]]
+    # Set if the organization has more keys of the user than embedded in `keys`.
+    keys_next_cursor: Optional[str]
+
+
+def organization_rows(organizations: List[Dict[str, Any]],
+                      org_keys: Dict[int, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Build the items of the organizations endpoint from the query results.
+    """
+    rows = []
+    for org in organizations:
+        keys, keys_next_cursor = paginate(org_keys.get(org["id"], []), KEYS_PER_ORGANIZATION)
+        rows.append({"org_id": org["id"], "org_name": org["name"], "role": org["role"],
+                     "keys": keys, "keys_next_cursor": keys_next_cursor})
+    return rows
 
 
 @router.get("/users/{user_id}/organizations", response_model=list[OrganizationResponse])
-async def get_user_organizations_endpoint(user_id: int, db: Session = Depends(get_db)):
+async def get_user_organizations_endpoint(user_id: int, response: Response,
+                                          if_none_match: Optional[str] = Header(None),
+                                          db: AsyncSession = Depends(get_async_read_db)):
     try:
-        organizations = get_organizations_of_user(db, user_id)
-        org_ids = [org["id"] for org in organizations]
-        org_keys = get_user_keys_in_organizations(db, user_id, org_ids)
-
-        for org in organizations:
-            org["org_id"] = org.pop("id")
-            org["org_name"] = org.pop("name")
-            org["keys"] = org_keys.get(org["org_id"], [])
+        # The version is read first, so a change racing with the joins only causes a refetch.
+        version = await get_user_version(db, user_id)
+        if version is None:
+            return []
+        etag = make_etag("user", user_id, version)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+        async def load():
+            organizations = await get_organizations_of_user(db, user_id)
+            org_ids = [org["id"] for org in organizations]
+            org_keys = await get_user_keys_in_organizations(
+                db, user_id, org_ids, limit_per_organization=KEYS_PER_ORGANIZATION + 1)
+            return organization_rows(organizations, org_keys)
+
+        # Concurrent requests for the same version share the joins of the first one.
+        rows = await single_flight("user_organizations", (user_id, version), load)
     except Exception as exc:
         logger.exception("Unknown error getting organizations of user %d: %s", user_id, str(exc))
         raise HTTPException(status_code=500, detail="Unknown server error.") from exc
 
-    return [OrganizationResponse(**org) for org in organizations]
+    if get_settings().fast_responses:
+        fast_response = FastJSONResponse(rows)
+        set_etag(fast_response, etag)
+        return fast_response
+    set_etag(response, etag)
+    return [OrganizationResponse(**org) for org in rows]
+
+
+class UserKeysResponse(BaseModel):
+    keys: List[Dict[str, Any]]
+    next_cursor: Optional[str]
+
+
+@router.get("/users/{user_id}/organizations/{org_id}/keys", response_model=UserKeysResponse)
+async def get_user_keys_endpoint(user_id: int, org_id: int,
+                                 limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                 cursor: Optional[str] = None,
+                                 db: AsyncSession = Depends(get_async_read_db)):
+    after_id = decode_cursor(cursor)
+    try:
+        org_keys = await get_user_keys_in_organizations(
+            db, user_id, [org_id], limit_per_organization=limit + 1, after_id=after_id)
+    except Exception as exc:
+        logger.exception("Unknown error getting keys of user %d: %s", user_id, str(exc))
+        raise HTTPException(status_code=500, detail="Unknown server error.") from exc
+
+    keys, next_cursor = paginate(org_keys.get(org_id, []), limit)
+    if get_settings().fast_responses:
+        return FastJSONResponse({"keys": keys, "next_cursor": next_cursor})
+    return UserKeysResponse(keys=keys, next_cursor=next_cursor)
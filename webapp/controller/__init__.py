@@ -1,29 +1,55 @@
+from .cache import get_cache
 from .manage import create_organization, create_user, add_user_to_organization, assign_role_to_user
-from .manage import create_access_key, revoke_access_key
+from .manage import create_access_key, revoke_access_key, bump_versions
+from .outbox import enqueue_message, claim_messages, complete_messages, fail_message
+from .provision import provision_users
 from .query import get_organization_id_by_name
-from .query import get_users_of_organization
+from .query import get_users_of_organization, get_user_role_in_organization
+from .query import get_user_memberships, get_members_among
 from .query import get_valid_keys_of_organization
 from .query import get_revoked_key_hashes
-from .query import login_by_key, get_user_profile
+from .query import login_by_key, get_user_id_by_valid_key, get_user_profile, get_user_profiles
 from .query import get_organizations_of_user
 from .query import get_user_keys_in_organizations
+from .query import get_user_version, get_organization_version
+from .query import search_users, search_organizations, SearchTimeout
 from .transact import add_transactions_batch, calculate_balances
+from .unit_of_work import UnitOfWork, create_account
 
 __all__ = [
+    "get_cache",
     "create_organization",
     "create_user",
     "add_user_to_organization",
     "assign_role_to_user",
     "create_access_key",
     "revoke_access_key",
+    "bump_versions",
+    "enqueue_message",
+    "claim_messages",
+    "complete_messages",
+    "fail_message",
+    "provision_users",
     "get_organization_id_by_name",
     "get_users_of_organization",
+    "get_user_role_in_organization",
+    "get_user_memberships",
+    "get_members_among",
     "get_valid_keys_of_organization",
     "get_revoked_key_hashes",
     "add_transactions_batch",
     "calculate_balances",
+    "UnitOfWork",
+    "create_account",
     "login_by_key",
+    "get_user_id_by_valid_key",
     "get_user_profile",
+    "get_user_profiles",
     "get_organizations_of_user",
     "get_user_keys_in_organizations",
+    "get_user_version",
+    "get_organization_version",
+    "search_users",
+    "search_organizations",
+    "SearchTimeout",
 ]
@@ -0,0 +1,57 @@
+"""
+aio.py contains the asynchronous versions of the controller functions.
+
+Each function runs its synchronous counterpart through `AsyncSession.run_sync`, so the
+queries go through asyncpg without blocking the event loop while the SQL logic stays in
+manage.py, outbox.py, provision.py, query.py, transact.py and unit_of_work.py.
+"""
+import functools
+from typing import Any, Awaitable, Callable
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import manage, outbox, provision, query, transact, unit_of_work
+
+
+def _asynchronous(func: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(func)
+    async def wrapper(db: AsyncSession, *args, **kwargs):
+        return await db.run_sync(func, *args, **kwargs)
+    return wrapper
+
+
+create_organization = _asynchronous(manage.create_organization)
+create_user = _asynchronous(manage.create_user)
+add_user_to_organization = _asynchronous(manage.add_user_to_organization)
+assign_role_to_user = _asynchronous(manage.assign_role_to_user)
+create_access_key = _asynchronous(manage.create_access_key)
+revoke_access_key = _asynchronous(manage.revoke_access_key)
+bump_versions = _asynchronous(manage.bump_versions)
+
+enqueue_message = _asynchronous(outbox.enqueue_message)
+claim_messages = _asynchronous(outbox.claim_messages)
+complete_messages = _asynchronous(outbox.complete_messages)
+fail_message = _asynchronous(outbox.fail_message)
+
+provision_users = _asynchronous(provision.provision_users)
+
+get_organization_id_by_name = _asynchronous(query.get_organization_id_by_name)
+get_user_memberships = _asynchronous(query.get_user_memberships)
+get_user_role_in_organization = _asynchronous(query.get_user_role_in_organization)
+get_users_of_organization = _asynchronous(query.get_users_of_organization)
+get_valid_keys_of_organization = _asynchronous(query.get_valid_keys_of_organization)
+get_revoked_key_hashes = _asynchronous(query.get_revoked_key_hashes)
+login_by_key = _asynchronous(query.login_by_key)
+get_user_id_by_valid_key = _asynchronous(query.get_user_id_by_valid_key)
+get_user_profile = _asynchronous(query.get_user_profile)
+get_user_profiles = _asynchronous(query.get_user_profiles)
+get_members_among = _asynchronous(query.get_members_among)
+get_organizations_of_user = _asynchronous(query.get_organizations_of_user)
+get_user_keys_in_organizations = _asynchronous(query.get_user_keys_in_organizations)
+get_user_version = _asynchronous(query.get_user_version)
+get_organization_version = _asynchronous(query.get_organization_version)
+search_users = _asynchronous(query.search_users)
+search_organizations = _asynchronous(query.search_organizations)
+
+add_transactions_batch = _asynchronous(transact.add_transactions_batch)
+calculate_balances = _asynchronous(transact.calculate_balances)
+
+create_account = _asynchronous(unit_of_work.create_account)
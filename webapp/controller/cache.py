@@ -0,0 +1,341 @@
+"""
+cache.py contains the cache of rarely changing entities read by the controllers.
+
+Values are stored as JSON, so every read returns a fresh copy that callers may modify, and
+a shared store holds only data, never code run by the workers that read it.
+The manage functions write through or invalidate the affected keys after they commit;
+other writers' changes show up once the entries expire. With CACHE_URL pointing to Redis,
+all workers share one cache and see each other's invalidations immediately.
+"""
+import asyncio
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy.util import await_only
+from sqlalchemy.util.concurrency import in_greenlet
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+# Bump to ignore entries written by an older layout of the cached values.
+KEY_PREFIX = 'devchat:v2:'
+# Keys of the statistics of the Redis cache, apart from the cached keys which all hold a ':'.
+ENTRIES_KEY = KEY_PREFIX + 'entries'
+HITS_KEY = KEY_PREFIX + 'hits'
+MISSES_KEY = KEY_PREFIX + 'misses'
+
+
+def organization_id_key(name: str) -> str:
+    return f'org-id:{name}'
+
+
+def user_profile_key(user_id: int) -> str:
+    return f'user-profile:{user_id}'
+
+
+def user_organizations_key(user_id: int) -> str:
+    return f'user-orgs:{user_id}'
+
+
+def user_memberships_key(user_id: int) -> str:
+    return f'user-memberships:{user_id}'
+
+
+def recent_write_key(kind: str, entity_id: int) -> str:
+    return f'written:{kind}:{entity_id}'
+
+
+class _Cache(ABC):
+    """
+    Base class of the cache backends, counting hits and misses.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def _set(self, key: str, data: bytes, ttl: Optional[float] = None):
+        pass
+
+    def _get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self._get(key) for key in keys]
+
+    @abstractmethod
+    def delete(self, *keys: str):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Returns:
+            Tuple[bool, Any]: Whether the key was found, and its value
+        """
+        data = self._get(key)
+        if data is None:
+            self.misses += 1
+            return (False, None)
+        self.hits += 1
+        return (True, json.loads(data))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Returns:
+            Dict[str, Any]: Values of the keys found
+        """
+        keys = list(keys)
+        found = {}
+        for key, data in zip(keys, self._get_many(keys)):
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                found[key] = json.loads(data)
+        return found
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Cache a value made of JSON types: dictionary keys come back as strings,
+        tuples as lists and string enums as their values.
+        """
+        self._set(key, json.dumps(value, separators=(',', ':')).encode(), ttl)
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether a key is cached, without counting as a hit or a miss.
+        """
+        return self._get(key) is not None
+
+    def get_or_load(self, key: str, loader: Callable[[], Any]) -> Any:
+        """
+        Get the value of a key, loading and caching it on a miss.
+        A None value is returned without being cached, so that misses are not remembered.
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+class LocalCache(_Cache):
+    """
+    In-process cache evicting the least recently used entries beyond `max_entries`
+    and expiring entries `ttl` seconds after they were written.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries: 'OrderedDict[str, Tuple[float, bytes]]' = OrderedDict()
+        self._memory = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key: str):
+        _, data = self._entries.pop(key)
+        self._memory -= len(key) + len(data)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key: str, data: bytes, ttl: Optional[float] = None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), data)
+            self._memory += len(key) + len(data)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory = 0
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        with self._lock:
+            stats.update(entries=len(self._entries), memory_bytes=self._memory,
+                         evictions=self.evictions)
+        return stats
+
+
+class RedisCache(_Cache):
+    """
+    Cache shared by all workers in Redis, which evicts by its own `maxmemory-policy`
+    (allkeys-lru is recommended) and expires entries `ttl` seconds after they were written.
+
+    The statistics are those of the shared cache: the workers add their hits and misses to
+    counters in Redis when their statistics are read, and the entries are counted in a
+    sorted set of the cached keys by expiry time, so that no statistic scans the keys.
+    """
+
+    def __init__(self, url: str, ttl: float = 60):
+        super().__init__()
+        import redis  # pylint: disable=import-outside-toplevel,import-error
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self._flushed = {'hits': 0, 'misses': 0}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def _call(func: Callable, *args, **kwargs) -> Any:
+        # Controllers run by AsyncSession.run_sync execute on the event loop, where a
+        # blocking round trip would stall every request: there it runs in a thread instead.
+        if in_greenlet():
+            return await_only(asyncio.to_thread(func, *args, **kwargs))
+        return func(*args, **kwargs)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self._call(self.client.get, KEY_PREFIX + key)
+
+    def _get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self._call(self.client.mget, [KEY_PREFIX + key for key in keys]) if keys else []
+
+    def _write(self, key: str, data: bytes, ttl: float):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(key, data, px=int(ttl * 1000))
+        pipeline.zadd(ENTRIES_KEY, {key: time.time() + ttl})
+        pipeline.execute()
+
+    def _set(self, key: str, data: bytes, ttl: Optional[float] = None):
+        self._call(self._write, KEY_PREFIX + key, data, self.ttl if ttl is None else ttl)
+
+    def _remove(self, keys: List[str]):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.delete(*keys)
+        pipeline.zrem(ENTRIES_KEY, *keys)
+        pipeline.execute()
+
+    def delete(self, *keys: str):
+        if keys:
+            self._call(self._remove, [KEY_PREFIX + key for key in keys])
+
+    def _clear(self):
+        keys = list(self.client.scan_iter(match=KEY_PREFIX + '*', count=1000))
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        self._call(self._clear)
+
+    def _read_stats(self, hits: int, misses: int) -> List[Any]:
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.incrby(HITS_KEY, hits)
+        pipeline.incrby(MISSES_KEY, misses)
+        pipeline.zremrangebyscore(ENTRIES_KEY, '-inf', time.time())
+        pipeline.zcard(ENTRIES_KEY)
+        pipeline.info('memory')
+        return pipeline.execute()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Statistics of the cache shared by all workers, with the memory used by the whole
+        Redis server. Entries evicted by Redis before they expire are still counted.
+        """
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+            total_hits, total_misses, _, entries, info = self._call(
+                self._read_stats, hits - self._flushed['hits'],
+                misses - self._flushed['misses'])
+            self._flushed = {'hits': hits, 'misses': misses}
+        lookups = total_hits + total_misses
+        return {'hits': total_hits, 'misses': total_misses,
+                'hit_ratio': total_hits / lookups if lookups else 0.0,
+                'entries': entries, 'memory_bytes': info.get('used_memory')}
+
+
+def invalidate_memberships(memberships: Iterable[Tuple[int, int]]):
+    """
+    Drop the cached memberships and organization lists affected by changed memberships.
+
+    Args:
+        memberships (Iterable[Tuple[int, int]]): Pairs of user ID and organization ID
+    """
+    keys = set()
+    user_ids = set()
+    organization_ids = set()
+    for user_id, organization_id in memberships:
+        keys.add(user_memberships_key(user_id))
+        keys.add(user_organizations_key(user_id))
+        user_ids.add(user_id)
+        organization_ids.add(organization_id)
+    if keys:
+        get_cache().delete(*keys)
+    mark_recent_writes(user_ids, organization_ids)
+
+
+def mark_recent_writes(user_ids: Iterable[int] = (), organization_ids: Iterable[int] = ()):
+    """
+    Pin the reads of changed users and organizations to the primary database for
+    READ_YOUR_WRITES_SECONDS, until the replicas have caught up with the change.
+    Nothing is marked unless replicas are configured.
+    """
+    settings = get_settings()
+    if not settings.database_replica_urls or settings.read_your_writes_seconds <= 0:
+        return
+    cache = get_cache()
+    for kind, ids in (('user', user_ids), ('organization', organization_ids)):
+        for entity_id in set(ids):
+            cache.set(recent_write_key(kind, entity_id), True,
+                      ttl=settings.read_your_writes_seconds)
+
+
+def has_recent_writes(user_ids: Iterable[int] = (), organization_ids: Iterable[int] = ()) -> bool:
+    """
+    Whether any of the users or organizations changed within READ_YOUR_WRITES_SECONDS.
+    """
+    cache = get_cache()
+    keys = [recent_write_key('user', user_id) for user_id in user_ids]
+    keys.extend(recent_write_key('organization', org_id) for org_id in organization_ids)
+    return any(cache.contains(key) for key in keys)
+
+
+@lru_cache(maxsize=None)
+def get_cache() -> _Cache:
+    """
+    Get the cache of the process, configured by CACHE_URL, CACHE_MAX_ENTRIES and CACHE_TTL.
+    """
+    settings = get_settings()
+    if settings.cache_url:
+        logger.info("Caching entities in Redis")
+        return RedisCache(settings.cache_url, ttl=settings.cache_ttl)
+    return LocalCache(max_entries=settings.cache_max_entries, ttl=settings.cache_ttl)
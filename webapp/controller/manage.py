@@ -1,18 +1,39 @@
 """
 management.py contains functions to create and update data in the database.
 """
-from typing import Tuple, Optional
-from sqlalchemy import insert
+from typing import Iterable, Tuple, Optional
+from sqlalchemy import insert, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from webapp.model import Organization, User, organization_user, Role
 from webapp.model import AccessKey
 from webapp.utils import now, generate_access_key
 from webapp.utils import get_logger
+from .cache import get_cache, invalidate_memberships, organization_id_key
+from .cache import user_profile_key, mark_recent_writes
+from .query import get_user_role_in_organization
 
 logger = get_logger(__name__)
 
 
+def bump_versions(db: Session, user_ids: Iterable[int] = (),
+                  organization_ids: Iterable[int] = ()):
+    """
+    Bump the versions of users and organizations in the transaction of the caller,
+    invalidating the ETags of their reads once it commits.
+
+    Args:
+        user_ids (Iterable[int]): IDs of the changed users
+        organization_ids (Iterable[int]): IDs of the changed organizations
+    """
+    user_ids, organization_ids = set(user_ids), set(organization_ids)
+    for model, ids in ((User, user_ids), (Organization, organization_ids)):
+        if ids:
+            db.execute(update(model).where(model.id.in_(ids)).values(version=model.version + 1),
+                       execution_options={'synchronize_session': False})
+    mark_recent_writes(user_ids, organization_ids)
+
+
 def create_organization(db: Session, name: str, country: Optional[str] = None) -> Organization:
     """
     Create a new organization.
@@ -24,11 +45,16 @@ def create_organization(db: Session, name: str, country: Optional[str] = None) -
     Returns:
         Organization: The created organization object
     """
+    organization = Organization(db, name=name, country_code=country)
     try:
-        organization = Organization(db, name=name, country_code=country)
+        db.add(organization)
+        db.commit()
+        get_cache().set(organization_id_key(name), organization.id)
+        mark_recent_writes(organization_ids=[organization.id])
         logger.info("Created organization %d (name: %s)", organization.id, organization.name)
         return organization
     except IntegrityError as error:
+        db.rollback()
         raise ValueError("Organization name already exists.") from error
 
 
@@ -47,12 +73,17 @@ def create_user(db: Session, username: str, email: str,
     Returns:
         User: The created user object
     """
+    user = User(db, username=username, email=email,
+                company=company, location=location, social_profile=social_profile)
     try:
-        user = User(db, username=username, email=email,
-                    company=company, location=location, social_profile=social_profile)
+        db.add(user)
+        db.commit()
+        get_cache().set(user_profile_key(user.id), {"username": username, "email": email})
+        mark_recent_writes(user_ids=[user.id])
         logger.info("Created user %d (username: %s)", user.id, user.username)
         return user
     except IntegrityError as error:
+        db.rollback()
         error_message = str(error.orig)
         if "email" in error_message:
             raise ValueError("Email already exists.") from error
@@ -81,7 +112,9 @@ def add_user_to_organization(db: Session, user_id: int, organization_id: int,
             role=Role[role.upper()]
         )
         db.execute(stmt)
+        bump_versions(db, [user_id], [organization_id])
         db.commit()
+        invalidate_memberships([(user_id, organization_id)])
         logger.info("Added user %d to organization %d", user_id, organization_id)
         return True
     except IntegrityError as error:
@@ -100,7 +133,9 @@ def assign_role_to_user(db: Session, user_id: int, org_id: int, role: Role):
             .where(organization_user.c.organization_id == org_id)
             .values(role=role)
         )
+        bump_versions(db, [user_id], [org_id])
         db.commit()
+        invalidate_memberships([(user_id, org_id)])
         logger.info("Assigned role %s to user %d in organization %d", role, user_id, org_id)
         return True
     except IntegrityError as error:
@@ -112,7 +147,7 @@ def assign_role_to_user(db: Session, user_id: int, org_id: int, role: Role):
 
 
 def create_access_key(db: Session, user_id: int, organization_id: int,
-                      name: str = None) -> Tuple[AccessKey, str]:
+                      name: str = None, commit: bool = True) -> Tuple[AccessKey, str]:
     """
     Create a new access key for a user.
 
@@ -120,22 +155,23 @@ def create_access_key(db: Session, user_id: int, organization_id: int,
         user_id (int): Unique ID of the user
         organization_id (int): Unique ID of the organization
         name (str): Name of the key
+        commit (bool): Whether to commit. Pass False to commit the key \
+            together with other changes of the caller.
 
     Returns:
         Tuple[AccessKey, str]: The created access key object and its value
     """
     with db.begin_nested():
         # Check if the user belongs to the organization
-        user_org_role = db.query(organization_user).filter(
-            organization_user.c.user_id == user_id,
-            organization_user.c.organization_id == organization_id).first()
-        if not user_org_role:
+        if get_user_role_in_organization(db, user_id, organization_id) is None:
             raise ValueError("User not found in the organization")
 
         value = generate_access_key(organization_id)
         key = AccessKey(value, user_id=user_id, organization_id=organization_id, name=name)
 
         db.add(key)
+        bump_versions(db, [user_id], [organization_id])
+    if commit:
         db.commit()
     logger.info("Created access key %d (hash: %s) for user %d in organization %d",
                 key.id, key.key_hash, key.user_id, key.organization_id)
@@ -157,6 +193,7 @@ def revoke_access_key(db: Session, key_id: int):
     if key:
         try:
             key.revoke_time = now(db)
+            bump_versions(db, [key.user_id], [key.organization_id])
             db.commit()
             logger.info("Revoked access key %d (hash: %s) for user %d in organization %d",
                         key.id, key.key_hash, key.user_id, key.organization_id)
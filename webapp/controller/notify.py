@@ -0,0 +1,35 @@
+"""
+notify.py contains the notifications of organization events sent with PostgreSQL NOTIFY.
+
+They are sent in the transaction of the change, so listeners get them once it commits and
+never for a change rolled back. webapp/events.py fans them out to the subscribers of every
+organization.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+CHANNEL = 'organization_events'
+
+# One notification per payload. NOTIFY takes no parameters, pg_notify does.
+_NOTIFY = text("SELECT pg_notify(:channel, payload) "
+               "FROM unnest(CAST(:payloads AS text[])) AS payload")
+
+
+def _encode(value: Any) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def notify_organizations(db: Session, events: Iterable[Dict[str, Any]]):
+    """
+    Send events of organizations, delivered when the transaction of the session commits.
+
+    Args:
+        events (Iterable[dict]): Events with their `organization_id` and `type`, \
+            e.g. `usage` or `balance`. Each must encode to less than 8000 bytes.
+    """
+    payloads = [json.dumps(event, default=_encode) for event in events]
+    if payloads:
+        db.execute(_NOTIFY, {'channel': CHANNEL, 'payloads': payloads})
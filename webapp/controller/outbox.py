@@ -0,0 +1,100 @@
+"""
+outbox.py contains functions to write and drain the transactional outbox.
+"""
+from datetime import timedelta
+from typing import Any, Dict, List
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import func
+from webapp.model import OutboxMessage, OutboxStatus
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+_outbox = OutboxMessage.__table__
+
+
+def enqueue_message(db: Session, topic: str, payload: Dict[str, Any]) -> OutboxMessage:
+    """
+    Add a message to the outbox without committing, so that it is written in the same
+    transaction as the changes of the caller.
+
+    Args:
+        topic (str): Kind of the message, e.g. 'email'
+        payload (dict): JSON-serializable arguments of the handler of the topic
+
+    Returns:
+        OutboxMessage: The pending message
+    """
+    message = OutboxMessage(topic=topic, payload=payload, status=OutboxStatus.PENDING,
+                            attempts=0)
+    db.add(message)
+    return message
+
+
+def claim_messages(db: Session, limit: int = 20,
+                   lease: timedelta = timedelta(seconds=60)) -> List[Dict[str, Any]]:
+    """
+    Claim a batch of due messages in a single statement.
+
+    The messages are locked with SKIP LOCKED so that concurrent workers claim disjoint
+    batches, and their next attempt is pushed back by `lease`, so that a message whose
+    worker dies is picked up again once the lease runs out.
+
+    Args:
+        limit (int): Maximum number of messages to claim
+        lease (timedelta): Time the claiming worker has to complete or fail the messages
+
+    Returns:
+        list: List of dictionaries with keys 'id', 'topic', 'payload' and 'attempts'.
+    """
+    due = select(_outbox.c.id).where(
+        _outbox.c.status == OutboxStatus.PENDING,
+        _outbox.c.next_attempt_time <= func.now()  # pylint: disable=E1102
+    ).order_by(_outbox.c.next_attempt_time).limit(limit).with_for_update(skip_locked=True)
+
+    stmt = update(_outbox).where(_outbox.c.id.in_(due.scalar_subquery())).values(
+        attempts=_outbox.c.attempts + 1,
+        next_attempt_time=func.now() + lease  # pylint: disable=E1102
+    ).returning(_outbox.c.id, _outbox.c.topic, _outbox.c.payload, _outbox.c.attempts)
+
+    messages = [row._asdict() for row in db.execute(stmt)]
+    db.commit()
+    return messages
+
+
+def complete_messages(db: Session, message_ids: List[int]):
+    """
+    Mark messages as sent and drop their payloads, which may hold secrets.
+
+    Args:
+        message_ids (list): IDs of the messages
+    """
+    if not message_ids:
+        return
+    db.execute(update(_outbox).where(_outbox.c.id.in_(message_ids)).values(
+        status=OutboxStatus.SENT, payload=None, last_error=None,
+        sent_time=func.now()))  # pylint: disable=E1102
+    db.commit()
+
+
+def fail_message(db: Session, message_id: int, error: str, retry_in: timedelta = None):
+    """
+    Record a failed attempt of a message. A message failed for good loses its payload,
+    which may hold secrets, like a sent one.
+
+    Args:
+        message_id (int): ID of the message
+        error (str): Description of the error
+        retry_in (timedelta, optional): Delay before the next attempt. \
+            If None, the message is marked as failed for good.
+    """
+    values = {'last_error': error[:1000]}
+    if retry_in is None:
+        values['status'] = OutboxStatus.FAILED
+        values['payload'] = None
+        logger.error("Outbox message %d failed for good: %s", message_id, error)
+    else:
+        values['next_attempt_time'] = func.now() + retry_in  # pylint: disable=E1102
+    db.execute(update(_outbox).where(_outbox.c.id == message_id).values(**values))
+    db.commit()
@@ -0,0 +1,190 @@
+"""
+provision.py contains functions to create users and memberships of an organization in bulk.
+"""
+from typing import Any, Dict, Iterable, List
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from webapp.model import Organization, User, organization_user, Role, AccessKey
+from webapp.model.id_allocator import user_ids
+from webapp.utils import is_valid_email, is_valid_account_name, generate_access_key
+from webapp.utils import get_logger
+from .cache import invalidate_memberships
+from .manage import bump_versions
+
+logger = get_logger(__name__)
+
+# Number of rows written per transaction, and per IN (...) list when looking rows up.
+CHUNK_SIZE = 500
+
+
+def _chunks(items: List[Any], size: int = CHUNK_SIZE) -> Iterable[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _validate(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Validate the rows in memory and build the per-row results.
+    A result whose 'error' is set is not written to the database.
+    """
+    results = []
+    usernames, emails = set(), set()
+    for index, row in enumerate(rows):
+        username = str(row.get('username') or '').strip()
+        email = str(row.get('email') or '').strip()
+        role = str(row.get('role') or Role.MEMBER.value).strip().lower()
+        result = {'row': index, 'username': username, 'email': email, 'role': role,
+                  'user_id': None, 'created': False, 'access_key': None, 'error': None}
+        results.append(result)
+
+        if not is_valid_account_name(username):
+            result['error'] = "Invalid username provided."
+        elif not is_valid_email(email):
+            result['error'] = "Invalid email provided."
+        elif role not in {r.value for r in Role}:
+            result['error'] = f"Invalid role {role}."
+        elif username in usernames:
+            result['error'] = "Duplicate username in the batch."
+        elif email in emails:
+            result['error'] = "Duplicate email in the batch."
+        else:
+            usernames.add(username)
+            emails.add(email)
+    return results
+
+
+def _match_existing_users(db: Session, organization_id: int, results: List[Dict[str, Any]]):
+    """
+    Link rows to users that already exist, or flag the conflicts, with one query per chunk
+    for users and one per chunk for the memberships of the organization.
+    """
+    pending = [result for result in results if result['error'] is None]
+    by_username, by_email = {}, {}
+    for chunk in _chunks(pending):
+        stmt = select(User.id, User.username, User.email).where(or_(
+            User.username.in_([result['username'] for result in chunk]),
+            User.email.in_([result['email'] for result in chunk])))
+        for user_id, username, email in db.execute(stmt):
+            by_username[username] = (user_id, email)
+            by_email[email] = user_id
+
+    for result in pending:
+        existing = by_username.get(result['username'])
+        if existing is not None:
+            if existing[1] != result['email']:
+                result['error'] = "Username already exists."
+            else:
+                result['user_id'] = existing[0]
+        elif result['email'] in by_email:
+            result['error'] = "Email already exists."
+
+    linked = [result for result in pending if result['user_id'] is not None]
+    members = set()
+    for chunk in _chunks(linked):
+        stmt = select(organization_user.c.user_id).where(
+            organization_user.c.organization_id == organization_id,
+            organization_user.c.user_id.in_([result['user_id'] for result in chunk]))
+        members.update(db.execute(stmt).scalars())
+    for result in linked:
+        if result['user_id'] in members:
+            result['error'] = "User already in the organization."
+
+
+def _write(db: Session, organization_id: int, chunk: List[Dict[str, Any]], create_keys: bool):
+    """
+    Write the users, memberships and access keys of a chunk with multi-row statements.
+    The caller commits or rolls back.
+    """
+    new_users = [result for result in chunk if result['created']]
+    if new_users:
+        db.execute(insert(User).values([
+            {'id': result['user_id'], 'username': result['username'], 'email': result['email']}
+            for result in new_users]))
+    db.execute(insert(organization_user).values([
+        {'organization_id': organization_id, 'user_id': result['user_id'],
+         'role': Role(result['role'])}
+        for result in chunk]))
+    bump_versions(db, [result['user_id'] for result in chunk if not result['created']],
+                  [organization_id])
+
+    if create_keys:
+        keys = []
+        for result in chunk:
+            result['access_key'] = generate_access_key(organization_id)
+            keys.append(AccessKey(result['access_key'], user_id=result['user_id'],
+                                  organization_id=organization_id))
+        db.add_all(keys)
+        db.flush()
+
+
+def _write_rows_one_by_one(db: Session, organization_id: int, chunk: List[Dict[str, Any]],
+                           create_keys: bool):
+    """
+    Write a chunk that failed as a whole, isolating each row in a savepoint.
+    """
+    for result in chunk:
+        try:
+            with db.begin_nested():
+                _write(db, organization_id, [result], create_keys)
+        except IntegrityError as error:
+            message = str(error.orig)
+            if 'email' in message:
+                result['error'] = "Email already exists."
+            elif 'username' in message:
+                result['error'] = "Username already exists."
+            else:
+                result['error'] = "Accounts not found or duplicate."
+            result['access_key'] = None
+    db.commit()
+
+
+def provision_users(db: Session, organization_id: int, rows: List[Dict[str, Any]],
+                    create_keys: bool = False) -> List[Dict[str, Any]]:
+    """
+    Create users in bulk and add them to an organization.
+
+    Rows naming an existing user by both username and email add that user to the
+    organization. Invalid or conflicting rows are reported without aborting the batch.
+
+    Args:
+        organization_id (int): Unique ID of the organization
+        rows (list): List of dictionaries with 'username', 'email' and optionally 'role'
+        create_keys (bool): Whether to create an access key for every added member
+
+    Returns:
+        list: One dictionary per row, in order, with keys 'row', 'username', 'email', \
+            'role', 'user_id', 'created', 'access_key' and 'error'.
+    """
+    if db.get(Organization, organization_id) is None:
+        raise ValueError("Organization not found.")
+
+    results = _validate(rows)
+    _match_existing_users(db, organization_id, results)
+
+    accepted = [result for result in results if result['error'] is None]
+    new_users = [result for result in accepted if result['user_id'] is None]
+    for result, user_id in zip(new_users, user_ids.allocate(db, len(new_users))):
+        result['user_id'] = user_id
+        result['created'] = True
+    db.commit()
+
+    for chunk in _chunks(accepted):
+        try:
+            _write(db, organization_id, chunk, create_keys)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            _write_rows_one_by_one(db, organization_id, chunk, create_keys)
+    invalidate_memberships([(result['user_id'], organization_id)
+                            for result in accepted if result['error'] is None])
+
+    for result in results:
+        if result['error'] is not None:
+            result['user_id'] = None
+            result['created'] = False
+
+    failed = sum(1 for result in results if result['error'] is not None)
+    logger.info("Provisioned %d of %d users in organization %d",
+                len(results) - failed, len(results), organization_id)
+    return results
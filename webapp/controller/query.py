@@ -1,16 +1,48 @@
 """
 query.py contains functions to query the database.
+
+The helpers returning a choice of columns run statements built once per projection and
+cached, with their values bound as parameters. Executing the same statement object lets
+SQLAlchemy reuse its cache key and compiled form instead of building and compiling the
+query on every call. Columns outside the whitelists are rejected.
 """
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-from sqlalchemy import select
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Iterable, Sequence, Set, Tuple
+from sqlalchemy import Float, Select, bindparam, select, text, tuple_
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.expression import func
 from sqlalchemy.orm import Session
-from webapp.model import Organization, User, organization_user
+from webapp.model import Organization, User, organization_user, Role
 from webapp.model import AccessKey
+from webapp.model.trigram import trigrams_installed
 from webapp.utils import get_logger, hash_access_key
+from .cache import get_cache, organization_id_key, user_memberships_key, user_profile_key
+from .cache import user_organizations_key
 
 logger = get_logger(__name__)
 
+USER_COLUMNS = {column: getattr(User, column) for column in (
+    'id', 'username', 'email', 'company', 'location', 'social_profile', 'create_time')}
+ORGANIZATION_COLUMNS = {column: getattr(Organization, column) for column in (
+    'id', 'name', 'balance', 'currency', 'country_code', 'create_time')}
+ORGANIZATION_COLUMNS['role'] = organization_user.c.role
+KEY_COLUMNS = {column: getattr(AccessKey, column) for column in (
+    'id', 'name', 'thumbnail', 'create_time', 'revoke_time', 'user_id', 'organization_id')}
+
+
+def _projection(columns: Sequence[str], allowed: Dict[str, Any]) -> Tuple[str, ...]:
+    """
+    Normalize a list of column names into a hashable projection, without duplicates.
+
+    Raises:
+        ValueError: If a column is not allowed
+    """
+    for column in columns:
+        if column not in allowed:
+            raise ValueError(f"Unknown column {column}.")
+    return tuple(dict.fromkeys(columns))
+
 
 def get_organization_id_by_name(db: Session, org_name: str) -> int:
     """
@@ -22,50 +54,109 @@ def get_organization_id_by_name(db: Session, org_name: str) -> int:
     Returns:
         int: the organization ID with the given name
     """
-    org_id = db.query(Organization.id).filter(Organization.name == org_name).first()
-    if org_id is None:
-        return None
-    return org_id[0]
+    return get_cache().get_or_load(
+        organization_id_key(org_name),
+        lambda: db.query(Organization.id).filter(Organization.name == org_name).scalar())
 
 
-def get_users_of_organization(db: Session, org_id: int,
-                              columns: List[str] = None) -> List[Dict[str, Any]]:
+_USER_MEMBERSHIPS = select(organization_user.c.organization_id, organization_user.c.role). \
+    where(organization_user.c.user_id == bindparam('user_id'))
+
+
+def get_user_memberships(db: Session, user_id: int) -> Dict[int, Role]:
+    """
+    Get the roles of a user in all of their organizations, cached as a whole per user
+    so that any number of role checks costs at most one query.
+
+    Args:
+        user_id (int): Unique ID of the user
+
+    Returns:
+        Dict[int, Role]: Role of the user by organization ID, empty for unknown users.
+    """
+    # Cached as pairs, since JSON objects only have string keys.
+    memberships = get_cache().get_or_load(
+        user_memberships_key(user_id),
+        lambda: [list(row) for row in db.execute(_USER_MEMBERSHIPS, {'user_id': user_id})])
+    return {org_id: Role(role) for org_id, role in memberships}
+
+
+def get_user_role_in_organization(db: Session, user_id: int, org_id: int) -> Optional[Role]:
     """
-    Get all users of an organization.
+    Get the role of a user in an organization.
 
     Args:
+        user_id (int): Unique ID of the user
         org_id (int): Unique ID of the organization
-        columns (list, optional): List of user columns to return. \
-            Default is ['id', 'username', 'email'].
 
     Returns:
-        list: List of dictionaries containing user information. \
-            Each dictionary contains user data with keys matching the specified columns.
+        Optional[Role]: Role of the user, or None if the user is not a member.
     """
-    if not columns:
-        columns = ['id', 'username', 'email']
+    return get_user_memberships(db, user_id).get(org_id)
+
 
-    users = db.query(User).with_entities(
-        *[getattr(User, column).label(column) for column in columns]). \
-        join(organization_user). \
-        filter(organization_user.c.organization_id == org_id).all()
+def get_users_of_organization(db: Session, org_id: int, columns: List[str] = None,
+                              limit: Optional[int] = None,
+                              after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Get users of an organization ordered by ID, a page at a time if `limit` is given.
 
-    return [row._asdict() for row in users]
+    Pages are read by keyset on the (organization_id, user_id) index, so a deep page
+    costs as much as the first one.
 
+    Args:
+        org_id (int): Unique ID of the organization
+        columns (list, optional): List of user columns to return. \
+            Default is ['id', 'username', 'email'].
+        limit (int, optional): Maximum number of users to return
+        after_id (int, optional): Return only users with a greater ID, i.e. the page \
+            after the one ending with this user
 
-def get_valid_keys_of_organization(db: Session, organization_id: int) -> List[AccessKey]:
+    Returns:
+        list: List of dictionaries containing user information. \
+            Each dictionary contains user data with keys matching the specified columns.
+    """
+    projection = _projection(columns or ['id', 'username', 'email'], USER_COLUMNS)
+    stmt = _users_of_organization_statement(projection, after_id is not None, limit is not None)
+    rows = db.execute(stmt, {'org_id': org_id, 'after_id': after_id, 'limit': limit})
+    return [dict(row) for row in rows.mappings()]
+
+
+@lru_cache(maxsize=256)
+def _users_of_organization_statement(projection: Tuple[str, ...], paged: bool,
+                                     limited: bool) -> Select:
+    stmt = select(*[USER_COLUMNS[column].label(column) for column in projection]). \
+        join(organization_user, organization_user.c.user_id == User.id). \
+        where(organization_user.c.organization_id == bindparam('org_id'))
+    if paged:
+        stmt = stmt.where(organization_user.c.user_id > bindparam('after_id'))
+    stmt = stmt.order_by(organization_user.c.user_id)
+    if limited:
+        stmt = stmt.limit(bindparam('limit'))
+    return stmt
+
+
+def get_valid_keys_of_organization(db: Session, organization_id: int,
+                                   limit: Optional[int] = None,
+                                   after_id: Optional[int] = None) -> List[AccessKey]:
     """
-    Get all valid access keys' information of an organization.
+    Get valid access keys' information of an organization ordered by ID,
+    a page at a time if `limit` is given.
 
     Args:
         organization_id (int): Unique ID of the organization
+        limit (int, optional): Maximum number of keys to return
+        after_id (int, optional): Return only keys with a greater ID
 
     Returns:
         list: List of AccessKey objects containing valid keys' information.
     """
-    return db.query(AccessKey).join(Organization).filter(
-        Organization.id == organization_id,
-        AccessKey.revoke_time == None).all()  # pylint: disable=C0121
+    query = db.query(AccessKey).filter(
+        AccessKey.organization_id == organization_id,
+        AccessKey.revoke_time == None)  # pylint: disable=C0121
+    if after_id is not None:
+        query = query.filter(AccessKey.id > after_id)
+    return query.order_by(AccessKey.id).limit(limit).all()
 
 
 def get_revoked_key_hashes(db: Session, start_time: datetime, end_time: datetime) -> List[str]:
@@ -105,11 +196,111 @@ def login_by_key(db: Session, key: str) -> Optional[int]:
     return access_key.user_id
 
 
+def get_user_id_by_valid_key(db: Session, key: str) -> Optional[int]:
+    """
+    Get the user ID of an access key that has not been revoked.
+
+    Args:
+        db (Session): Database session.
+        key (str): Value of the access key.
+
+    Returns:
+        Optional[int]: User ID of the key, or None if the key is unknown or revoked.
+    """
+    stmt = select(AccessKey.user_id).where(AccessKey.key_hash == hash_access_key(key),
+                                           AccessKey.revoke_time.is_(None))
+    return db.execute(stmt).scalar()
+
+
+def get_user_version(db: Session, user_id: int) -> Optional[int]:
+    """
+    Get the version of a user, which changes with the profile, organizations and keys of the user.
+
+    Args:
+        user_id (int): Unique ID of the user
+
+    Returns:
+        int: Version of the user, or None if the user does not exist
+    """
+    return db.execute(select(User.version).where(User.id == user_id)).scalar()
+
+
+def get_organization_version(db: Session, org_id: int) -> Optional[int]:
+    """
+    Get the version of an organization, which changes with its members and keys.
+
+    Args:
+        org_id (int): Unique ID of the organization
+
+    Returns:
+        int: Version of the organization, or None if the organization does not exist
+    """
+    return db.execute(select(Organization.version).where(Organization.id == org_id)).scalar()
+
+
 def get_user_profile(db: Session, user_id: int) -> Optional[Dict[str, str]]:
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is not None:
-        return {"username": user.username, "email": user.email}
-    return None
+    def load():
+        user = db.query(User).filter(User.id == user_id).first()
+        if user is not None:
+            return {"username": user.username, "email": user.email}
+        return None
+    return get_cache().get_or_load(user_profile_key(user_id), load)
+
+
+_USER_PROFILES = select(User.id, User.username, User.email). \
+    where(User.id.in_(bindparam('user_ids', expanding=True)))
+
+
+def get_user_profiles(db: Session, user_ids: Iterable[int]) -> Dict[int, Dict[str, str]]:
+    """
+    Get the profiles of users at once, from the cache or else with a single query.
+
+    Args:
+        user_ids (Iterable[int]): Unique IDs of the users
+
+    Returns:
+        Dict[int, Dict[str, str]]: Profiles of the users found, by user ID
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    cache = get_cache()
+    cached = cache.get_many(user_profile_key(user_id) for user_id in user_ids)
+    profiles = {}
+    missing = []
+    for user_id in user_ids:
+        profile = cached.get(user_profile_key(user_id))
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+
+    if missing:
+        for row in db.execute(_USER_PROFILES, {'user_ids': missing}):
+            profiles[row.id] = {"username": row.username, "email": row.email}
+            cache.set(user_profile_key(row.id), profiles[row.id])
+    return profiles
+
+
+_MEMBERS_AMONG = select(organization_user.c.user_id).distinct(). \
+    where(organization_user.c.organization_id.in_(bindparam('org_ids', expanding=True)),
+          organization_user.c.user_id.in_(bindparam('user_ids', expanding=True)))
+
+
+def get_members_among(db: Session, org_ids: Iterable[int], user_ids: Iterable[int]) -> Set[int]:
+    """
+    Get those of the users who are members of any of the organizations, with a single query.
+
+    Args:
+        org_ids (Iterable[int]): Unique IDs of the organizations
+        user_ids (Iterable[int]): Unique IDs of the users
+
+    Returns:
+        Set[int]: IDs of the users member of at least one of the organizations
+    """
+    org_ids, user_ids = list(org_ids), list(user_ids)
+    if not org_ids or not user_ids:
+        return set()
+    rows = db.execute(_MEMBERS_AMONG, {'org_ids': org_ids, 'user_ids': user_ids})
+    return {row.user_id for row in rows}
 
 
 def get_organizations_of_user(db: Session, user_id: int,
@@ -127,26 +318,32 @@ def get_organizations_of_user(db: Session, user_id: int,
             Each dictionary contains organization data with keys matching the specified columns.
     """
     if not columns:
-        columns = ['id', 'name', 'role']
+        # Only the default columns are cached, so that one key covers the cached lists.
+        organizations = get_cache().get_or_load(user_organizations_key(user_id),
+                                                lambda: get_organizations_of_user(
+                                                    db, user_id, ['id', 'name', 'role']))
+        return [dict(organization, role=Role(organization['role']))
+                for organization in organizations]
 
-    selected_columns = []
-    for column in columns:
-        if hasattr(Organization, column):
-            selected_columns.append(getattr(Organization, column).label(column))
-        elif hasattr(organization_user.c, column):
-            selected_columns.append(getattr(organization_user.c, column).label(column))
+    projection = _projection(columns, ORGANIZATION_COLUMNS)
+    rows = db.execute(_organizations_of_user_statement(projection), {'user_id': user_id})
+    return [dict(row) for row in rows.mappings()]
 
-    user_orgs = db.query(Organization).with_entities(*selected_columns). \
-        join(organization_user). \
-        filter(organization_user.c.user_id == user_id).all()
 
-    return [row._asdict() for row in user_orgs]
+@lru_cache(maxsize=256)
+def _organizations_of_user_statement(projection: Tuple[str, ...]) -> Select:
+    return select(*[ORGANIZATION_COLUMNS[column].label(column) for column in projection]). \
+        join(organization_user, organization_user.c.organization_id == Organization.id). \
+        where(organization_user.c.user_id == bindparam('user_id'))
 
 
 def get_user_keys_in_organizations(db: Session, user_id: int, org_ids: List[int],
-                                   columns: List[str] = None) -> Dict[int, List[Dict[str, Any]]]:
+                                   columns: List[str] = None,
+                                   limit_per_organization: Optional[int] = None,
+                                   after_id: Optional[int] = None
+                                   ) -> Dict[int, List[Dict[str, Any]]]:
     """
-    Get keys of a user in certain organizations.
+    Get keys of a user in certain organizations ordered by ID.
 
     Args:
         db (Session): Database session.
@@ -154,29 +351,187 @@ def get_user_keys_in_organizations(db: Session, user_id: int, org_ids: List[int]
         org_ids (List[int]): List of organization IDs.
         columns (List[str], optional): List of columns to return. \
             Default is ['id', 'thumbnail', 'create_time'].
+        limit_per_organization (int, optional): Maximum number of keys per organization.
+        after_id (int, optional): Return only keys with a greater ID.
 
     Returns:
         Dict[int, List[Dict[str, Any]]]: Dictionary indexed by organization ID \
             containing a list of dictionaries with key information. \
             Each dictionary contains key data matching the specified columns.
     """
-    if not columns:
-        columns = ['id', 'thumbnail', 'create_time']
-    if 'organization_id' not in columns:
-        columns.append('organization_id')
-    selected_columns = [getattr(AccessKey, column).label(column) for column in columns]
-
-    user_keys = db.query(AccessKey).with_entities(*selected_columns). \
-        filter(AccessKey.user_id == user_id,
-               AccessKey.organization_id.in_(org_ids),
-               AccessKey.revoke_time.is_(None)).all()
+    projection = _projection(columns or ['id', 'thumbnail', 'create_time'], KEY_COLUMNS)
+    if 'organization_id' not in projection:
+        projection += ('organization_id',)
+    org_ids = list(org_ids)
+    stmt = _user_keys_statement(projection, after_id is not None,
+                                limit_per_organization is not None, len(org_ids) == 1)
+    user_keys = db.execute(stmt, {'user_id': user_id, 'org_ids': org_ids,
+                                  'after_id': after_id, 'limit': limit_per_organization})
 
     result = {}
-    for row in user_keys:
-        row_dict = row._asdict()
+    for row in user_keys.mappings():
+        row_dict = dict(row)
         org_id = row_dict.pop('organization_id')
         if org_id not in result:
             result[org_id] = []
         result[org_id].append(row_dict)
 
     return result
+
+
+@lru_cache(maxsize=256)
+def _user_keys_statement(projection: Tuple[str, ...], paged: bool, limited: bool,
+                         single: bool) -> Select:
+    selected_columns = [KEY_COLUMNS[column].label(column) for column in projection]
+    conditions = [AccessKey.user_id == bindparam('user_id'),
+                  AccessKey.organization_id.in_(bindparam('org_ids', expanding=True)),
+                  AccessKey.revoke_time.is_(None)]
+    if paged:
+        conditions.append(AccessKey.id > bindparam('after_id'))
+
+    stmt = select(*selected_columns).where(*conditions).order_by(AccessKey.id)
+    if not limited:
+        return stmt
+    if single:
+        # A page of one organization stops after `limit` keys of the index.
+        return stmt.limit(bindparam('limit'))
+
+    # The limit applies per organization, to every key ranked in its organization.
+    rank = func.row_number().over(  # pylint: disable=E1102
+        partition_by=AccessKey.organization_id, order_by=AccessKey.id).label('rank')
+    ranked = select(*selected_columns, rank, AccessKey.id.label('key_id')). \
+        where(*conditions).subquery()
+    return select(*[ranked.c[column] for column in projection]). \
+        where(ranked.c.rank <= bindparam('limit')). \
+        order_by(ranked.c.key_id)
+
+
+SEARCH_FIELDS = {'username': User.username, 'email': User.email, 'name': Organization.name}
+_SEARCH_COLUMNS = {User: (User.id, User.username, User.email),
+                   Organization: (Organization.id, Organization.name)}
+MAX_SEARCH_QUERY_LENGTH = 100
+MIN_FUZZY_QUERY_LENGTH = 3
+
+_SET_STATEMENT_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+_QUERY_CANCELED = '57014'
+
+# Set once pg_trgm is found, after which it is not looked up again.
+_trigrams = {'installed': False}
+
+
+class SearchTimeout(Exception):
+    """
+    A search was canceled by its statement timeout.
+    """
+
+
+def search_users(db: Session, query: str, by: str = 'username', fuzzy: bool = False,
+                 limit: int = 20, after: Optional[Tuple[Any, int]] = None,
+                 timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Search users by the prefix of their username or email, or by similarity to it.
+
+    A prefix search is a range scan of an index on the lowercased field, ordered by that
+    field and ID, so every page costs about the same whatever the size of the table.
+    A fuzzy search matches the trigrams of the query and returns the closest fields first.
+    It needs the pg_trgm extension and reads the index by distance, so deeper pages cost more.
+
+    Args:
+        query (str): Prefix or approximate value of the field, case-insensitive
+        by (str): Field searched, `username` or `email`
+        fuzzy (bool): Whether to search by similarity rather than prefix
+        limit (int): Maximum number of users to return
+        after (tuple, optional): `sort_key` and ID of the last user of the previous page
+        timeout (float, optional): Seconds after which the search is canceled. \
+            The timeout lasts until the end of the transaction.
+
+    Returns:
+        list: Dictionaries with the `id`, `username` and `email` of the users, and the \
+            `sort_key` of their order, the lowercased field or the distance to the query
+
+    Raises:
+        ValueError: If the field, the query or `after` is invalid, \
+            or if a fuzzy search is not available
+        SearchTimeout: If the search runs longer than `timeout`
+    """
+    if by not in ('username', 'email'):
+        raise ValueError(f"Unknown search field {by}.")
+    return _search(db, by, query, fuzzy, limit, after, timeout)
+
+
+def search_organizations(db: Session, query: str, fuzzy: bool = False, limit: int = 20,
+                         after: Optional[Tuple[Any, int]] = None,
+                         timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Search organizations by the prefix of their name, or by similarity to it,
+    like `search_users`.
+
+    Returns:
+        list: Dictionaries with the `id`, `name` and `sort_key` of the organizations
+    """
+    return _search(db, 'name', query, fuzzy, limit, after, timeout)
+
+
+def _search(db: Session, field: str, query: str, fuzzy: bool, limit: int,
+            after: Optional[Tuple[Any, int]], timeout: Optional[float]) -> List[Dict[str, Any]]:
+    query = query.strip().lower()
+    if not query or len(query) > MAX_SEARCH_QUERY_LENGTH:
+        raise ValueError(
+            f"Search query must have 1 to {MAX_SEARCH_QUERY_LENGTH} characters.")
+    if not query.isprintable():
+        raise ValueError("Invalid search query.")
+    if after is not None:
+        sort_key_type = (int, float) if fuzzy else str
+        if not isinstance(after[1], int) or not isinstance(after[0], sort_key_type) \
+                or isinstance(after[0], bool):
+            raise ValueError("Invalid cursor.")
+
+    if fuzzy:
+        if len(query) < MIN_FUZZY_QUERY_LENGTH:
+            raise ValueError(f"Fuzzy search query must have at least "
+                             f"{MIN_FUZZY_QUERY_LENGTH} characters.")
+        if not _trigrams['installed']:
+            _trigrams['installed'] = trigrams_installed(db.connection())
+            if not _trigrams['installed']:
+                raise ValueError("Fuzzy search is not available.")
+        params = {'query': query}
+    elif not query.isascii():
+        # Usernames, emails and names are ASCII, see webapp/utils.py.
+        return []
+    else:
+        # The prefix range, with the bound after every string starting with the prefix.
+        params = {'prefix': query, 'prefix_end': query[:-1] + chr(ord(query[-1]) + 1)}
+    if after is not None:
+        params.update(after_key=after[0], after_id=after[1])
+    params['limit'] = limit
+
+    stmt = _search_statement(field, fuzzy, after is not None)
+    try:
+        if timeout is not None:
+            db.execute(_SET_STATEMENT_TIMEOUT, {'timeout': f'{int(timeout * 1000)}ms'})
+        rows = db.execute(stmt, params)
+        return [dict(row) for row in rows.mappings()]
+    except DBAPIError as error:
+        if getattr(error.orig, 'pgcode', None) == _QUERY_CANCELED:
+            raise SearchTimeout(f"Search by {field} timed out.") from error
+        raise
+
+
+@lru_cache(maxsize=16)
+def _search_statement(field: str, fuzzy: bool, paged: bool) -> Select:
+    column = SEARCH_FIELDS[field]
+    entity = column.class_
+    if fuzzy:
+        sort_key = func.lower(column).op('<->', return_type=Float)(bindparam('query'))
+        conditions = [func.lower(column).op('%', is_comparison=True)(bindparam('query'))]
+    else:
+        # Matches the expression of the search index, see webapp/model/user.py.
+        sort_key = func.lower(column).collate('C')
+        conditions = [sort_key >= bindparam('prefix'), sort_key < bindparam('prefix_end')]
+    if paged:
+        after_row = tuple_(bindparam('after_key'), bindparam('after_id'))
+        conditions.append(tuple_(sort_key, entity.id) > after_row)
+    return select(*_SEARCH_COLUMNS[entity], sort_key.label('sort_key')). \
+        where(*conditions). \
+        order_by(sort_key, entity.id). \
+        limit(bindparam('limit'))
@@ -7,19 +7,31 @@ from sqlalchemy import and_, func
 from sqlalchemy.orm import Session
 from webapp.model import Organization, Transaction, Balance, Payment
 from webapp.utils import now, get_logger
+from .notify import notify_organizations
 
 logger = get_logger(__name__)
 
 
 def add_transactions_batch(db: Session, transactions: List[Transaction]):
     """
-    Add a batch of transactions to the transactions table.
+    Add a batch of transactions to the transactions table, and notify the usage
+    of every organization in the batch.
 
     Args:
         transactions (list): A list of Transaction objects to be added to the database.
     """
+    usage = {}
+    for transaction in transactions:
+        org_usage = usage.setdefault(transaction.organization_id, {
+            'organization_id': transaction.organization_id, 'type': 'usage', 'transactions': 0,
+            'prompt_tokens': 0, 'response_tokens': 0, 'cost': 0})
+        org_usage['transactions'] += 1
+        org_usage['prompt_tokens'] += transaction.prompt_tokens
+        org_usage['response_tokens'] += transaction.response_tokens
+        org_usage['cost'] += transaction.cost
     try:
         db.add_all(transactions)
+        notify_organizations(db, usage.values())
         db.commit()
         logger.info("Added %d transactions to the database", len(transactions))
         return True
@@ -47,6 +59,7 @@ def calculate_balances(db: Session, organization_ids=None):
     ).all()
 
     balances = []
+    events = []
 
     # Get a single timestamp for all balances
     timestamp = now(db).replace(microsecond=0) - timedelta(seconds=1)
@@ -83,7 +96,11 @@ def calculate_balances(db: Session, organization_ids=None):
 
         db.add(balance)
         balances.append((org_id, new_balance))
+        events.append({'organization_id': org_id, 'type': 'balance', 'balance': new_balance,
+                       'prompt_tokens': prompt_token_sum, 'response_tokens': response_token_sum,
+                       'cost': cost_sum, 'payments': payment_sum, 'timestamp': timestamp})
 
+    notify_organizations(db, events)
     db.commit()
     logger.info("Calculated balances for %d organizations", len(balances))
     return balances
@@ -0,0 +1,167 @@
+"""
+unit_of_work.py contains the unit of work building several entities in one transaction.
+"""
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from webapp.model import Organization, User, organization_user, Role
+from webapp.model import AccessKey, OutboxMessage
+from webapp.utils import generate_access_key
+from webapp.utils import get_logger
+from .cache import invalidate_memberships
+from .manage import bump_versions
+from .query import get_user_role_in_organization
+from .outbox import enqueue_message
+
+logger = get_logger(__name__)
+
+
+class UnitOfWork:
+    """
+    UnitOfWork stages users, organizations, memberships, access keys and outbox messages
+    and writes them with one flush and one commit.
+
+    Entities are validated and get their IDs when staged, without a query in most cases.
+    Used as a context manager, it commits on success and rolls back on error:
+
+        with UnitOfWork(db) as uow:
+            user = uow.create_user("alice", "alice@example.com")
+            org = uow.create_organization("alice")
+            uow.add_user_to_organization(user.id, org.id, Role.OWNER)
+            key, value = uow.create_access_key(user.id, org.id)
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._memberships: List[Dict[str, Any]] = []
+        self._created_ids: Set[int] = set()
+        self._changed_user_ids: Set[int] = set()
+        self._changed_organization_ids: Set[int] = set()
+
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def create_user(self, username: str, email: str, company: str = None,
+                    location: str = None, social_profile: str = None) -> User:
+        user = User(self.db, username=username, email=email,
+                    company=company, location=location, social_profile=social_profile)
+        self.db.add(user)
+        self._created_ids.add(user.id)
+        return user
+
+    def create_organization(self, name: str, country: Optional[str] = None) -> Organization:
+        organization = Organization(self.db, name=name, country_code=country)
+        self.db.add(organization)
+        self._created_ids.add(organization.id)
+        return organization
+
+    def add_user_to_organization(self, user_id: int, organization_id: int,
+                                 role: Union[Role, str] = 'member'):
+        self._memberships.append({'organization_id': organization_id, 'user_id': user_id,
+                                  'role': Role[role.upper()]})
+        self._changed(user_id, organization_id)
+
+    def create_access_key(self, user_id: int, organization_id: int,
+                          name: str = None) -> Tuple[AccessKey, str]:
+        # A membership staged in this unit of work needs no check against the database.
+        key = (user_id, organization_id)
+        staged = any((membership['user_id'], membership['organization_id']) == key
+                     for membership in self._memberships)
+        if not staged and \
+                get_user_role_in_organization(self.db, user_id, organization_id) is None:
+            raise ValueError("User not found in the organization")
+
+        value = generate_access_key(organization_id)
+        key = AccessKey(value, user_id=user_id, organization_id=organization_id, name=name)
+        self.db.add(key)
+        self._changed(user_id, organization_id)
+        return (key, value)
+
+    def _changed(self, user_id: int, organization_id: int):
+        # Entities created in this unit of work start at their first version.
+        if user_id not in self._created_ids:
+            self._changed_user_ids.add(user_id)
+        if organization_id not in self._created_ids:
+            self._changed_organization_ids.add(organization_id)
+
+    def enqueue_message(self, topic: str, payload: Dict[str, Any]) -> OutboxMessage:
+        return enqueue_message(self.db, topic, payload)
+
+    def commit(self):
+        """
+        Write everything staged and commit.
+
+        Raises:
+            ValueError: If a username, email or organization name is already taken
+        """
+        try:
+            self.db.flush()
+            if self._memberships:
+                self.db.execute(insert(organization_user).values(self._memberships))
+            bump_versions(self.db, self._changed_user_ids, self._changed_organization_ids)
+            self.db.commit()
+            invalidate_memberships((membership['user_id'], membership['organization_id'])
+                                   for membership in self._memberships)
+        except IntegrityError as error:
+            self.rollback()
+            error_message = str(error.orig)
+            if "email" in error_message:
+                raise ValueError("Email already exists.") from error
+            if "username" in error_message:
+                raise ValueError("Username already exists.") from error
+            if "organizations" in error_message:
+                raise ValueError("Organization name already exists.") from error
+            raise ValueError("Accounts not found or duplicate.") from error
+        except Exception:
+            self.rollback()
+            raise
+        self._reset()
+
+    def rollback(self):
+        self.db.rollback()
+        self._reset()
+
+    def _reset(self):
+        self._memberships = []
+        self._created_ids = set()
+        self._changed_user_ids = set()
+        self._changed_organization_ids = set()
+
+
+def create_account(db: Session, username: str, email: str,
+                   welcome_email: Optional[Dict[str, Any]] = None
+                   ) -> Tuple[User, Organization, AccessKey, str]:
+    """
+    Sign a user up in one transaction: the user, an organization named after the user
+    with the user as owner, an access key, and optionally the welcome email in the outbox.
+
+    Args:
+        username (str): Unique username of the user
+        email (str): Primary email of the user
+        welcome_email (dict, optional): 'from_address', 'from_name' and 'template_id' \
+            of the welcome email carrying the user name and the access key
+
+    Returns:
+        Tuple[User, Organization, AccessKey, str]: The created entities and the key value
+    """
+    with UnitOfWork(db) as uow:
+        user = uow.create_user(username, email)
+        organization = uow.create_organization(username)
+        user_id, organization_id = user.id, organization.id
+        uow.add_user_to_organization(user_id, organization_id, Role.OWNER)
+        key, value = uow.create_access_key(user_id, organization_id)
+        if welcome_email is not None:
+            uow.enqueue_message('email', {
+                **welcome_email, 'to_address': email,
+                'template_data': {'user_name': username, 'access_key': value}})
+
+    logger.info("Created account of user %d (username: %s) with organization %d",
+                user_id, username, organization_id)
+    return (user, organization, key, value)
@@ -1,6 +1,17 @@
-import os
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi import Depends, Header, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from webapp.model.database import Database
+from starlette.concurrency import run_in_threadpool
+from webapp import ratelimit
+from webapp.controller import aio
+from webapp.controller.cache import has_recent_writes
+from webapp.metrics import timed_pool_class
+from webapp.model import Role
+from webapp.model.database import Database, AsyncDatabase
+from webapp.model.pool import get_pool_profile
+from webapp.settings import get_settings
 from webapp.utils import get_logger
 
 logger = get_logger(__name__)
@@ -8,21 +19,182 @@ logger = get_logger(__name__)
 
 def get_database_url() -> str:
     """
-    Get the database URL from environment variable or AWS Secrets Manager.
+    Get the database URL from the settings.
     Returns:
         str: The database URL.
     """
-
-    # Try to get the database URL from environment variable
-    db_url = os.getenv("DATABASE_URL")
+    db_url = get_settings().database_url
     if db_url is None:
         raise ValueError("DATABASE_URL environment variable is not set.")
     return db_url
 
 
-database = Database(get_database_url())
+def get_engine_options(asynchronous: bool = False) -> dict:
+    """
+    Get the engine options of the pool profile in the settings, with a pool class recording
+    the time checkouts wait.
+    """
+    settings = get_settings()
+    profile = get_pool_profile(
+        settings.database_pool_profile, pool_size=settings.database_pool_size,
+        max_overflow=settings.database_max_overflow,
+        statement_timeout_ms=settings.database_statement_timeout_ms)
+    options = profile.engine_options(get_database_url(), asynchronous)
+    options['poolclass'] = timed_pool_class(options['poolclass'])
+    options['pool_logging_name'] = 'async' if asynchronous else 'sync'
+    return options
+
+
+def get_replica_urls() -> List[str]:
+    """
+    Get the URLs of the read replicas, none without CACHE_URL: the reads of changed entities
+    are pinned to the primary by marks in the cache, which must be shared by all the workers
+    and instances for every one of them to see the writes of the others.
+    """
+    settings = get_settings()
+    if settings.database_replica_urls and not settings.cache_url:
+        logger.warning("DATABASE_REPLICA_URLS is ignored without a shared CACHE_URL, "
+                       "since reads could miss the writes of other processes")
+        return []
+    return settings.database_replica_urls
+
+
+@lru_cache(maxsize=None)
+def get_database() -> Database:
+    """
+    Get the database of the process. It is created on the first request rather than at import,
+    so that a cold start does not pay for the engine or the DDL before it has work to do.
+    """
+    settings = get_settings()
+    return Database(get_database_url(), create_tables=settings.create_tables,
+                    replica_urls=get_replica_urls(),
+                    max_replica_lag=settings.replica_max_lag_seconds,
+                    replica_check_interval=settings.replica_check_seconds,
+                    **get_engine_options())
+
+
+@lru_cache(maxsize=None)
+def get_async_database() -> AsyncDatabase:
+    """
+    Get the asyncio database of the process, created on the first request like get_database().
+    """
+    settings = get_settings()
+    return AsyncDatabase(get_database_url(), create_tables=settings.create_tables,
+                         replica_urls=get_replica_urls(),
+                         max_replica_lag=settings.replica_max_lag_seconds,
+                         replica_check_interval=settings.replica_check_seconds,
+                         **get_engine_options(asynchronous=True))
 
 
 def get_db() -> Session:
-    with database.get_session() as db:
+    with get_database().get_session() as db:
+        yield db
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with get_async_database().get_session() as db:
+        yield db
+
+
+def _read_your_writes(request: Request) -> bool:
+    # The users and organizations of the path, and the caller if authenticated already.
+    # Path parameters are strings here, which make the same cache keys as the IDs.
+    user_ids = [request.path_params['user_id']] if 'user_id' in request.path_params else []
+    caller_id = getattr(request.state, 'user_id', None)
+    if caller_id is not None:
+        user_ids.append(caller_id)
+    organization_ids = [request.path_params['org_id']] if 'org_id' in request.path_params \
+        else []
+    return has_recent_writes(user_ids, organization_ids)
+
+
+async def get_async_read_db(request: Request) -> AsyncIterator[AsyncSession]:
+    """
+    Get a session for the reads of query endpoints, on a read replica if any is configured
+    and in sync. The reads of users and organizations that changed within
+    READ_YOUR_WRITES_SECONDS go to the primary, so that callers see their own writes.
+    Endpoints authenticating the caller must declare `get_current_user_id` or
+    `get_permissions` before this dependency, so that the caller's own writes are taken
+    into account too.
+    """
+    database = get_async_database()
+    # In a thread, since the marks may be read from Redis.
+    primary = bool(database.replica_urls) and await run_in_threadpool(_read_your_writes, request)
+    async with database.read_session(primary=primary) as db:
         yield db
+
+
+async def get_current_user_id(request: Request,
+                              authorization: Optional[str] = Header(None)) -> int:
+    """
+    Authenticate the caller by the access key sent as `Authorization: Bearer <key>`.
+    Keys are looked up on the primary, so that a key works as soon as it is created, in a
+    session closed before the endpoint runs: the request does not hold that connection
+    while it waits for another one or streams its response.
+    """
+    scheme, _, key = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not key:
+        raise HTTPException(status_code=401, detail="Missing access key.")
+    async with get_async_database().get_session() as db:
+        user_id = await aio.get_user_id_by_valid_key(db, key.strip())
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid access key.")
+    request.state.user_id = user_id
+    return user_id
+
+
+async def get_admin_user_id(user_id: int = Depends(get_current_user_id)) -> int:
+    """
+    Authenticate the caller as one of the administrators of ADMIN_USER_IDS.
+    """
+    if user_id not in get_settings().admin_user_ids:
+        raise HTTPException(status_code=403, detail="Only administrators are allowed.")
+    return user_id
+
+
+class Permissions:
+    """
+    Roles of the caller in their organizations, for the permission checks of an endpoint.
+    """
+
+    def __init__(self, user_id: int, roles: Dict[int, Role]):
+        self.user_id = user_id
+        self.roles = roles
+
+    def __repr__(self):
+        return f"<Permissions(user_id={self.user_id}, roles={self.roles})>"
+
+    def role(self, org_id: int) -> Optional[Role]:
+        return self.roles.get(org_id)
+
+    def require_member(self, org_id: int, detail: str = "Only members are allowed."):
+        """
+        Raises:
+            HTTPException: 403 if the caller is not a member of the organization
+        """
+        if self.role(org_id) is None:
+            raise HTTPException(status_code=403, detail=detail)
+
+    def require_owner(self, org_id: int, detail: str = "Only owners are allowed."):
+        """
+        Raises:
+            HTTPException: 403 if the caller is not an owner of the organization
+        """
+        if self.role(org_id) != Role.OWNER:
+            raise HTTPException(status_code=403, detail=detail)
+
+
+async def get_permissions(request: Request,
+                          user_id: int = Depends(get_current_user_id)) -> Permissions:
+    """
+    Get the roles of the authenticated caller. They are loaded in one query and cached
+    per user until their memberships change, so the checks usually cost no query.
+    Like the key lookup, the query runs in a session closed before the endpoint runs.
+    A member's request on an organization of the path takes a token from its `org` bucket.
+    """
+    async with get_async_database().get_session() as db:
+        permissions = Permissions(user_id, await aio.get_user_memberships(db, user_id))
+    org_id = request.path_params.get('org_id')
+    if org_id is not None and permissions.role(int(org_id)) is not None:
+        await ratelimit.admit_organization(request, int(org_id))
+    return permissions
@@ -0,0 +1,176 @@
+"""
+events.py contains the fan-out of organization events to the subscribers of the process.
+
+The events are sent with PostgreSQL NOTIFY by the ingest and balance controllers, see
+webapp/controller/notify.py. A process holds a single LISTEN connection, opened for its first
+subscriber and reopened if it is lost, and hands every event to the subscribers of its
+organization, so any number of open dashboards costs one database connection per worker.
+LISTEN needs a session of its own on the server, which PgBouncer in transaction mode does not
+provide: point DATABASE_LISTEN_URL to the database directly in that case.
+"""
+import asyncio
+import json
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Optional, Set
+from sqlalchemy.engine import make_url
+from webapp.controller.notify import CHANNEL
+from webapp.metrics import EVENTS_DROPPED, EVENT_SUBSCRIBERS
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+HEARTBEAT_SECONDS = 15
+
+
+class Subscription:
+    """
+    Events of an organization queued for one subscriber. A subscriber falling behind by more
+    than `max_queued` events loses the oldest ones.
+    """
+
+    def __init__(self, organization_id: int, max_queued: int = 100):
+        self.organization_id = organization_id
+        self.dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+
+    def put(self, event: Dict[str, Any]):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+            EVENTS_DROPPED.inc()
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Get the next event, or None if there is none within `timeout` seconds.
+        """
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventHub:
+    """
+    LISTEN connection of the process and the subscriptions it feeds.
+
+    Args:
+        database_url (str): URL of the database to listen to, without PgBouncer in between
+        retry_delay (float): Seconds to wait before reopening a lost connection
+        keepalive (float): Seconds between two checks of an idle connection
+    """
+
+    def __init__(self, database_url: str, retry_delay: float = 1.0, keepalive: float = 30.0):
+        self.database_url = database_url
+        self.retry_delay = retry_delay
+        self.keepalive = keepalive
+        self.subscriptions: Dict[int, Set[Subscription]] = {}
+        self.connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def dsn(self) -> str:
+        url = make_url(self.database_url).set(drivername='postgresql')
+        return url.render_as_string(hide_password=False)
+
+    def subscribe(self, organization_id: int) -> Subscription:
+        """
+        Subscribe to the events of an organization, listening if not done yet.
+        """
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._listen())
+        subscription = Subscription(organization_id)
+        self.subscriptions.setdefault(organization_id, set()).add(subscription)
+        EVENT_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.organization_id, set())
+        if subscription in subscriptions:
+            subscriptions.discard(subscription)
+            EVENT_SUBSCRIBERS.dec()
+            if not subscriptions:
+                del self.subscriptions[subscription.organization_id]
+
+    def dispatch(self, payload: str):
+        try:
+            event = json.loads(payload)
+            organization_id = int(event['organization_id'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Invalid organization event: %s", payload)
+            return
+        for subscription in self.subscriptions.get(organization_id, ()):
+            subscription.put(event)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        # pylint: disable=unused-argument
+        self.dispatch(payload)
+
+    async def _listen(self):
+        # Imported with the first subscription rather than on a cold start.
+        import asyncpg  # pylint: disable=import-outside-toplevel
+        while True:
+            try:
+                connection = await asyncpg.connect(self.dsn())
+            except (OSError, asyncpg.PostgresError) as exc:
+                logger.warning("Could not listen to organization events: %s", str(exc))
+                await asyncio.sleep(self.retry_delay)
+                continue
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            try:
+                await connection.add_listener(CHANNEL, self._on_notification)
+                self.connected.set()
+                logger.info("Listening to organization events")
+                await self._wait_until_lost(connection, lost)
+                logger.warning("Lost the connection listening to organization events")
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+                logger.warning("Stopped listening to organization events: %s", str(exc))
+            finally:
+                self.connected.clear()
+                if not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.retry_delay)
+
+    async def _wait_until_lost(self, connection, lost: asyncio.Event):
+        # A connection dropped by the network may not be noticed until it is used.
+        while not lost.is_set():
+            try:
+                await asyncio.wait_for(lost.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                await connection.fetchval('SELECT 1')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def event_stream(hub: EventHub, subscription: Subscription,
+                       heartbeat: float = HEARTBEAT_SECONDS) -> AsyncIterator[str]:
+    """
+    Encode the events of a subscription as Server-Sent Events, with a comment line whenever
+    there is no event for `heartbeat` seconds so that proxies keep the stream open.
+    The subscription ends with the stream.
+    """
+    try:
+        while True:
+            event = await subscription.get(timeout=heartbeat)
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        hub.unsubscribe(subscription)
+
+
+@lru_cache(maxsize=None)
+def get_event_hub() -> EventHub:
+    """
+    Get the event hub of the process, listening to DATABASE_LISTEN_URL.
+    """
+    return EventHub(get_settings().database_listen_url)
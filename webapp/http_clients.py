@@ -0,0 +1,177 @@
+"""
+http_clients.py contains the pooled asynchronous HTTP clients of the outbound integrations.
+
+Every service has its own keep-alive connection pool, timeouts and circuit breaker.
+Pools are kept per event loop, since connections cannot be shared between loops.
+httpx is imported on first use to keep cold starts fast.
+"""
+# pylint: disable=import-outside-toplevel
+import asyncio
+import time
+import weakref
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = get_logger(__name__)
+
+
+class ServiceUnavailableError(Exception):
+    """
+    Raised when a service fails, times out, or its circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker that opens after `failure_threshold` consecutive failures.
+
+    While open, calls fail fast. After `reset_timeout` seconds one trial call is let through:
+    its success closes the circuit and its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = self.clock()
+
+
+class ServiceClient:
+    """
+    Client of one outbound HTTP service.
+
+    Transport errors, timeouts and 5xx responses count as failures of the circuit breaker
+    and are raised as ServiceUnavailableError. Other responses are returned as they are.
+    """
+
+    def __init__(self, name: str, base_url: str, timeout: float = 10.0,
+                 connect_timeout: float = 3.0, max_connections: int = 20,
+                 max_keepalive_connections: int = 10, breaker: CircuitBreaker = None):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.breaker = breaker or CircuitBreaker()
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self) -> 'httpx.AsyncClient':
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive_connections))
+            self._clients[loop] = client
+        return client
+
+    async def request(self, method: str, path: str, **kwargs) -> 'httpx.Response':
+        import httpx
+
+        if not self.breaker.allow():
+            raise ServiceUnavailableError(f"Circuit of {self.name} is open.")
+        try:
+            response = await self._client().request(method, path, **kwargs)
+        except httpx.HTTPError as error:
+            self.breaker.record_failure()
+            logger.warning("Request to %s failed: %r", self.name, error)
+            raise ServiceUnavailableError(f"Request to {self.name} failed.") from error
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            logger.warning("Request to %s failed with status code %d",
+                           self.name, response.status_code)
+            raise ServiceUnavailableError(
+                f"{self.name} responded with status code {response.status_code}.")
+        self.breaker.record_success()
+        return response
+
+    async def post(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('POST', path, **kwargs)
+
+    async def aclose(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def _create_hcaptcha_client() -> ServiceClient:
+    return ServiceClient('hcaptcha', get_settings().hcaptcha_url, timeout=10.0)
+
+
+def _create_sendgrid_client() -> ServiceClient:
+    return ServiceClient('sendgrid', get_settings().sendgrid_url, timeout=10.0,
+                         breaker=CircuitBreaker(failure_threshold=5, reset_timeout=60.0))
+
+
+_FACTORIES: Dict[str, Callable[[], ServiceClient]] = {
+    'hcaptcha': _create_hcaptcha_client,
+    'sendgrid': _create_sendgrid_client,
+}
+_service_clients: Dict[str, ServiceClient] = {}
+
+
+def get_service_client(name: str) -> ServiceClient:
+    client: Optional[ServiceClient] = _service_clients.get(name)
+    if client is None:
+        client = _service_clients[name] = _FACTORIES[name]()
+    return client
+
+
+async def close_service_clients():
+    """
+    Close the connection pools of the running event loop.
+    """
+    for client in list(_service_clients.values()):
+        await client.aclose()
+
+
+def reset_service_clients():
+    """
+    Forget all clients, so that they are created again from the current settings.
+    """
+    _service_clients.clear()
@@ -0,0 +1,62 @@
+"""
+integrations.py contains the calls to the external services hCaptcha and SendGrid.
+"""
+from webapp.http_clients import get_service_client
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+async def send_email(from_address: str, from_name: str, to_address: str,
+                     template_id: str, template_data: dict) -> int:
+    mail = {
+        "from": {"email": from_address, "name": from_name},
+        "personalizations": [{
+            "to": [{"email": to_address}],
+            # Set the dynamic template data
+            "dynamic_template_data": template_data,
+        }],
+        # Set the transactional template ID
+        "template_id": template_id,
+    }
+
+    response = await get_service_client('sendgrid').post(
+        "/v3/mail/send", json=mail,
+        headers={"Authorization": f"Bearer {_get_sendgrid_api_key()}"})
+    logger.info("Sent email of template %s to %s with status code %s",
+                template_id, to_address, response.status_code)
+    return response.status_code
+
+
+def _get_sendgrid_api_key() -> str:
+    sendgrid_api_key = get_settings().sendgrid_api_key
+    if sendgrid_api_key is None:
+        raise ValueError("SENDGRID_API_KEY environment variable is not set")
+    return sendgrid_api_key
+
+
+async def verify_hcaptcha(token: str) -> bool:
+    """
+    Verify the hCaptcha token.
+
+    :param token: The hCaptcha token to verify.
+    :return: True if the token is valid, False otherwise.
+    :raises ServiceUnavailableError: If hCaptcha cannot be reached.
+    """
+    secret_key = get_settings().hcaptcha_secret_key
+    if secret_key is None:
+        raise ValueError("HCAPTCHA_SECRET_KEY environment variable is not set")
+    payload = {
+        "response": token,
+        "secret": secret_key
+    }
+
+    response = await get_service_client('hcaptcha').post("/siteverify", data=payload)
+    result = response.json()
+
+    if not result.get("success"):
+        error_msg = ", ".join(result.get("error-codes", []))
+        logger.info("hCaptcha verification failed: %s", error_msg)
+        return False
+    return True
@@ -0,0 +1,166 @@
+"""
+log.py contains the logging pipeline of the process, configured once by `configure_logging`.
+
+Records of every logger are formatted into their message on the calling thread and put on
+a queue by a QueueHandler on the root logger. A QueueListener thread writes them out, as
+text or JSON lines, so a log call on the request path never waits for I/O. The loggers of
+the app log at LOG_LEVEL. Records below WARNING of chatty loggers can be sampled with
+LOG_SAMPLING, e.g. `webapp.controller.transact=0.01,webapp.controller.query=0.1` keeps
+1 in 100 and 1 in 10.
+"""
+import atexit
+import json
+import logging
+import math
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+from webapp.settings import Settings
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Parent of the loggers of the app, which log at LOG_LEVEL.
+APP_LOGGER = 'webapp'
+
+# Attributes of every LogRecord, the others were passed in `extra` and are logged as fields.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Filter keeping a `rate` fraction of the records below WARNING of the sampled loggers and
+    of their children, spread evenly. Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, name: str) -> Optional[float]:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        if rate is None:
+            return True
+        if rate == 0:
+            return False
+        # The n-th record is kept when it raises the count of records due, ceil(n * rate),
+        # computed from the count of records rather than summed up, so that it cannot drift.
+        with self._lock:
+            count = self._counts.get(record.name, 0)
+            self._counts[record.name] = count + 1
+        return math.ceil((count + 1) * rate) > math.ceil(count * rate)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formatter of records as JSON lines, with the fields passed in `extra` included.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    QueueHandler keeping the message and the traceback apart, for the formatter of the
+    listener. The standard one merges them into the message.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[QueueListener] = None  # pylint: disable=invalid-name
+_handler: Optional[logging.Handler] = None  # pylint: disable=invalid-name
+_lock = threading.Lock()
+
+
+def stop_logging():
+    """
+    Write out the queued records and stop the listener thread.
+    """
+    global _listener, _handler  # pylint: disable=global-statement
+    with _lock:
+        if _handler is not None:
+            logging.getLogger().removeHandler(_handler)
+            _handler = None
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def configure_logging(settings: Settings = None, handler: logging.Handler = None):
+    """
+    Route the records of every logger through the logging pipeline, replacing the previous
+    configuration if any.
+
+    Args:
+        settings (Settings): Settings with the level, format, sampling and queueing of the logs.
+            Defaults to the environment at the time of the call, since loggers are created
+            at import time, before the settings of the process may be read.
+        handler (logging.Handler): Handler writing the records out. Defaults to stderr.
+    """
+    global _listener, _handler  # pylint: disable=global-statement
+    settings = settings or Settings()
+    stop_logging()
+
+    if handler is None:
+        handler = logging.StreamHandler(sys.stderr)
+    if settings.log_format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    logging.getLogger(APP_LOGGER).setLevel(getattr(logging, settings.log_level, logging.INFO))
+    with _lock:
+        if settings.log_queue:
+            _listener = QueueListener(queue.SimpleQueue(), handler, respect_handler_level=True)
+            _listener.start()
+            _handler = _QueueHandler(_listener.queue)
+        else:
+            _handler = handler
+        _handler.addFilter(SamplingFilter(settings.log_sampling))
+        logging.getLogger().addHandler(_handler)
+
+
+def ensure_logging():
+    """
+    Configure the logging pipeline unless it is configured already.
+    """
+    if _handler is None:
+        configure_logging()
+
+
+atexit.register(stop_logging)
@@ -1,9 +1,20 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from webapp.api.routers import router
+from webapp.dependencies import get_async_database
+from webapp.events import get_event_hub
+from webapp.http_clients import close_service_clients
+from webapp.metrics import REGISTRY, MetricsMiddleware, install_sqlalchemy_hooks
+from webapp.profiler import ProfilerMiddleware, install_profiler_hooks
+from webapp.ratelimit import RateLimitMiddleware, get_rate_limiter
+from webapp.settings import get_settings
+from webapp.worker import OutboxWorker
 
 app = FastAPI(title="DevChat Webapp", version="0.1.0")
 
+# Innermost, so that its 429 responses carry the CORS headers and are recorded.
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -11,5 +22,35 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
+install_sqlalchemy_hooks()
+install_profiler_hooks()
 
 app.include_router(router)
+
+
+# Not a coroutine, so that the collectors run in a thread: the cache statistics may come
+# from Redis.
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("startup")
+async def startup():
+    settings = get_settings()
+    get_rate_limiter().monitor.start()
+    if settings.outbox_worker:
+        app.state.outbox_worker = OutboxWorker(get_async_database(),
+                                               concurrency=settings.outbox_concurrency)
+        app.state.outbox_worker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if getattr(app.state, 'outbox_worker', None) is not None:
+        await app.state.outbox_worker.stop()
+    await get_rate_limiter().monitor.stop()
+    await get_event_hub().stop()
+    await close_service_clients()
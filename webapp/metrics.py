@@ -0,0 +1,448 @@
+"""
+metrics.py contains the Prometheus metrics of the webapp, the middleware recording them per
+request, and the SQLAlchemy hooks counting queries, database time and pool checkouts.
+
+The metrics are served in the Prometheus text format at /metrics. A route whose
+`db_queries_per_request` climbs with the size of its data is a likely N+1 loop.
+"""
+import itertools
+import threading
+import time
+import weakref
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from starlette.routing import Match
+from webapp.controller.cache import get_cache
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+# Label of the queries run outside of a request, e.g. by the outbox worker.
+BACKGROUND = 'background'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f'{name}{_format_labels(label_names, label_values)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value per label set.
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, self.label_names, key, value
+
+
+class Gauge(Counter):
+    """
+    Value per label set that goes up and down.
+    """
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values per label set in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            # Per bucket counts, then the sum and the count of the observations.
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        names = self.label_names + ('le',)
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield f'{self.name}_bucket', names, key + (_format_value(bound),), cumulative
+            yield f'{self.name}_sum', self.label_names, key, values[-2]
+            yield f'{self.name}_count', self.label_names, key, values[-1]
+
+
+class Registry:
+    """
+    Metrics served together, plus collectors refreshing gauges just before they are served.
+    """
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', "HTTP requests by route and status code.",
+    ('method', 'route', 'status')))
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', "Latency of HTTP requests by route.", ('method', 'route')))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'http_requests_in_flight', "HTTP requests being handled, by route.", ('method', 'route')))
+DB_QUERIES = REGISTRY.register(Counter(
+    'db_queries_total', "Database statements executed, by route.", ('route',)))
+DB_TIME = REGISTRY.register(Counter(
+    'db_query_seconds_total', "Time spent executing database statements, by route.",
+    ('route',)))
+DB_QUERIES_PER_REQUEST = REGISTRY.register(Histogram(
+    'db_queries_per_request', "Database statements executed per request, by route.",
+    ('route',), buckets=QUERY_COUNT_BUCKETS))
+POOL_CHECKOUT_WAIT = REGISTRY.register(Histogram(
+    'db_pool_checkout_wait_seconds',
+    "Time to get a connection from the pool, including connecting if it opens one."))
+POOL_CHECKED_OUT = REGISTRY.register(Gauge(
+    'db_pool_connections_checked_out', "Database connections checked out of the pools."))
+REQUESTS_REJECTED = REGISTRY.register(Counter(
+    'http_requests_rejected_total',
+    "HTTP requests rejected with 429, by rate limit scope, or `overload` when shed.",
+    ('reason',)))
+SINGLE_FLIGHT = REGISTRY.register(Counter(
+    'single_flight_requests_total',
+    "Coalescible reads by name and outcome: `leader` when loaded, `coalesced` when sharing "
+    "the load in flight, `timeout` when loaded after waiting too long for it.",
+    ('name', 'outcome')))
+EVENT_SUBSCRIBERS = REGISTRY.register(Gauge(
+    'organization_event_subscribers', "Open subscriptions to organization events."))
+EVENTS_DROPPED = REGISTRY.register(Counter(
+    'organization_events_dropped_total',
+    "Organization events dropped because their subscriber fell behind."))
+EVENT_LOOP_LAG = REGISTRY.register(Gauge(
+    'event_loop_lag_seconds', "Delay of the last scheduled wake-up of the event loop."))
+
+
+class RequestStats:
+    """
+    Database statements executed on behalf of the current request.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+def get_request_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+def _route_of(scope) -> str:
+    # FastAPI puts the matched route in the scope, whose path has no IDs in it.
+    route = scope.get('route')
+    return getattr(route, 'path', None) or 'unmatched'
+
+
+def _match_route(scope) -> str:
+    # The route is only put in the scope once the request is routed, so a request starting
+    # is matched against the routes of the app here, which gives the same path.
+    router = getattr(scope.get('app'), 'router', None)
+    for route in getattr(router, 'routes', ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, status code and database statements of requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        response = {'status': 500}
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            await send(message)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        in_flight_route = _match_route(scope)
+        REQUESTS_IN_FLIGHT.inc(method=method, route=in_flight_route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec(method=method, route=in_flight_route)
+            _request_stats.reset(token)
+            route = _route_of(scope)
+            REQUESTS.inc(method=method, route=route, status=str(response['status']))
+            REQUEST_LATENCY.observe(elapsed, method=method, route=route)
+            DB_QUERIES.inc(stats.queries, route=route)
+            DB_TIME.inc(stats.db_time, route=route)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    if context is not None:
+        context.metrics_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    start = getattr(context, 'metrics_start_time', None)
+    elapsed = time.perf_counter() - start if start is not None else 0.0
+    stats = _request_stats.get()
+    if stats is None:
+        DB_QUERIES.inc(route=BACKGROUND)
+        DB_TIME.inc(elapsed, route=BACKGROUND)
+    else:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # pylint: disable=unused-argument
+    POOL_CHECKED_OUT.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    # pylint: disable=unused-argument
+    POOL_CHECKED_OUT.dec()
+
+
+def install_sqlalchemy_hooks():
+    """
+    Count the statements and checkouts of every engine and pool of the process.
+    """
+    hooks = [(Engine, 'before_cursor_execute', _before_cursor_execute),
+             (Engine, 'after_cursor_execute', _after_cursor_execute),
+             (Pool, 'checkout', _on_checkout),
+             (Pool, 'checkin', _on_checkin)]
+    for target, name, func in hooks:
+        if not event.contains(target, name, func):
+            event.listen(target, name, func)
+
+
+_timed_pools = weakref.WeakSet()
+
+
+class _TimedCheckout:
+    """
+    Mixin of a pool class timing `Pool._do_get`, which waits for a free connection
+    or opens a new one, and counting the connections checked out and the checkouts waiting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked_out_count = 0
+        self.waiting_count = 0
+        # Start times of the checkouts waiting, and the end and duration of the last one.
+        self._wait_starts: Dict[int, float] = {}
+        self._wait_ids = itertools.count()
+        self._last_wait = (float('-inf'), 0.0)
+        self._count_lock = threading.Lock()
+        _timed_pools.add(self)
+
+    def _count(self, checked_out: int = 0, waiting: int = 0):
+        with self._count_lock:
+            self.checked_out_count += checked_out
+            self.waiting_count += waiting
+
+    def _do_get(self):
+        wait_id = next(self._wait_ids)
+        start = time.perf_counter()
+        with self._count_lock:
+            self.waiting_count += 1
+            self._wait_starts[wait_id] = start
+        try:
+            connection = super()._do_get()  # pylint: disable=no-member
+            self._count(checked_out=1)
+            return connection
+        finally:
+            end = time.perf_counter()
+            with self._count_lock:
+                self.waiting_count -= 1
+                del self._wait_starts[wait_id]
+                self._last_wait = (end, end - start)
+            POOL_CHECKOUT_WAIT.observe(end - start)
+
+    def current_wait(self, window: float) -> float:
+        """
+        Get the longest wait of the checkouts still waiting, or of the last checkout
+        if it ended within `window` seconds.
+        """
+        now = time.perf_counter()
+        with self._count_lock:
+            waits = [now - start for start in self._wait_starts.values()]
+            ended, duration = self._last_wait
+        if now - ended <= window:
+            waits.append(duration)
+        return max(waits, default=0.0)
+
+    def _do_return_conn(self, record):
+        self._count(checked_out=-1)
+        super()._do_return_conn(record)  # pylint: disable=no-member
+
+
+@lru_cache(maxsize=None)
+def timed_pool_class(pool_class: type) -> type:
+    """
+    Get a subclass of a pool class that records the time its checkouts wait.
+    """
+    return type(f'Timed{pool_class.__name__}', (_TimedCheckout, pool_class), {})
+
+
+def pool_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Get the saturation of the pools created by timed pool classes, by pool logging name.
+
+    Returns:
+        dict: `checked_out` and `waiting` connections of every pool, plus its `capacity`
+            and `saturation`, the fraction of the capacity checked out, if it is bounded
+    """
+    stats = {}
+    for pool in list(_timed_pools):
+        name = getattr(pool, 'logging_name', None) or type(pool).__name__
+        pool_stat = {'checked_out': pool.checked_out_count, 'waiting': pool.waiting_count}
+        max_overflow = getattr(pool, '_max_overflow', None)
+        if hasattr(pool, 'size') and max_overflow is not None and max_overflow >= 0:
+            capacity = pool.size() + max_overflow
+            pool_stat['capacity'] = capacity
+            pool_stat['saturation'] = pool.checked_out_count / capacity if capacity else 0.0
+        stats[name] = pool_stat
+    return stats
+
+
+def pool_wait(window: float = 1.0) -> float:
+    """
+    Get the longest wait for a connection of the pools created by timed pool classes,
+    counting the checkouts still waiting and those that ended within `window` seconds.
+    """
+    return max((pool.current_wait(window) for pool in list(_timed_pools)), default=0.0)
+
+
+def _collect_pool_stats():
+    for name, stats in pool_stats().items():
+        for stat, value in stats.items():
+            POOL_STATS.set(value, pool=name, stat=stat)
+
+
+def _collect_cache_stats():
+    for name, value in get_cache().stats().items():
+        if value is not None:
+            CACHE_STATS.set(value, stat=name)
+
+
+CACHE_STATS = REGISTRY.register(Gauge(
+    'entity_cache', "Statistics of the entity cache: hits, misses, hit_ratio, entries, "
+    "evictions and memory_bytes.", ('stat',)))
+REGISTRY.add_collector(_collect_cache_stats)
+
+POOL_STATS = REGISTRY.register(Gauge(
+    'db_pool', "Saturation of the database pools: checked_out, waiting, capacity and "
+    "saturation, by pool.", ('pool', 'stat')))
+REGISTRY.add_collector(_collect_pool_stats)
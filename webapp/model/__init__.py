@@ -1,16 +1,18 @@
 """
 This file is used to import all the models in the models directory.
 """
-from .database import Database, Base
+from .database import Database, AsyncDatabase, Base
 from .organization import Organization, organization_user, Role
 from .user import User
 from .access_key import AccessKey
 from .transaction import Transaction
 from .balance import Balance
 from .payment import Payment
+from .outbox import OutboxMessage, OutboxStatus
 
 __all__ = [
     'Database',
+    'AsyncDatabase',
     'Base',
     'Organization',
     'organization_user',
@@ -19,5 +21,7 @@ __all__ = [
     'AccessKey',
     'Transaction',
     'Balance',
-    'Payment'
+    'Payment',
+    'OutboxMessage',
+    'OutboxStatus',
 ]
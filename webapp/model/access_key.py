@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index
 from sqlalchemy import String, BigInteger, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import func
@@ -35,6 +35,14 @@ class AccessKey(Base):
     user = relationship("User", back_populates="access_keys")
     organization = relationship("Organization", back_populates="access_keys")
 
+    # Serve the keyset pagination of valid keys by organization and by user.
+    __table_args__ = (
+        Index('ix_access_keys_organization_id_id', organization_id, id,
+              postgresql_where=revoke_time.is_(None)),
+        Index('ix_access_keys_user_id_organization_id_id', user_id, organization_id, id,
+              postgresql_where=revoke_time.is_(None)),
+    )
+
     def __init__(self, key: str, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.key_hash = hash_access_key(key)
@@ -1,16 +1,77 @@
-from contextlib import contextmanager
-from sqlalchemy import create_engine
+import asyncio
+from contextlib import contextmanager, asynccontextmanager
+import threading
+from typing import AsyncIterator, Iterator, List, Optional, Sequence
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from webapp.utils import get_logger
+from .replicas import LAG_QUERY, ReplicaRouter
 
+logger = get_logger(__name__)
 
 Base = declarative_base()
 
 
+def _replica_options(engine_options: dict, index: int) -> dict:
+    # Replicas get pools of their own, named after the one of the primary.
+    options = dict(engine_options)
+    if options.get('pool_logging_name'):
+        options['pool_logging_name'] = f"{options['pool_logging_name']}-replica{index}"
+    return options
+
+
+def _as_lag(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
 class Database:
-    def __init__(self, database_url: str):
-        self.engine = create_engine(database_url)
-        self.session_class = sessionmaker(bind=self.engine)
-        Base.metadata.create_all(self.engine)
+    """
+    Database holds the engine and the session factory of a database.
+
+    The engine is created on first use, so constructing a Database neither imports
+    the DB driver nor connects. Missing tables are created at that point as well
+    unless `create_tables` is False.
+
+    Sessions of `read_session` go to one of the `replica_urls` lagging by no more than
+    `max_replica_lag` seconds, or to the primary if there is none.
+    """
+
+    def __init__(self, database_url: str, create_tables: bool = True,
+                 replica_urls: Sequence[str] = (), max_replica_lag: float = 5,
+                 replica_check_interval: float = 1, **engine_options):
+        # pylint: disable=too-many-arguments
+        self.database_url = database_url
+        self.create_tables = create_tables
+        self.engine_options = engine_options
+        self.replica_urls = list(replica_urls)
+        self.router = ReplicaRouter(len(self.replica_urls), max_replica_lag,
+                                    replica_check_interval)
+        self._engine = None
+        self._session_class = None
+        self._replica_engines: Optional[List[Engine]] = None
+        self._replica_session_classes: List[sessionmaker] = []
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self) -> Engine:
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    engine = create_engine(self.database_url, **self.engine_options)
+                    if self.create_tables:
+                        Base.metadata.create_all(engine)
+                    self._session_class = sessionmaker(bind=engine)
+                    self._engine = engine
+        return self._engine
+
+    @property
+    def session_class(self) -> sessionmaker:
+        if self._session_class is None:
+            _ = self.engine
+        return self._session_class
 
     @contextmanager
     def get_session(self) -> Session:
@@ -19,3 +80,166 @@ class Database:
             yield session
         finally:
             session.close()
+
+    @property
+    def replica_engines(self) -> List[Engine]:
+        if self._replica_engines is None:
+            with self._lock:
+                if self._replica_engines is None:
+                    engines = [create_engine(url, **_replica_options(self.engine_options, index))
+                               for index, url in enumerate(self.replica_urls)]
+                    self._replica_session_classes = [sessionmaker(bind=engine)
+                                                     for engine in engines]
+                    self._replica_engines = engines
+        return self._replica_engines
+
+    def _measure_lag(self, index: int) -> Optional[float]:
+        try:
+            with self.replica_engines[index].connect() as conn:
+                return _as_lag(conn.execute(text(LAG_QUERY)).scalar())
+        except Exception as exc:  # an unreachable replica is skipped until the next check
+            logger.warning("Could not measure the lag of replica %d: %s", index, str(exc))
+            return None
+
+    def choose_replica(self) -> Optional[int]:
+        """
+        Get the replica to read from, measuring the lags that are due, None for the primary.
+        """
+        if not self.replica_urls:
+            return None
+        for index in self.router.due():
+            self.router.record(index, self._measure_lag(index))
+        return self.router.choose()
+
+    @contextmanager
+    def read_session(self, primary: bool = False) -> Iterator[Session]:
+        """
+        Get a session for reads only, on a replica unless `primary` is True.
+        """
+        index = None if primary else self.choose_replica()
+        if index is None:
+            with self.get_session() as session:
+                yield session
+            return
+        session = self._replica_session_classes[index]()
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+def to_async_url(database_url: str) -> str:
+    """
+    Get the asyncpg flavor of a PostgreSQL URL, e.g. postgresql+asyncpg://user@host/db.
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == 'postgresql':
+        url = url.set(drivername='postgresql+asyncpg')
+    return url.render_as_string(hide_password=False)
+
+
+class AsyncDatabase:
+    """
+    AsyncDatabase is the asyncio counterpart of Database, running on an AsyncEngine.
+
+    Sessions do not expire objects on commit, since reloading attributes lazily is not
+    possible outside of the event loop's greenlet.
+    """
+
+    def __init__(self, database_url: str, create_tables: bool = True,
+                 replica_urls: Sequence[str] = (), max_replica_lag: float = 5,
+                 replica_check_interval: float = 1, **engine_options):
+        # pylint: disable=too-many-arguments
+        self.database_url = to_async_url(database_url)
+        self.create_tables = create_tables
+        self.engine_options = engine_options
+        self.replica_urls = [to_async_url(url) for url in replica_urls]
+        self.router = ReplicaRouter(len(self.replica_urls), max_replica_lag,
+                                    replica_check_interval)
+        self._engine = None
+        self._session_class = None
+        self._replica_engines: Optional[List[AsyncEngine]] = None
+        self._replica_session_classes: List[async_sessionmaker] = []
+        self._tables_created = False
+        self._tables_lock = asyncio.Lock()
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is None:
+            self._engine = create_async_engine(self.database_url, **self.engine_options)
+            self._session_class = async_sessionmaker(bind=self._engine, expire_on_commit=False)
+        return self._engine
+
+    @property
+    def session_class(self) -> async_sessionmaker:
+        if self._session_class is None:
+            _ = self.engine
+        return self._session_class
+
+    async def _ensure_tables(self):
+        if not self.create_tables or self._tables_created:
+            return
+        async with self._tables_lock:
+            if not self._tables_created:
+                async with self.engine.begin() as conn:
+                    await conn.run_sync(Base.metadata.create_all)
+                self._tables_created = True
+
+    @asynccontextmanager
+    async def get_session(self) -> AsyncIterator[AsyncSession]:
+        await self._ensure_tables()
+        session = self.session_class()
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    @property
+    def replica_engines(self) -> List[AsyncEngine]:
+        if self._replica_engines is None:
+            engines = [create_async_engine(url, **_replica_options(self.engine_options, index))
+                       for index, url in enumerate(self.replica_urls)]
+            self._replica_session_classes = [
+                async_sessionmaker(bind=engine, expire_on_commit=False) for engine in engines]
+            self._replica_engines = engines
+        return self._replica_engines
+
+    async def _measure_lag(self, index: int) -> Optional[float]:
+        try:
+            async with self.replica_engines[index].connect() as conn:
+                return _as_lag((await conn.execute(text(LAG_QUERY))).scalar())
+        except Exception as exc:  # an unreachable replica is skipped until the next check
+            logger.warning("Could not measure the lag of replica %d: %s", index, str(exc))
+            return None
+
+    async def choose_replica(self) -> Optional[int]:
+        """
+        Get the replica to read from, measuring the lags that are due, None for the primary.
+        """
+        if not self.replica_urls:
+            return None
+        for index in self.router.due():
+            self.router.record(index, await self._measure_lag(index))
+        return self.router.choose()
+
+    @asynccontextmanager
+    async def read_session(self, primary: bool = False) -> AsyncIterator[AsyncSession]:
+        """
+        Get a session for reads only, on a replica unless `primary` is True.
+        """
+        index = None if primary else await self.choose_replica()
+        if index is None:
+            async with self.get_session() as session:
+                yield session
+            return
+        session = self._replica_session_classes[index]()
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+        for engine in self._replica_engines or []:
+            await engine.dispose()
@@ -0,0 +1,152 @@
+"""
+id_allocator.py allocates unique, non-sequential-looking 11-digit IDs without probing tables.
+
+Each entity type owns a database sequence that hands out blocks of counters, and every
+counter is mapped to an ID by a keyed Feistel permutation. Since the permutation is a
+bijection, distinct counters always give distinct IDs, so no lookup is needed.
+"""
+import hashlib
+import os
+import threading
+from typing import List
+from sqlalchemy import Sequence, func, select
+from sqlalchemy.orm import Session
+from webapp.settings import get_settings
+from .database import Base
+
+ID_MIN = 10000000000
+ID_SPACE = 90000000000  # IDs lie in [ID_MIN, ID_MIN + ID_SPACE), i.e. exactly 11 digits.
+
+# Number of counters reserved by one sequence call. Sequences are created with this increment,
+# so it must never change on an existing database.
+BLOCK_SIZE = 100
+
+_DEFAULT_KEY = 'devchat-entity-ids'
+
+
+class FeistelPermutation:
+    """
+    A keyed pseudo-random permutation of [0, domain).
+
+    A balanced Feistel network permutes the smallest even-bit range covering the domain,
+    and values falling outside the domain are walked through the network again until
+    they land inside it.
+    """
+
+    def __init__(self, key: bytes, domain: int = ID_SPACE, rounds: int = 4):
+        bits = (domain - 1).bit_length()
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.domain = domain
+        self.rounds = rounds
+        self.key = key
+
+    def _round(self, index: int, value: int) -> int:
+        digest = hashlib.blake2b(value.to_bytes(8, 'big') + bytes([index]),
+                                 key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for index in range(self.rounds):
+            left, right = right, left ^ self._round(index, right)
+        return (left << self.half_bits) | right
+
+    def permute(self, value: int) -> int:
+        if not 0 <= value < self.domain:
+            raise ValueError(f"Value {value} is out of the permutation domain.")
+        value = self._encrypt(value)
+        while value >= self.domain:
+            value = self._encrypt(value)
+        return value
+
+
+class IdAllocator:
+    """
+    Allocator of the IDs of one entity type.
+
+    Blocks of BLOCK_SIZE counters are reserved from the sequence and consumed in process,
+    so most allocations cost no query at all. A forked worker drops the block it inherited.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sequence = Sequence(f'{name}_id_block_seq', start=0, minvalue=0,
+                                 increment=BLOCK_SIZE, metadata=Base.metadata)
+        self._permutation = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+
+    @property
+    def permutation(self) -> FeistelPermutation:
+        if self._permutation is None:
+            base_key = get_settings().id_permutation_key or _DEFAULT_KEY
+            key = hashlib.blake2b(self.name.encode(), key=base_key.encode()).digest()
+            self._permutation = FeistelPermutation(key)
+        return self._permutation
+
+    def reset(self):
+        """
+        Forget the reserved block, e.g. after the sequence has been dropped and recreated.
+        """
+        with self._lock:
+            self._next = self._end = 0
+
+    def _reserve_blocks(self, db: Session, count: int) -> List[int]:
+        if count == 1:
+            return [db.execute(select(self.sequence.next_value())).scalar_one()]
+        stmt = select(self.sequence.next_value()).select_from(func.generate_series(1, count))
+        return list(db.execute(stmt).scalars())
+
+    def _take(self, count: int) -> List[int]:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._next = self._end = 0
+        counters = list(range(self._next, min(self._end, self._next + count)))
+        self._next += len(counters)
+        return counters
+
+    def allocate_counters(self, db: Session, count: int = 1) -> List[int]:
+        # The lock is never held across the sequence query: under AsyncSession.run_sync the
+        # query yields to the event loop, where a concurrent allocation waiting on the lock
+        # would block the loop thread for good.
+        with self._lock:
+            counters = self._take(count)
+
+        missing = count - len(counters)
+        if missing > 0:
+            blocks = self._reserve_blocks(db, -(-missing // BLOCK_SIZE))
+            with self._lock:
+                for start in blocks:
+                    taken = min(missing, BLOCK_SIZE)
+                    counters.extend(range(start, start + taken))
+                    missing -= taken
+                # Keep whichever of the cached block and the rest of the new one is larger,
+                # the counters of the other are skipped.
+                start = blocks[-1]
+                if start + BLOCK_SIZE - counters[-1] - 1 > self._end - self._next:
+                    self._next, self._end = counters[-1] + 1, start + BLOCK_SIZE
+        return counters
+
+    def allocate(self, db: Session, count: int = 1) -> List[int]:
+        """
+        Allocate `count` new IDs.
+
+        Args:
+            db (Session): Database session used when a new block has to be reserved
+            count (int): Number of IDs to allocate
+
+        Returns:
+            list: List of unique 11-digit IDs
+        """
+        return [ID_MIN + self.permutation.permute(counter)
+                for counter in self.allocate_counters(db, count)]
+
+    def next_id(self, db: Session) -> int:
+        return self.allocate(db)[0]
+
+
+user_ids = IdAllocator('user')
+organization_ids = IdAllocator('organization')
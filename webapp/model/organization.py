@@ -2,13 +2,14 @@
 organization.py contains the Organization model.
 """
 from enum import Enum
-import random
-from sqlalchemy import Column, ForeignKey, Table, Enum as SqlEnum
+from sqlalchemy import Column, ForeignKey, Index, Table, Enum as SqlEnum
 from sqlalchemy import String, Float, BigInteger, DateTime
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy.sql.expression import func
 from webapp.utils import is_valid_account_name
 from .database import Base
+from .id_allocator import organization_ids
+from .trigram import add_trigram_index
 from .balance import Balance  # pylint: disable=unused-import
 from .payment import Payment  # pylint: disable=unused-import
 
@@ -23,7 +24,9 @@ organization_user = Table(
     Base.metadata,
     Column('organization_id', BigInteger, ForeignKey('organizations.id')),
     Column('user_id', BigInteger, ForeignKey('users.id')),
-    Column('role', SqlEnum(Role), nullable=False, default=Role.MEMBER)
+    Column('role', SqlEnum(Role), nullable=False, default=Role.MEMBER),
+    # Serves membership lookups and the keyset pagination of members.
+    Index('ix_organization_user_organization_id_user_id', 'organization_id', 'user_id')
 )
 
 
@@ -38,6 +41,7 @@ class Organization(Base):
         currency (str): Currency of the balance
         country_code (str): Location of the organization
         create_time (DateTime): Time when the organization was created
+        version (int): Counter bumped by every change visible in the reads of the organization
     """
     __tablename__ = 'organizations'
 
@@ -48,27 +52,29 @@ class Organization(Base):
     country_code = Column(String, nullable=True)
     create_time = Column(DateTime(timezone=True), nullable=False,
                          default=func.now())  # pylint: disable=E1102
+    version = Column(BigInteger, nullable=False, default=1, server_default='1')
 
     users = relationship("User", secondary=organization_user, back_populates="organizations")
     access_keys = relationship("AccessKey", back_populates="organization")
     balances = relationship("Balance", back_populates="organization")
     payments = relationship("Payment", back_populates="organization")
 
+    # Serves the prefix search and its keyset pagination, like the indexes of User.
+    __table_args__ = (
+        Index('ix_organizations_name_search', func.lower(name).collate('C'), id),
+    )
+
     def __init__(self, db: Session, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not is_valid_account_name(self.name):
             raise ValueError("Invalid organization name provided.")
 
-        with db.begin_nested():
-            while True:
-                unique_id = random.randint(10000000000, 99999999999)
-                if not db.query(Organization).filter(Organization.id == unique_id).first():
-                    self.id = unique_id
-                    break
-            db.add(self)
-            db.commit()
+        self.id = organization_ids.next_id(db)
 
     def __repr__(self):
         return f"<Organization(id={self.id}, name='{self.name}', " \
                f"balance={self.balance}, currency='{self.currency}', " \
                f"country_code='{self.country_code}')>"
+
+
+add_trigram_index(Organization.__table__, 'ix_organizations_name_trigram', 'lower(name)')
@@ -0,0 +1,55 @@
+"""
+outbox.py contains the OutboxMessage model.
+"""
+from enum import Enum
+from sqlalchemy import Column, Index, Enum as SqlEnum
+from sqlalchemy import BigInteger, Integer, String, DateTime, JSON
+from sqlalchemy.sql.expression import func
+from .database import Base
+
+
+class OutboxStatus(str, Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class OutboxMessage(Base):
+    """
+    OutboxMessage model, a side effect to carry out once the transaction that wrote it commits.
+
+    Attributes:
+        id (int): Unique auto-increment Biginteger identifier for the message
+        topic (str): Kind of the message, selecting its handler
+        payload (dict): Arguments of the handler, cleared once the message is sent \
+            or failed for good
+        status (OutboxStatus): Whether the message is pending, sent or failed for good
+        attempts (int): Number of delivery attempts so far
+        next_attempt_time (DateTime): Time before which the message is not picked up
+        last_error (str): Error of the last failed attempt
+        create_time (DateTime): Time when the message was created
+        sent_time (DateTime): Time when the message was sent
+    """
+    __tablename__ = 'outbox'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    topic = Column(String, nullable=False)
+    payload = Column(JSON, nullable=True)
+    status = Column(SqlEnum(OutboxStatus), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_time = Column(DateTime(timezone=True), nullable=False,
+                               default=func.now())  # pylint: disable=E1102
+    last_error = Column(String, nullable=True)
+    create_time = Column(DateTime(timezone=True), nullable=False,
+                         default=func.now())  # pylint: disable=E1102
+    sent_time = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbox_pending', next_attempt_time,
+              postgresql_where=status == OutboxStatus.PENDING),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, topic='{self.topic}', " \
+               f"status='{self.status}', attempts={self.attempts}, " \
+               f"next_attempt_time='{self.next_attempt_time}', sent_time='{self.sent_time}')>"
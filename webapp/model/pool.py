@@ -0,0 +1,152 @@
+"""
+pool.py contains the connection pool profiles of the database engines.
+
+A profile bundles the pool class and sizes, pre-ping, recycling, timeouts and driver options
+suited to a deployment, and is selected with DATABASE_POOL_PROFILE:
+
+- `default`: SQLAlchemy's defaults, 5 pooled connections plus 10 on overflow.
+- `server`: long-lived uvicorn workers under high concurrency. A larger pool reused in LIFO
+  order, so idle connections beyond the load can be recycled, pre-pinged on checkout.
+- `serverless`: short-lived functions, e.g. on Vercel, that would leave a pool of idle
+  connections behind every cold start. Connections are opened per session and closed after.
+- `pgbouncer`: PgBouncer in transaction mode, which pools the connections itself. Connections
+  are opened per session, and asyncpg does not cache prepared statements, which would not
+  survive the server connection being swapped between transactions. No startup parameters
+  are sent, since PgBouncer rejects them; set the statement timeout on the database role.
+"""
+from typing import Optional
+from uuid import uuid4
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+
+class PoolProfile:
+    """
+    Pool and connection options of a database engine.
+
+    Attributes:
+        name (str): Name of the profile
+        null_pool (bool): Whether to open a connection per session instead of pooling them
+        pool_size (int): Number of connections kept in the pool
+        max_overflow (int): Number of connections opened beyond the pool size under load
+        pool_timeout (float): Seconds to wait for a connection before giving up
+        pool_recycle (int): Seconds after which a connection is replaced, -1 for never
+        pre_ping (bool): Whether to test connections on checkout
+        use_lifo (bool): Whether to reuse the most recently returned connection first
+        statement_timeout_ms (int): Server-side timeout of statements, None for the default
+        connect_timeout (int): Seconds to wait for a new connection, None for the default
+        prepared_statements (bool): Whether asyncpg may cache prepared statements
+        startup_parameters (bool): Whether settings such as the statement timeout may be \
+            sent when connecting
+    """
+
+    def __init__(self, name: str, null_pool: bool = False, pool_size: int = 5,
+                 max_overflow: int = 10, pool_timeout: float = 30, pool_recycle: int = -1,
+                 pre_ping: bool = False, use_lifo: bool = False,
+                 statement_timeout_ms: Optional[int] = None,
+                 connect_timeout: Optional[int] = None, prepared_statements: bool = True,
+                 startup_parameters: bool = True):
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.null_pool = null_pool
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pre_ping = pre_ping
+        self.use_lifo = use_lifo
+        self.statement_timeout_ms = statement_timeout_ms
+        self.connect_timeout = connect_timeout
+        self.prepared_statements = prepared_statements
+        self.startup_parameters = startup_parameters
+
+    def __repr__(self):
+        return f"<PoolProfile(name='{self.name}', null_pool={self.null_pool}, " \
+               f"pool_size={self.pool_size}, max_overflow={self.max_overflow})>"
+
+    def engine_options(self, database_url: str, asynchronous: bool = False) -> dict:
+        """
+        Get the options of `create_engine` or `create_async_engine` for this profile.
+
+        Args:
+            database_url (str): URL of the database
+            asynchronous (bool): Whether the engine runs on asyncpg rather than psycopg2
+
+        Returns:
+            dict: Keyword arguments of the engine, including `poolclass` and `connect_args`
+        """
+        options = {'pool_pre_ping': self.pre_ping}
+        if self.null_pool:
+            options['poolclass'] = NullPool
+        else:
+            options.update(poolclass=AsyncAdaptedQueuePool if asynchronous else QueuePool,
+                           pool_size=self.pool_size, max_overflow=self.max_overflow,
+                           pool_timeout=self.pool_timeout, pool_recycle=self.pool_recycle,
+                           pool_use_lifo=self.use_lifo)
+
+        if make_url(database_url).get_backend_name() != 'postgresql':
+            return options
+
+        connect_args = {}
+        if asynchronous:
+            if self.statement_timeout_ms is not None:
+                connect_args['server_settings'] = {
+                    'statement_timeout': str(self.statement_timeout_ms)}
+            if self.connect_timeout is not None:
+                connect_args['timeout'] = self.connect_timeout
+            if not self.prepared_statements:
+                connect_args.update(statement_cache_size=0, prepared_statement_cache_size=0,
+                                    prepared_statement_name_func=_unique_statement_name)
+        else:
+            if self.statement_timeout_ms is not None:
+                connect_args['options'] = f'-c statement_timeout={self.statement_timeout_ms}'
+            if self.connect_timeout is not None:
+                connect_args['connect_timeout'] = self.connect_timeout
+        if connect_args:
+            options['connect_args'] = connect_args
+        return options
+
+
+def _unique_statement_name() -> str:
+    # Statements asyncpg still prepares for a single execution must not collide with those
+    # of other clients sharing the same server connection behind PgBouncer.
+    return f'__asyncpg_{uuid4().hex}__'
+
+
+PROFILES = {
+    'default': PoolProfile('default'),
+    'server': PoolProfile('server', pool_size=20, max_overflow=10, pool_timeout=10,
+                          pool_recycle=1800, pre_ping=True, use_lifo=True,
+                          statement_timeout_ms=30000, connect_timeout=10),
+    'serverless': PoolProfile('serverless', null_pool=True, statement_timeout_ms=10000,
+                              connect_timeout=5),
+    'pgbouncer': PoolProfile('pgbouncer', null_pool=True, connect_timeout=5,
+                             prepared_statements=False, startup_parameters=False),
+}
+
+
+def get_pool_profile(name: str, pool_size: Optional[int] = None,
+                     max_overflow: Optional[int] = None,
+                     statement_timeout_ms: Optional[int] = None) -> PoolProfile:
+    """
+    Get a pool profile by name, with some of its options overridden.
+
+    Raises:
+        ValueError: If there is no profile of that name, or if a statement timeout is given \
+            to a profile that cannot send it
+    """
+    if name not in PROFILES:
+        raise ValueError(f"Unknown pool profile {name}, expected one of "
+                         f"{', '.join(PROFILES)}.")
+    profile = PROFILES[name]
+    if statement_timeout_ms is not None and not profile.startup_parameters:
+        raise ValueError(f"The {name} pool profile cannot set the statement timeout, "
+                         f"set it on the database role instead of "
+                         f"DATABASE_STATEMENT_TIMEOUT_MS.")
+    overrides = {'pool_size': pool_size, 'max_overflow': max_overflow,
+                 'statement_timeout_ms': statement_timeout_ms}
+    overrides = {key: value for key, value in overrides.items() if value is not None}
+    if not overrides:
+        return profile
+    options = {**vars(profile), **overrides}
+    return PoolProfile(**options)
@@ -0,0 +1,76 @@
+"""
+replicas.py contains the routing of reads between the read replicas of a database.
+
+The replication lag of every replica is measured at most once per check interval, on the
+request that finds the measurement stale. Reads go round-robin to the replicas lagging by
+no more than the maximum lag, and to the primary when none does or when a replica cannot
+be reached.
+"""
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Seconds since the last replayed transaction, zero on a replica streaming from the primary
+# that replayed everything it received, since an idle primary would otherwise look like lag.
+# A replica cut off from the primary has replayed everything it received too, so it is only
+# caught up while its WAL receiver streams. The status of the receiver is only visible to
+# roles with pg_read_all_stats, e.g. through pg_monitor; for others, the lag of an idle
+# primary counts. NULL before any replay.
+LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+         AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class ReplicaRouter:
+    """
+    Lag bookkeeping and round-robin choice of the replicas of a database, without any I/O:
+    the databases measure the replicas returned by `due` and report them with `record`.
+    """
+
+    def __init__(self, count: int, max_lag: float = 5, check_interval: float = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.count = count
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.clock = clock
+        self.lags: List[Optional[float]] = [None] * count
+        self._checked = [float('-inf')] * count
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def due(self) -> List[int]:
+        """
+        Get the replicas to measure now. They are not returned again for a check interval,
+        so that concurrent requests do not measure the same replica.
+        """
+        now = self.clock()
+        with self._lock:
+            indexes = [index for index in range(self.count)
+                       if now - self._checked[index] >= self.check_interval]
+            for index in indexes:
+                self._checked[index] = now
+        return indexes
+
+    def record(self, index: int, lag: Optional[float]):
+        """
+        Record the lag of a replica in seconds, None if it could not be measured.
+        """
+        self.lags[index] = lag
+
+    def choose(self) -> Optional[int]:
+        """
+        Get the next replica to read from, None to read from the primary.
+        """
+        with self._lock:
+            for offset in range(self.count):
+                index = (self._next + offset) % self.count
+                lag = self.lags[index]
+                if lag is not None and lag <= self.max_lag:
+                    self._next = index + 1
+                    return index
+        return None
@@ -0,0 +1,43 @@
+"""
+trigram.py contains the trigram indexes of the fuzzy searches.
+
+They need the pg_trgm extension, which is installed with the tables if the server provides
+it. pg_trgm is a trusted extension, so a role allowed to create tables may install it. The
+indexes are left out on servers without it, where the fuzzy searches are not available.
+"""
+from sqlalchemy import DDL, Table, event, text
+from sqlalchemy.engine import Connection
+
+_AVAILABLE = text("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')")
+_INSTALLED = text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+
+
+def trigrams_available(connection: Connection) -> bool:
+    """
+    Whether the pg_trgm extension can be installed on the server of a connection.
+    """
+    return bool(connection.execute(_AVAILABLE).scalar())
+
+
+def trigrams_installed(connection: Connection) -> bool:
+    """
+    Whether the pg_trgm extension is installed in the database of a connection.
+    """
+    return bool(connection.execute(_INSTALLED).scalar())
+
+
+def _if_available(ddl, target, bind, **kwargs) -> bool:
+    # pylint: disable=unused-argument
+    return trigrams_available(bind)
+
+
+def add_trigram_index(table: Table, name: str, expression: str):
+    """
+    Create a GiST trigram index on an expression of a table along with the table.
+    GiST rather than GIN, so that the index also returns the rows by distance to the query.
+    """
+    event.listen(table, 'after_create', DDL(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(callable_=_if_available))
+    event.listen(table, 'after_create', DDL(
+        f'CREATE INDEX IF NOT EXISTS {name} ON {table.name} '
+        f'USING gist (({expression}) gist_trgm_ops)').execute_if(callable_=_if_available))
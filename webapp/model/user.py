@@ -1,13 +1,14 @@
 """
 user.py contains the User model.
 """
-import random
-from sqlalchemy import Column, String, BigInteger, DateTime
+from sqlalchemy import Column, Index, String, BigInteger, DateTime
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy.sql.expression import func
 from webapp.utils import is_valid_email, is_valid_account_name
 from .database import Base
+from .id_allocator import user_ids
 from .organization import organization_user
+from .trigram import add_trigram_index
 
 
 class User(Base):
@@ -22,6 +23,7 @@ class User(Base):
         location (str): Location of the user
         social_profile (str): Link to the user's social profile
         create_time (DateTime): Time when the user was created
+        version (int): Counter bumped by every change visible in the reads of the user
     """
     __tablename__ = 'users'
 
@@ -33,11 +35,20 @@ class User(Base):
     social_profile = Column(String, nullable=True)
     create_time = Column(DateTime(timezone=True), nullable=False,
                          default=func.now())  # pylint: disable=E1102
+    version = Column(BigInteger, nullable=False, default=1, server_default='1')
 
     organizations = relationship("Organization",
                                  secondary=organization_user, back_populates="users")
     access_keys = relationship("AccessKey", back_populates="user")
 
+    # Serve the prefix searches and their keyset pagination, see query.search_users.
+    # The C collation orders by code point, which lets the same index serve prefix ranges
+    # as text_pattern_ops would, as well as the ORDER BY and the keyset comparison.
+    __table_args__ = (
+        Index('ix_users_username_search', func.lower(username).collate('C'), id),
+        Index('ix_users_email_search', func.lower(email).collate('C'), id),
+    )
+
     def __init__(self, db: Session, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not is_valid_email(self.email):
@@ -45,16 +56,13 @@ class User(Base):
         if not is_valid_account_name(self.username):
             raise ValueError("Invalid username provided.")
 
-        with db.begin_nested():
-            while True:
-                unique_id = random.randint(10000000000, 99999999999)
-                if not db.query(User).filter(User.id == unique_id).first():
-                    self.id = unique_id
-                    break
-            db.add(self)
-            db.commit()
+        self.id = user_ids.next_id(db)
 
     def __repr__(self):
         return f"<User(id={self.id}, username='{self.username}', email='{self.email}', " \
                f"company='{self.company}', location='{self.location}', " \
                f"social_profile='{self.social_profile}')>"
+
+
+add_trigram_index(User.__table__, 'ix_users_username_trigram', 'lower(username)')
+add_trigram_index(User.__table__, 'ix_users_email_trigram', 'lower(email)')
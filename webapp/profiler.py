@@ -0,0 +1,186 @@
+"""
+profiler.py contains the per-request SQL profiler, enabled with SQL_PROFILER=true.
+
+It records every statement of a request with its normalized text, parameter count, duration
+and row count, and reports the totals in a `Server-Timing: db;dur=...` response header.
+Requests slower than SLOW_REQUEST_MS are logged with their slowest statements. SELECTs
+slower than EXPLAIN_QUERY_MS are run again with EXPLAIN (ANALYZE, BUFFERS) and their plans
+are logged too; other statements are never re-run, since ANALYZE executes them.
+"""
+import re
+import time
+from contextvars import ContextVar
+from typing import Any, List, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from webapp.settings import get_settings
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+SLOWEST_LOGGED = 10
+
+_NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),              # string literals
+    (re.compile(r'%\(\w+\)s|\$\d+|%s'), '?'),         # bound parameters
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),           # numeric literals
+    (re.compile(r'\(\?(?:\s*,\s*\?)+\)'), '(?, ...)'),  # IN lists and multi-row values
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(statement: str) -> str:
+    """
+    Strip the values from a statement, so that executions of the same query look the same.
+    """
+    for pattern, replacement in _NORMALIZE:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def _count_parameters(parameters: Any, executemany: bool) -> int:
+    if not parameters:
+        return 0
+    if executemany:
+        return sum(len(row) for row in parameters)
+    return len(parameters)
+
+
+class QueryRecord:
+    """
+    A statement executed during a request.
+    """
+
+    def __init__(self, statement: str, parameters: int, duration: float, rows: int):
+        self.statement = statement
+        self.parameters = parameters
+        self.duration = duration
+        self.rows = rows
+        self.plan: Optional[str] = None
+
+    def __repr__(self):
+        return f"<QueryRecord(statement='{self.statement}', parameters={self.parameters}, " \
+               f"duration={self.duration:.6f}, rows={self.rows})>"
+
+
+class RequestProfile:
+    """
+    Statements executed on behalf of one request.
+    """
+
+    def __init__(self, explain_threshold: Optional[float] = None):
+        self.explain_threshold = explain_threshold
+        self.queries: List[QueryRecord] = []
+
+    @property
+    def db_time(self) -> float:
+        return sum(query.duration for query in self.queries)
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.db_time * 1000:.1f};desc="{len(self.queries)} queries"'
+
+    def summary(self) -> str:
+        lines = []
+        for query in sorted(self.queries, key=lambda query: -query.duration)[:SLOWEST_LOGGED]:
+            lines.append(f"  {query.duration * 1000:8.1f} ms  {query.rows:6d} rows  "
+                         f"{query.parameters:5d} params  {query.statement}")
+            if query.plan:
+                lines.extend('      ' + line for line in query.plan.splitlines())
+        return '\n'.join(lines)
+
+
+_profile: ContextVar[Optional[RequestProfile]] = ContextVar('sql_profile', default=None)
+
+
+def get_profile() -> Optional[RequestProfile]:
+    return _profile.get()
+
+
+def _explain(conn, statement: str, parameters: Any) -> Optional[str]:
+    # A separate DBAPI cursor keeps the results of the profiled statement, and
+    # bypasses the engine events, so the EXPLAIN is not profiled itself. It runs in a
+    # savepoint, since a failed EXPLAIN, e.g. one running into the statement timeout,
+    # would otherwise abort the transaction of the request.
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT profiler_explain')
+        try:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT profiler_explain')
+            raise
+        finally:
+            cursor.execute('RELEASE SAVEPOINT profiler_explain')
+        return plan
+    except Exception as exc:  # the plan is best effort, the request goes on
+        logger.warning("Could not explain statement %s: %s", normalize(statement), str(exc))
+        return None
+    finally:
+        cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    if context is not None and _profile.get() is not None:
+        context.profiler_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    profile = _profile.get()
+    start = getattr(context, 'profiler_start_time', None)
+    if profile is None or start is None:
+        return
+    duration = time.perf_counter() - start
+    record = QueryRecord(normalize(statement), _count_parameters(parameters, executemany),
+                         duration, cursor.rowcount if cursor.rowcount is not None else -1)
+    profile.queries.append(record)
+
+    if profile.explain_threshold is not None and duration >= profile.explain_threshold \
+            and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+        record.plan = _explain(conn, statement, parameters)
+
+
+def install_profiler_hooks():
+    hooks = [('before_cursor_execute', _before_cursor_execute),
+             ('after_cursor_execute', _after_cursor_execute)]
+    for name, func in hooks:
+        if not event.contains(Engine, name, func):
+            event.listen(Engine, name, func)
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware profiling the statements of each request while SQL_PROFILER is enabled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        settings = get_settings()
+        if scope['type'] != 'http' or not settings.sql_profiler:
+            await self.app(scope, receive, send)
+            return
+
+        explain_ms = settings.explain_query_ms
+        profile = RequestProfile(explain_ms / 1000 if explain_ms is not None else None)
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'server-timing', profile.server_timing().encode())]
+            await send(message)
+
+        token = _profile.set(profile)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _profile.reset(token)
+            elapsed = time.perf_counter() - start
+            if elapsed * 1000 >= settings.slow_request_ms:
+                logger.warning("Slow request %s %s: %.1f ms, %d queries, %.1f ms in database\n%s",
+                               scope['method'], scope['path'], elapsed * 1000,
+                               len(profile.queries), profile.db_time * 1000, profile.summary())
@@ -0,0 +1,373 @@
+"""
+ratelimit.py contains the rate limiting and load shedding middleware of the API.
+
+Every API request takes a token from the buckets of the scopes it falls in, configured with
+RATE_LIMITS, e.g. `RATE_LIMITS=ip=20/s:40,auth=10/m,key=50/s:100,org=200/s`:
+
+- `ip`: all requests of a client IP.
+- `auth`: signups and logins of a client IP, to slow down account creation and key guessing.
+- `key`: requests of an access key sent as `Authorization: Bearer <key>`.
+- `org`: requests of the members of an organization on it, e.g. /organizations/{org_id}/keys,
+  taken by `get_permissions` once the caller is known to be a member, so that other clients
+  cannot drain the bucket of an organization.
+
+A request finding a bucket empty is rejected with 429 and a `Retry-After` header, and gets
+back the tokens it took from its other buckets. The buckets are held in process, or in Redis
+with RATE_LIMIT_URL so that all workers share them.
+
+While the event loop lags by more than SHED_LOOP_LAG_MS or a database checkout has waited
+more than SHED_POOL_WAIT_MS, the process is overloaded and requests are shed: only those
+whose buckets are at least half full get through, so the clients causing the spike are
+turned away first while the others keep their latency. Requests in no bucket are all shed.
+Shedding picks the requests by their buckets, so it only applies once RATE_LIMITS is set.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from webapp.metrics import EVENT_LOOP_LAG, REQUESTS_REJECTED, pool_wait
+from webapp.settings import get_settings
+from webapp.utils import get_logger, hash_access_key
+
+logger = get_logger(__name__)
+
+SCOPES = ('ip', 'auth', 'key', 'org')
+AUTH_ROUTES = {('POST', '/api/v1/users'), ('POST', '/api/v1/login')}
+# Health checks must not be turned away by their own load balancer's address.
+EXEMPT_PATHS = {'/api/v1/ping'}
+# Fraction of its burst a bucket must hold for its requests to get through an overload.
+OVERLOAD_RESERVE = 0.5
+
+# Refills and takes from a bucket stored as a hash of its tokens and last update time,
+# expiring once it would be full again. Returns the seconds to wait, as a string since
+# Redis truncates Lua numbers to integers.
+_TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local required = 1 + tonumber(ARGV[4]) * burst
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= required then
+    tokens = tokens - 1
+else
+    wait = (required - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+# Gives a token back to a bucket, e.g. of a request rejected by another bucket.
+_GIVE_BACK_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+if not state[1] then
+    return 0
+end
+local tokens = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+redis.call('HSET', KEYS[1], 'tokens', math.min(burst, tokens + 1), 'updated', now)
+return 1
+"""
+
+
+class RateLimit:
+    """
+    Token bucket refilled at `rate` tokens per second up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+    def __repr__(self):
+        return f"<RateLimit(rate={self.rate}, burst={self.burst})>"
+
+
+class LocalBuckets:
+    """
+    Token buckets of the process, forgetting the least recently used beyond `max_entries`.
+    A forgotten bucket starts full again, as it would have refilled in the meantime.
+    """
+    blocking = False
+
+    def __init__(self, max_entries: int = 100000, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+
+    def take(self, key: str, limit: RateLimit, reserve: float = 0) -> float:
+        """
+        Take a token from a bucket if it holds one more than `reserve` times its burst.
+
+        Returns:
+            float: 0 if the token was taken, otherwise the seconds until it could be
+        """
+        # The buckets are only used from the event loop, which needs no lock.
+        now = self.clock()
+        tokens, updated = self._buckets.pop(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+        required = 1 + reserve * limit.burst
+        wait = 0.0
+        if tokens >= required:
+            tokens -= 1
+        else:
+            wait = (required - tokens) / limit.rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def give_back(self, key: str, limit: RateLimit):
+        """
+        Give back a token taken from a bucket.
+        """
+        if key in self._buckets:
+            tokens, updated = self._buckets[key]
+            self._buckets[key] = (min(limit.burst, tokens + 1), updated)
+
+
+class RedisBuckets:
+    """
+    Token buckets shared by all workers in Redis, updated atomically by a script.
+    Requests are let through when Redis cannot be reached.
+    """
+    blocking = True
+
+    def __init__(self, url: str):
+        import redis  # pylint: disable=import-outside-toplevel,import-error
+        self.client = redis.Redis.from_url(url)
+        self.errors = (redis.RedisError,)
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+        self._give_back = self.client.register_script(_GIVE_BACK_SCRIPT)
+
+    def take(self, key: str, limit: RateLimit, reserve: float = 0) -> float:
+        try:
+            return float(self._take(keys=['devchat:rate:' + key],
+                                    args=[limit.rate, limit.burst, time.time(), reserve]))
+        except self.errors as exc:
+            logger.warning("Could not rate limit %s: %s", key, str(exc))
+            return 0.0
+
+    def give_back(self, key: str, limit: RateLimit):
+        try:
+            self._give_back(keys=['devchat:rate:' + key],
+                            args=[limit.rate, limit.burst, time.time()])
+        except self.errors as exc:
+            logger.warning("Could not give back a token of %s: %s", key, str(exc))
+
+
+class LoopLagMonitor:
+    """
+    Task measuring how late the event loop wakes it up, every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.lag = 0.0
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            EVENT_LOOP_LAG.set(self.lag)
+
+
+class RateLimiter:
+    """
+    Admission control of the API requests by token buckets and overload signals.
+
+    Args:
+        limits (dict): Rate limits by scope
+        buckets: LocalBuckets or RedisBuckets holding the tokens
+        monitor (LoopLagMonitor, optional): Monitor of the event loop lag
+        max_loop_lag (float, optional): Lag in seconds above which requests are shed
+        max_pool_wait (float, optional): Checkout wait in seconds above which requests are shed
+        trust_forwarded_for (bool): Whether the client IP is read from X-Forwarded-For
+    """
+
+    def __init__(self, limits: Dict[str, RateLimit], buckets, monitor: LoopLagMonitor = None,
+                 max_loop_lag: Optional[float] = None, max_pool_wait: Optional[float] = None,
+                 trust_forwarded_for: bool = False):
+        # pylint: disable=too-many-arguments
+        unknown = set(limits) - set(SCOPES)
+        if unknown:
+            raise ValueError(f"Unknown rate limit scopes {', '.join(sorted(unknown))}, "
+                             f"expected some of {', '.join(SCOPES)}.")
+        self.limits = limits
+        self.buckets = buckets
+        self.monitor = monitor or LoopLagMonitor()
+        self.max_loop_lag = max_loop_lag
+        self.max_pool_wait = max_pool_wait
+        self.trust_forwarded_for = trust_forwarded_for
+
+    def overloaded(self) -> bool:
+        if self.max_loop_lag is not None and self.monitor.lag > self.max_loop_lag:
+            return True
+        return self.max_pool_wait is not None and pool_wait() > self.max_pool_wait
+
+    def client_ip(self, scope) -> str:
+        headers = dict(scope.get('headers') or [])
+        forwarded_for = headers.get(b'x-forwarded-for')
+        if self.trust_forwarded_for and forwarded_for:
+            # The last address is the one the proxy in front of the app added; those before
+            # it come from the client, which may forge them.
+            return forwarded_for.decode('latin-1').split(',')[-1].strip()
+        client = scope.get('client')
+        return client[0] if client else 'unknown'
+
+    def buckets_of(self, scope) -> List[Tuple[str, str]]:
+        """
+        Get the scopes and bucket keys of a request, for the scopes with a rate limit.
+        """
+        keys = []
+        if 'ip' in self.limits or 'auth' in self.limits:
+            ip = self.client_ip(scope)
+            keys.append(('ip', f'ip:{ip}'))
+            if (scope['method'], scope['path']) in AUTH_ROUTES:
+                keys.append(('auth', f'auth:{ip}'))
+        if 'key' in self.limits:
+            authorization = dict(scope.get('headers') or []).get(b'authorization', b'')
+            auth_scheme, _, key = authorization.decode('latin-1').partition(' ')
+            if auth_scheme.lower() == 'bearer' and key.strip():
+                keys.append(('key', f'key:{hash_access_key(key.strip())}'))
+        return [(name, key) for name, key in keys if name in self.limits]
+
+    async def _call(self, method: Callable, *args):
+        if self.buckets.blocking:
+            return await run_in_threadpool(method, *args)
+        return method(*args)
+
+    async def take(self, buckets: List[Tuple[str, str]]) -> Tuple[float, Optional[str]]:
+        """
+        Take a token from every bucket, or from none of them if one is short of tokens.
+
+        Args:
+            buckets (list): Scopes and keys of the buckets
+
+        Returns:
+            Tuple[float, Optional[str]]: 0 and None if the tokens were taken, otherwise
+                the seconds after which to retry and the reason, a scope or `overload`
+        """
+        overloaded = self.overloaded()
+        reserve = OVERLOAD_RESERVE if overloaded else 0
+        if overloaded and not buckets:
+            return 1.0, 'overload'
+        for index, (name, key) in enumerate(buckets):
+            wait = await self._call(self.buckets.take, key, self.limits[name], reserve)
+            if wait > 0:
+                await self.give_back(buckets[:index])
+                return wait, 'overload' if overloaded else name
+        return 0.0, None
+
+    async def give_back(self, buckets: List[Tuple[str, str]]):
+        """
+        Give back the tokens taken from buckets by a request rejected afterwards.
+        """
+        for name, key in buckets:
+            await self._call(self.buckets.give_back, key, self.limits[name])
+
+    async def admit(self, scope) -> Tuple[float, Optional[str]]:
+        """
+        Take a token from every bucket of a request, see `take`.
+        """
+        return await self.take(self.buckets_of(scope))
+
+
+def _rejection(retry_after: float, reason: str) -> Tuple[str, Dict[str, str]]:
+    REQUESTS_REJECTED.inc(reason=reason)
+    detail = "Server overloaded. Please try again later." if reason == 'overload' \
+        else "Too many requests. Please try again later."
+    return detail, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter() -> RateLimiter:
+    """
+    Get the rate limiter of the process, configured by RATE_LIMITS, RATE_LIMIT_URL,
+    TRUST_FORWARDED_FOR, SHED_LOOP_LAG_MS and SHED_POOL_WAIT_MS.
+    """
+    settings = get_settings()
+    limits = {name: RateLimit(rate, burst) for name, (rate, burst)
+              in settings.rate_limits.items()}
+    if settings.rate_limit_url and limits:
+        logger.info("Rate limiting in Redis")
+        buckets = RedisBuckets(settings.rate_limit_url)
+    else:
+        buckets = LocalBuckets()
+    # Without limits, every request would be shed alike instead of the heaviest clients.
+    shedding = bool(limits)
+    return RateLimiter(limits, buckets,
+                       max_loop_lag=settings.shed_loop_lag if shedding else None,
+                       max_pool_wait=settings.shed_pool_wait if shedding else None,
+                       trust_forwarded_for=settings.trust_forwarded_for)
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware rejecting the API requests over their rate limits or shed under overload
+    with 429 Too Many Requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/') \
+                or scope['path'] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = get_rate_limiter()
+        buckets = limiter.buckets_of(scope)
+        retry_after, reason = await limiter.take(buckets)
+        if reason is None:
+            # Kept in the request state, to be given back if the organization rejects it.
+            scope.setdefault('state', {})['rate_limit_buckets'] = buckets
+            await self.app(scope, receive, send)
+            return
+
+        detail, headers = _rejection(retry_after, reason)
+        response = JSONResponse({"detail": detail}, status_code=429, headers=headers)
+        await response(scope, receive, send)
+
+
+async def admit_organization(request: Request, org_id: int):
+    """
+    Take a token from the bucket of an organization for a request of one of its members.
+
+    Raises:
+        HTTPException: 429 if the bucket is short of tokens, after giving back the tokens
+            the request took from its other buckets
+    """
+    limiter = get_rate_limiter()
+    if 'org' not in limiter.limits:
+        return
+    retry_after, reason = await limiter.take([('org', f'org:{org_id}')])
+    if reason is not None:
+        await limiter.give_back(getattr(request.state, 'rate_limit_buckets', []))
+        detail, headers = _rejection(retry_after, reason)
+        raise HTTPException(status_code=429, detail=detail, headers=headers)
@@ -0,0 +1,195 @@
+"""
+settings.py reads the webapp configuration from environment variables once per process.
+"""
+import os
+from functools import lru_cache
+from typing import Dict, Mapping, Optional, Tuple
+
+
+def _as_bool(value: Optional[str], default: bool) -> bool:
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _as_int(value: Optional[str]) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def _as_rates(value: Optional[str]) -> Dict[str, float]:
+    # Sampling rates given as `logger=rate` pairs separated by commas.
+    rates = {}
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        name, _, rate = pair.partition('=')
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"Invalid sampling rate of logger {name.strip()}: {rate}")
+        rates[name.strip()] = rate
+    return rates
+
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def _as_limits(value: Optional[str]) -> Dict[str, Tuple[float, float]]:
+    # Rate limits given as `scope=count/period[:burst]` pairs separated by commas, with a
+    # period of s, m or h. Returns the rate in tokens per second and the burst by scope.
+    limits = {}
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        name, _, limit = pair.partition('=')
+        limit, _, burst = limit.partition(':')
+        count, _, period = limit.partition('/')
+        period = period.strip().lower() or 's'
+        if period not in _PERIODS or float(count) <= 0:
+            raise ValueError(f"Invalid rate limit of scope {name.strip()}: {limit}")
+        limits[name.strip()] = (float(count) / _PERIODS[period],
+                                float(burst) if burst.strip() else float(count))
+    return limits
+
+
+def _as_milliseconds(value: Optional[str], default: float) -> Optional[float]:
+    # A threshold in milliseconds returned in seconds, disabled by 0.
+    milliseconds = float(value) if value else default
+    return milliseconds / 1000 if milliseconds > 0 else None
+
+
+class Settings:
+    """
+    Settings of the webapp.
+
+    Attributes:
+        database_url (str): URL of the primary database
+        cold_start (bool): Whether the process runs as a short-lived serverless function. \
+            Defaults to True on Vercel.
+        create_tables (bool): Whether to create missing tables on first database use. \
+            Defaults to False in cold-start mode.
+        database_pool_profile (str): Name of the connection pool profile of the engines, \
+            see webapp/model/pool.py. Defaults to `serverless` in cold-start mode, \
+            where connections are not pooled, and to `default` otherwise.
+        database_listen_url (str): URL of the database connection listening to organization \
+            events, which must not go through PgBouncer in transaction mode. \
+            Defaults to DATABASE_URL.
+        database_replica_urls (list): URLs of the read replicas of the primary database, \
+            given as a comma-separated list
+        replica_max_lag_seconds (float): Replication lag above which a replica is not read
+        replica_check_seconds (float): Seconds between two measurements of the lag of a replica
+        read_your_writes_seconds (float): Seconds during which the reads of changed users \
+            and organizations go to the primary database
+        database_pool_size (int): Pool size overriding the one of the profile
+        database_max_overflow (int): Overflow overriding the one of the profile
+        database_statement_timeout_ms (int): Statement timeout overriding the one of the profile
+        jwt_secret_key (str): HS256 secret used to sign access keys
+        sendgrid_api_key (str): API key of SendGrid
+        sendgrid_template_id (str): ID of the SendGrid template of the welcome email
+        hcaptcha_secret_key (str): Secret key of hCaptcha
+        hcaptcha_url (str): Base URL of the hCaptcha API
+        sendgrid_url (str): Base URL of the SendGrid API
+        outbox_worker (bool): Whether to drain the outbox in the app process. \
+            Defaults to False in cold-start mode, where `python -m webapp.worker` does it.
+        outbox_concurrency (int): Number of tasks draining the outbox
+        id_permutation_key (str): Key of the permutation behind user and organization IDs. \
+            It must never change once IDs have been issued.
+        cache_url (str): Redis URL of the entity cache shared by all workers. \
+            If not set, every process caches entities in memory.
+        cache_max_entries (int): Maximum number of entries of the in-memory cache
+        cache_ttl (float): Seconds after which cached entities expire
+        sql_profiler (bool): Whether to profile the statements of every request
+        slow_request_ms (float): Duration above which a profiled request is logged \
+            with its slowest statements
+        explain_query_ms (float): Duration above which a profiled SELECT is explained \
+            with EXPLAIN (ANALYZE, BUFFERS). If not set, no statement is explained.
+        single_flight_wait (float): Seconds a read waits for the identical read in flight \
+            before loading on its own, None not to coalesce reads
+        fast_responses (bool): Whether read endpoints encode their results directly, \
+            with orjson if installed, instead of validating them against their response models
+        log_level (str): Level of the loggers of the app, e.g. `INFO` or `DEBUG`
+        log_format (str): Format of the logs, `text` lines or `json` lines
+        log_sampling (dict): Rates at which records below WARNING are kept, by logger name
+        log_queue (bool): Whether records are written out by a background thread instead of \
+            the logging thread. Defaults to False in cold-start mode, where the process may be \
+            frozen between requests with records still queued.
+        rate_limits (dict): Rate in requests per second and burst of the token buckets, \
+            by scope: `ip`, `auth`, `key` and `org`, see webapp/ratelimit.py
+        rate_limit_url (str): Redis URL of the token buckets shared by all workers. \
+            Defaults to CACHE_URL. If neither is set, every process has its own buckets.
+        trust_forwarded_for (bool): Whether the client IP is read from the last address of \
+            X-Forwarded-For. Defaults to True on Vercel, whose proxy sets it.
+        shed_loop_lag (float): Event loop lag in seconds above which requests are shed, \
+            None to never shed on it. Requests are only shed when `rate_limits` are set.
+        shed_pool_wait (float): Wait for a database connection in seconds above which \
+            requests are shed, None to never shed on it. Not set by default in cold-start \
+            mode, where every session opens its own connection.
+        search_timeout (float): Seconds after which the statements of a search are canceled, \
+            None not to bound them
+        admin_user_ids (set): IDs of the users allowed to search users and organizations, \
+            given as a comma-separated list
+    """
+
+    def __init__(self, environ: Mapping[str, str] = None):
+        if environ is None:
+            environ = os.environ
+
+        self.database_url = environ.get('DATABASE_URL')
+        self.cold_start = _as_bool(environ.get('COLD_START'), bool(environ.get('VERCEL')))
+        self.create_tables = _as_bool(environ.get('DATABASE_CREATE_TABLES'), not self.cold_start)
+        self.database_listen_url = environ.get('DATABASE_LISTEN_URL') or self.database_url
+        self.database_replica_urls = [
+            url.strip() for url in environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url.strip()]
+        self.replica_max_lag_seconds = float(environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+        self.replica_check_seconds = float(environ.get('REPLICA_CHECK_SECONDS', '1'))
+        self.read_your_writes_seconds = float(environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+        self.database_pool_profile = environ.get('DATABASE_POOL_PROFILE') or \
+            ('serverless' if self.cold_start else 'default')
+        self.database_pool_size = _as_int(environ.get('DATABASE_POOL_SIZE'))
+        self.database_max_overflow = _as_int(environ.get('DATABASE_MAX_OVERFLOW'))
+        self.database_statement_timeout_ms = _as_int(
+            environ.get('DATABASE_STATEMENT_TIMEOUT_MS'))
+
+        self.jwt_secret_key = environ.get('JWT_SECRET_KEY')
+        self.sendgrid_api_key = environ.get('SENDGRID_API_KEY')
+        self.sendgrid_template_id = environ.get('SENDGRID_TEMPLATE_ID')
+        self.hcaptcha_secret_key = environ.get('HCAPTCHA_SECRET_KEY')
+        self.hcaptcha_url = environ.get('HCAPTCHA_URL', 'https://hcaptcha.com')
+        self.sendgrid_url = environ.get('SENDGRID_URL', 'https://api.sendgrid.com')
+        self.outbox_worker = _as_bool(environ.get('OUTBOX_WORKER'), not self.cold_start)
+        self.outbox_concurrency = int(environ.get('OUTBOX_CONCURRENCY', '2'))
+        self.id_permutation_key = environ.get('ID_PERMUTATION_KEY')
+        self.cache_url = environ.get('CACHE_URL')
+        self.cache_max_entries = int(environ.get('CACHE_MAX_ENTRIES', '10000'))
+        self.cache_ttl = float(environ.get('CACHE_TTL', '60'))
+        self.fast_responses = _as_bool(environ.get('FAST_RESPONSES'), False)
+        self.single_flight_wait = _as_milliseconds(environ.get('SINGLE_FLIGHT_WAIT_MS'), 1000)
+        self.sql_profiler = _as_bool(environ.get('SQL_PROFILER'), False)
+        self.slow_request_ms = float(environ.get('SLOW_REQUEST_MS', '500'))
+        explain_query_ms = environ.get('EXPLAIN_QUERY_MS')
+        self.explain_query_ms = float(explain_query_ms) if explain_query_ms else None
+        self.log_level = environ.get('LOG_LEVEL', 'INFO').upper()
+        self.log_format = environ.get('LOG_FORMAT', 'text').lower()
+        self.log_sampling = _as_rates(environ.get('LOG_SAMPLING'))
+        self.log_queue = _as_bool(environ.get('LOG_QUEUE'), not self.cold_start)
+        self.rate_limits = _as_limits(environ.get('RATE_LIMITS'))
+        self.rate_limit_url = environ.get('RATE_LIMIT_URL') or self.cache_url
+        self.trust_forwarded_for = _as_bool(environ.get('TRUST_FORWARDED_FOR'),
+                                            bool(environ.get('VERCEL')))
+        self.shed_loop_lag = _as_milliseconds(environ.get('SHED_LOOP_LAG_MS'), 250)
+        self.shed_pool_wait = _as_milliseconds(environ.get('SHED_POOL_WAIT_MS'),
+                                               0 if self.cold_start else 1000)
+        self.search_timeout = _as_milliseconds(environ.get('SEARCH_TIMEOUT_MS'), 500)
+        self.admin_user_ids = {
+            int(user_id) for user_id in environ.get('ADMIN_USER_IDS', '').split(',')
+            if user_id.strip()}
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """
+    Get the settings of the process, reading the environment on the first call only.
+    """
+    return Settings()
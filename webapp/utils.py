@@ -4,44 +4,29 @@ utils.py contains utility functions that are used throughout the webapp.
 from datetime import datetime
 import hashlib
 import logging
-import os
 import random
 import re
 import time
 import uuid
 
-import jwt
-import requests
 from sqlalchemy.orm import Session
 from sqlalchemy.sql.expression import func
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To
+from webapp.log import TEXT_FORMAT, ensure_logging
+from webapp.settings import get_settings
+
+# jwt is imported where it is used to keep cold starts fast.
 
 
 def get_logger(name: str = None, handler: logging.Handler = None) -> logging.Logger:
+    """
+    Get a logger, whose level is set for all the loggers of the app by `configure_logging`.
+    The records go through the logging pipeline, and also to `handler` if one is given.
+    """
     local_logger = logging.getLogger(name)
-
-    # Default to 'INFO' if 'LOG_LEVEL' env var is not set
-    log_level_str = os.getenv('LOG_LEVEL', 'INFO')
-    log_level = getattr(logging, log_level_str.upper(), logging.INFO)
-    local_logger.setLevel(log_level)
-
-    # If a handler is provided, configure and add it to the logger
+    ensure_logging()
     if handler is not None:
-        handler.setLevel(log_level)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        local_logger.addHandler(handler)
-
-    # If no handler is provided and the logger has no handlers, add a default StreamHandler
-    elif not local_logger.handlers:
-        handler = logging.StreamHandler()
-        handler.setLevel(log_level)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
         local_logger.addHandler(handler)
-
-    local_logger.info("Log level set to %s (env: %s)", log_level, log_level_str)
     return local_logger
 
 
@@ -67,6 +52,8 @@ def generate_uuid(name: str) -> str:
 
 
 def generate_access_key(org_id: int) -> str:
+    import jwt  # pylint: disable=import-outside-toplevel
+
     if not org_id:
         raise ValueError("Invalid organization ID")
     # Load the HS256 secret key from environment variables
@@ -86,6 +73,8 @@ def generate_access_key(org_id: int) -> str:
 
 
 def verify_access_key(key: str) -> str:
+    import jwt  # pylint: disable=import-outside-toplevel
+
     if not key or not key.startswith('DC.'):
         raise ValueError("Invalid access key prefix")
 
@@ -108,60 +97,8 @@ def now(db: Session) -> datetime:
     return db.query(func.now()).scalar()  # pylint: disable=E1102
 
 
-def send_email(from_address: str, from_name: str, to_address: str,
-               template_id: str, template_data: dict) -> int:
-    from_email = Email(from_address, from_name)
-    to_email = To(to_address)
-    mail = Mail(from_email, to_email)
-
-    # Set the transactional template ID
-    mail.template_id = template_id
-
-    # Set the dynamic template data
-    mail.dynamic_template_data = template_data
-
-    client = SendGridAPIClient(_get_sendgrid_api_key())
-    response = client.send(mail)
-    logger.info("Sent email of template %s to %s with status code %s",
-                template_id, to_address, response.status_code)
-    return response.status_code
-
-
 def _get_jwt_secret_key() -> str:
-    secret_key = os.getenv('JWT_SECRET_KEY')
+    secret_key = get_settings().jwt_secret_key
     if secret_key is None:
         raise ValueError("JWT_SECRET_KEY environment variable is not set")
     return secret_key
-
-
-def _get_sendgrid_api_key() -> str:
-    sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
-    if sendgrid_api_key is None:
-        raise ValueError("SENDGRID_API_KEY environment variable is not set")
-    return sendgrid_api_key
-
-
-def verify_hcaptcha(token: str) -> bool:
-    """
-    Verify the hCaptcha token.
-
-    :param token: The hCaptcha token to verify.
-    :return: True if the token is valid, False otherwise.
-    """
-    url = "https://hcaptcha.com/siteverify"
-    secret_key = os.getenv('HCAPTCHA_SECRET_KEY')
-    if secret_key is None:
-        raise ValueError("HCAPTCHA_SECRET_KEY environment variable is not set")
-    payload = {
-        "response": token,
-        "secret": secret_key
-    }
-
-    response = requests.post(url, data=payload, timeout=10)
-    result = response.json()
-
-    if not result.get("success"):
-        error_msg = ", ".join(result.get("error-codes", []))
-        logger.info("hCaptcha verification failed: %s", error_msg)
-        return False
-    return True
@@ -0,0 +1,142 @@
+"""
+worker.py contains the background worker pool draining the transactional outbox.
+
+The worker runs inside long-lived app processes when OUTBOX_WORKER is enabled (the default
+outside of cold-start mode). On serverless deployments, run it as its own process:
+
+    python -m webapp.worker
+"""
+import asyncio
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List
+from webapp.controller import aio
+from webapp.http_clients import ServiceUnavailableError
+from webapp.integrations import send_email
+from webapp.model import AsyncDatabase
+from webapp.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class PermanentFailure(Exception):
+    """
+    Raised by a handler when retrying the message cannot succeed.
+    """
+
+
+async def _handle_email(payload: Dict[str, Any]):
+    status = await send_email(**payload)
+    if status == 429 or status >= 500:
+        raise ServiceUnavailableError(f"SendGrid responded with status code {status}.")
+    if status != 202:
+        raise PermanentFailure(f"SendGrid responded with status code {status}.")
+
+
+HANDLERS: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {
+    'email': _handle_email,
+}
+
+
+class OutboxWorker:
+    """
+    A pool of tasks claiming batches of outbox messages and handling them concurrently.
+
+    A failed message is retried with exponential backoff, from `base_delay` up to
+    `max_delay`, until it has been attempted `max_attempts` times.
+    """
+
+    def __init__(self, database: AsyncDatabase, concurrency: int = 2, batch_size: int = 20,
+                 poll_interval: float = 1.0, max_attempts: int = 8,
+                 base_delay: timedelta = timedelta(seconds=5),
+                 max_delay: timedelta = timedelta(hours=1),
+                 handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = None):
+        self.database = database
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.handlers = handlers if handlers is not None else HANDLERS
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = asyncio.Event()
+
+    def backoff(self, attempts: int) -> timedelta:
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    async def _handle(self, message: Dict[str, Any]) -> Exception:
+        handler = self.handlers.get(message['topic'])
+        if handler is None:
+            return PermanentFailure(f"No handler for topic {message['topic']}.")
+        try:
+            await handler(message['payload'])
+            return None
+        except Exception as exc:  # the error is recorded on the message
+            return exc
+
+    async def run_once(self) -> int:
+        """
+        Claim and handle one batch of messages.
+
+        Returns:
+            int: Number of messages claimed
+        """
+        async with self.database.get_session() as db:
+            messages = await aio.claim_messages(db, self.batch_size)
+            if not messages:
+                return 0
+
+            errors = await asyncio.gather(*[self._handle(message) for message in messages])
+
+            await aio.complete_messages(db, [message['id'] for message, error
+                                             in zip(messages, errors) if error is None])
+            for message, error in zip(messages, errors):
+                if error is None:
+                    continue
+                permanent = isinstance(error, PermanentFailure) or \
+                    message['attempts'] >= self.max_attempts
+                logger.warning("Outbox message %d (%s) failed on attempt %d: %r",
+                               message['id'], message['topic'], message['attempts'], error)
+                await aio.fail_message(db, message['id'], repr(error),
+                                       None if permanent else self.backoff(message['attempts']))
+        return len(messages)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                claimed = await self.run_once()
+            except Exception as exc:
+                logger.exception("Outbox worker error: %s", str(exc))
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+        logger.info("Started %d outbox worker tasks", self.concurrency)
+
+    async def stop(self):
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+async def _main():
+    # pylint: disable=import-outside-toplevel
+    from webapp.dependencies import get_async_database
+    from webapp.settings import get_settings
+
+    worker = OutboxWorker(get_async_database(), concurrency=get_settings().outbox_concurrency)
+    worker.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await worker.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())